@@ -80,6 +80,18 @@ def assert_torrents_equal():
     return _assert_torrents_equal
 
 
+def _expected_hashes(path, piece_size):
+    torrent = torf.Torrent(path)
+    torrent.piece_size = piece_size
+    torrent.generate()
+    return torrent.hashes
+
+
+@pytest.fixture
+def expected_hashes():
+    return _expected_hashes
+
+
 @pytest.fixture
 def human_readable(monkeypatch):
     @contextlib.contextmanager
@@ -102,6 +114,15 @@ def mock_content(tmp_path):
     return base
 
 
+@pytest.fixture
+def content(tmp_path):
+    base = tmp_path / 'content'
+    base.mkdir()
+    for name, size in (('a', 800000), ('b', 98760), ('c', 0), ('d', 560008)):
+        (base / name).write_bytes(os.urandom(size))
+    return base
+
+
 @pytest.fixture
 def mock_create_mode(monkeypatch):
     from torfcli import _main
@@ -0,0 +1,395 @@
+import json
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+import torf
+
+from torfcli import _errors as err
+from torfcli import _vars, run
+
+
+def _make_content(tmp_path, *names):
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.mkdir(parents=True)
+        (path / 'file.txt').write_text(f'data of {name}')
+        paths.append(path)
+    return paths
+
+
+def test_multiple_PATHs(capsys, tmp_path):
+    paths = _make_content(tmp_path, 'foo', 'bar', 'baz')
+    run([str(p) for p in paths])
+    for path in paths:
+        t = torf.Torrent.read(f'{path.name}.torrent')
+        assert t.name == path.name
+        assert len(t.files) == 1
+    cap = capsys.readouterr()
+    for path in paths:
+        assert f'Torrent\t{path.name}.torrent\n' in cap.out
+
+
+def test_multiple_PATHs_with_options_between(capsys, tmp_path):
+    paths = _make_content(tmp_path, 'foo', 'bar')
+    run([str(paths[0]), '--private', str(paths[1]), '--tracker', 'http://localhost/announce'])
+    for path in paths:
+        t = torf.Torrent.read(f'{path.name}.torrent')
+        assert t.private is True
+        assert t.trackers == [['http://localhost/announce']]
+
+
+def test_each_option(capsys, tmp_path):
+    _make_content(tmp_path, 'base/foo', 'base/bar')
+    (tmp_path / 'base' / 'not_a_directory').write_text('ignored')
+    run([str(tmp_path / 'base'), '--each'])
+    assert sorted(f for f in os.listdir('.') if f.endswith('.torrent')) == ['bar.torrent', 'foo.torrent']
+
+
+def test_each_option_without_subdirectories(capsys, tmp_path):
+    content_path = tmp_path / 'base'
+    content_path.mkdir()
+    with patch('sys.exit') as mock_exit:
+        run([str(content_path), '--each'])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: {content_path}: No subdirectories\n'
+
+
+def test_out_option_is_directory(capsys, tmp_path):
+    paths = _make_content(tmp_path, 'foo', 'bar')
+    outdir = tmp_path / 'torrents'
+    outdir.mkdir()
+    run([str(p) for p in paths] + ['--out', str(outdir), '--profile', 'this', '--noconfig'])
+    assert sorted(os.listdir(outdir)) == ['bar.this.torrent', 'foo.this.torrent']
+
+
+def test_out_option_is_not_a_directory(capsys, tmp_path):
+    paths = _make_content(tmp_path, 'foo', 'bar')
+    with patch('sys.exit') as mock_exit:
+        run([str(p) for p in paths] + ['--out', 'foo.torrent'])
+    mock_exit.assert_called_once_with(err.Code.WRITE)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: foo.torrent: Not a directory\n'
+
+
+def test_failing_job_does_not_stop_other_jobs(capsys, tmp_path):
+    paths = _make_content(tmp_path, 'foo', 'bar')
+    with patch('sys.exit') as mock_exit:
+        run([str(paths[0]), 'nonexisting', str(paths[1])])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    assert os.path.exists('foo.torrent')
+    assert os.path.exists('bar.torrent')
+    cap = capsys.readouterr()
+    assert cap.err == (f'{_vars.__appname__}: nonexisting: No such file or directory\n'
+                       f'{_vars.__appname__}: 1 of 3 jobs failed\n')
+
+
+def test_json_output_is_one_object_per_line(capsys, tmp_path):
+    paths = _make_content(tmp_path, 'foo', 'bar')
+    run([str(p) for p in paths] + ['--json'])
+    cap = capsys.readouterr()
+    lines = cap.out.splitlines()
+    assert len(lines) == 2
+    assert [json.loads(line)['Name'] for line in lines] == ['foo', 'bar']
+
+
+def test_multiple_PATHs_in_verify_mode(capsys, tmp_path, create_torrent):
+    with create_torrent() as torrent_file:
+        with patch('sys.exit') as mock_exit:
+            run(['-i', torrent_file, 'foo', 'bar'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: Multiple torrents can only be created, displayed or edited\n'
+
+
+def _make_torrents(tmp_path, *names):
+    torrent_files = []
+    for path in _make_content(tmp_path, *names):
+        torrent_file = tmp_path / f'{path.name}.torrent'
+        t = torf.Torrent(path=path)
+        t.generate()
+        t.write(torrent_file)
+        torrent_files.append(torrent_file)
+    return torrent_files
+
+
+def test_multiple_inputs(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar', 'baz')
+    run([arg for tf in torrent_files for arg in ('-i', str(tf))])
+    cap = capsys.readouterr()
+    assert [line.split('\t')[1] for line in cap.out.splitlines() if line.startswith('Name\t')] == \
+        ['foo', 'bar', 'baz']
+    assert [line.split('\t')[1] for line in cap.out.splitlines() if line.startswith('Torrent\t')] == \
+        [str(tf) for tf in torrent_files]
+
+
+def test_glob_input(capsys, tmp_path):
+    _make_torrents(tmp_path, 'foo', 'bar')
+    run(['-i', str(tmp_path / '*.torrent'), '--json'])
+    cap = capsys.readouterr()
+    assert sorted(json.loads(line)['Name'] for line in cap.out.splitlines()) == ['bar', 'foo']
+
+
+def test_nonexisting_input_that_looks_like_glob(capsys, tmp_path):
+    with patch('sys.exit') as mock_exit:
+        run(['-i', '[x]nothere.torrent'])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: [x]nothere.torrent: No such file or directory\n'
+
+
+def test_glob_input_without_matches(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo')
+    pattern = str(tmp_path / '*.nothing')
+    with patch('sys.exit') as mock_exit:
+        run(['-i', str(torrent_files[0]), '-i', pattern])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    cap = capsys.readouterr()
+    assert 'Name\tfoo\n' in cap.out
+    assert cap.err == f'{_vars.__appname__}: {pattern}: No such file or directory\n'
+
+
+def test_directory_input_without_torrents(capsys, tmp_path):
+    with patch('sys.exit') as mock_exit:
+        run(['-i', str(tmp_path)])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: {tmp_path}: No torrent files found\n'
+
+
+def test_magnet_errors_are_reported_with_their_torrent(capsys, monkeypatch):
+    foo = 'magnet:?xt=urn:btih:e167b1fbb42ea72f051f4f50432703308efb8fd1&dn=foo&xl=1000'
+    bar = 'magnet:?xt=urn:btih:e167b1fbb42ea72f051f4f50432703308efb8fd2&dn=bar&xl=1000'
+
+    def get_info(self, callback=None, **kwargs):
+        if self.dn == 'foo':
+            # Give the other thread time to report its error
+            time.sleep(0.2)
+        else:
+            callback(torf.ConnectionError('http://bar/bar.torrent', 'Timed out'))
+        return False
+
+    monkeypatch.setattr(torf.Magnet, 'get_info', get_info)
+    with patch('sys.exit'):
+        run(['-i', foo, '-i', bar, '--json', '--threads', '2'])
+    objects = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [obj['Name'] for obj in objects] == ['foo', 'bar']
+    assert 'Error' not in objects[0]
+    assert objects[1]['Error'] == ['http://bar/bar.torrent: Timed out']
+
+
+def test_in_from_option(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar', 'baz')
+    listfile = tmp_path / 'list'
+    listfile.write_text(''.join(f'{tf}\n' for tf in reversed(torrent_files)))
+    run(['--in-from', str(listfile), '--json', '--threads', '2'])
+    cap = capsys.readouterr()
+    objects = [json.loads(line) for line in cap.out.splitlines()]
+    assert [obj['Name'] for obj in objects] == ['baz', 'bar', 'foo']
+    assert [obj['Torrent'] for obj in objects] == [str(tf) for tf in reversed(torrent_files)]
+
+
+def test_in_from_option_with_nonexisting_file(capsys, tmp_path):
+    with patch('sys.exit') as mock_exit:
+        run(['--in-from', 'nonexisting'])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: nonexisting: No such file or directory\n'
+
+
+def test_unreadable_input_does_not_stop_other_inputs(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar')
+    with patch('sys.exit') as mock_exit:
+        run(['-i', str(torrent_files[0]), '-i', 'nonexisting.torrent', '-i', str(torrent_files[1]), '--json'])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    cap = capsys.readouterr()
+    objects = [json.loads(line) for line in cap.out.splitlines()]
+    assert objects[0]['Name'] == 'foo'
+    assert objects[1] == {'Error': ['nonexisting.torrent: No such file or directory']}
+    assert objects[2]['Name'] == 'bar'
+    assert objects[3] == {'Error': ['1 of 3 jobs failed']}
+    assert len(objects) == 4
+
+
+def test_verify_from_option(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar', 'baz')
+    (tmp_path / 'bar' / 'file.txt').write_text('data of baR')
+    manifest = tmp_path / 'manifest'
+    manifest.write_text(
+        '# Comment\n'
+        f'{torrent_files[0]}\t{tmp_path / "foo"}\n'
+        '\n'
+        f'{torrent_files[1]}\t{tmp_path / "bar"}\n'
+        f'{torrent_files[2]}\t{tmp_path}/\n'
+    )
+    with patch('sys.exit') as mock_exit:
+        run(['--verify-from', str(manifest), '--json', '--device-jobs', '2'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    cap = capsys.readouterr()
+    objects = [json.loads(line) for line in cap.out.splitlines()]
+    assert [obj['Torrent'] for obj in objects[:3]] == [str(tf) for tf in torrent_files]
+    assert [obj['Verified'] for obj in objects[:3]] == ['yes', 'no', 'yes']
+    assert objects[1]['Error'] == [
+        'Corruption in piece 1',
+        f'{tmp_path / "bar"} does not satisfy {torrent_files[1]}',
+    ]
+    assert objects[3] == {'Error': ['1 of 3 jobs failed']}
+    assert len(objects) == 4
+
+
+@pytest.mark.parametrize('args', (('--resume',), ('--quick',), ('--only', 'foo'), ('--only-regex', 'foo')))
+def test_verify_from_option_with_unsupported_option(capsys, tmp_path, args):
+    torrent_files = _make_torrents(tmp_path, 'foo')
+    manifest = tmp_path / 'manifest'
+    manifest.write_text(f'{torrent_files[0]}\t{tmp_path / "foo"}\n')
+    with patch('sys.exit') as mock_exit:
+        run(['--verify-from', str(manifest), *args])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: {args[0]} cannot be combined with --verify-from\n'
+    assert cap.out == ''
+
+
+def test_verify_from_option_with_invalid_line(capsys, tmp_path):
+    manifest = tmp_path / 'manifest'
+    manifest.write_text('foo.torrent\tpath/to/foo\nbar.torrent\n')
+    with patch('sys.exit') as mock_exit:
+        run(['--verify-from', str(manifest)])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: {manifest}:2: Expected TORRENT<TAB>PATH: bar.torrent\n'
+
+
+def test_verify_from_option_with_unreadable_torrent(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo')
+    manifest = tmp_path / 'manifest'
+    manifest.write_text(f'nonexisting.torrent\t{tmp_path / "foo"}\n'
+                        f'{torrent_files[0]}\t{tmp_path / "foo"}\n')
+    with patch('sys.exit') as mock_exit:
+        run(['--verify-from', str(manifest)])
+    mock_exit.assert_called_once_with(err.Code.READ)
+    cap = capsys.readouterr()
+    assert cap.err == (f'{_vars.__appname__}: nonexisting.torrent: No such file or directory\n'
+                       f'{_vars.__appname__}: 1 of 2 jobs failed\n')
+    assert 'Verified\tyes\n' in cap.out
+
+
+def test_bulk_edit_inplace(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar')
+    orig_infohashes = [torf.Torrent.read(tf).infohash for tf in torrent_files]
+    run(['-i', str(tmp_path), '--inplace', '--tracker', 'http://localhost/announce', '--json'])
+    for tf, orig_infohash in zip(torrent_files, orig_infohashes):
+        t = torf.Torrent.read(tf)
+        assert t.trackers == [['http://localhost/announce']]
+        assert t.infohash == orig_infohash
+    cap = capsys.readouterr()
+    objects = sorted((json.loads(line) for line in cap.out.splitlines()), key=lambda obj: obj['Name'])
+    assert [obj['Changed'] for obj in objects] == ['yes', 'yes']
+    assert [obj['Torrent'] for obj in objects] == [str(tf) for tf in reversed(torrent_files)]
+    assert [obj['Info Hash'] for obj in objects] == list(reversed(orig_infohashes))
+
+
+def test_inplace_without_input(capsys, tmp_path):
+    paths = _make_content(tmp_path, 'foo')
+    with patch('torfcli._main._hash_pieces') as mock_hash_pieces, patch('sys.exit') as mock_exit:
+        run([str(paths[0]), '--inplace'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert mock_hash_pieces.call_count == 0
+    assert capsys.readouterr().err == f'{_vars.__appname__}: --inplace requires --in or --in-from\n'
+
+
+def test_bulk_edit_keeps_file_mode(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar')
+    os.chmod(torrent_files[0], 0o644)
+    os.chmod(torrent_files[1], 0o640)
+    run(['-i', str(torrent_files[0]), '-i', str(torrent_files[1]), '--inplace', '--source', 'ASDF'])
+    assert torf.Torrent.read(torrent_files[0]).source == 'ASDF'
+    assert os.stat(torrent_files[0]).st_mode & 0o777 == 0o644
+    assert os.stat(torrent_files[1]).st_mode & 0o777 == 0o640
+
+
+def test_bulk_edit_to_out_directory_uses_umask(capsys, tmp_path, monkeypatch):
+    from torfcli import _utils
+    monkeypatch.setattr(_utils, '_UMASK', 0o027)
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar')
+    outdir = tmp_path / 'edited'
+    outdir.mkdir()
+    run(['-i', str(torrent_files[0]), '-i', str(torrent_files[1]), '--source', 'ASDF', '--out', str(outdir)])
+    assert os.stat(outdir / 'foo.torrent').st_mode & 0o777 == 0o640
+    assert os.stat(outdir / 'bar.torrent').st_mode & 0o777 == 0o640
+
+
+def test_bulk_edit_does_not_rewrite_unchanged_torrents(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar')
+    t = torf.Torrent.read(torrent_files[0])
+    t.trackers = ['http://localhost/announce']
+    t.write(torrent_files[0], overwrite=True)
+    mtimes = [os.stat(tf).st_mtime_ns for tf in torrent_files]
+    with patch('torfcli._utils.write_file_atomic') as mock_write:
+        run(['-i', str(torrent_files[0]), '-i', str(torrent_files[1]),
+             '--inplace', '--tracker', 'http://localhost/announce', '--notracker'])
+    assert [call[0][0] for call in mock_write.call_args_list] == [str(torrent_files[1])]
+    assert [os.stat(tf).st_mtime_ns for tf in torrent_files] == mtimes
+    cap = capsys.readouterr()
+    assert cap.out.count('Changed\tno\n') == 1
+    assert cap.out.count('Changed\tyes\n') == 1
+
+
+def test_bulk_edit_to_out_directory(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo', 'bar')
+    outdir = tmp_path / 'edited'
+    outdir.mkdir()
+    run(['-i', str(tmp_path / '*.torrent'), '--source', 'ASDF', '--out', str(outdir)])
+    assert sorted(os.listdir(outdir)) == ['bar.torrent', 'foo.torrent']
+    for tf in torrent_files:
+        assert torf.Torrent.read(tf).source is None
+        assert torf.Torrent.read(outdir / tf.name).source == 'ASDF'
+
+
+def test_bulk_edit_with_existing_output_file(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo')
+    outdir = tmp_path / 'edited'
+    outdir.mkdir()
+    (outdir / 'foo.torrent').write_text('existing')
+    with patch('sys.exit') as mock_exit:
+        run(['-i', str(torrent_files[0]), '-i', str(torrent_files[0]), '--source', 'ASDF', '--out', str(outdir)])
+    mock_exit.assert_called_once_with(err.Code.WRITE)
+    assert (outdir / 'foo.torrent').read_text() == 'existing'
+
+
+@pytest.mark.parametrize('yes', ((), ('--yes',)))
+def test_bulk_edit_with_same_output_file_twice(capsys, tmp_path, yes):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    torrent_files = _make_torrents(tmp_path / 'a', 'foo') + _make_torrents(tmp_path / 'b', 'foo')
+    outdir = tmp_path / 'edited'
+    outdir.mkdir()
+    with patch('sys.exit') as mock_exit:
+        run(['-i', str(torrent_files[0]), '-i', str(torrent_files[1]), '--source', 'ASDF',
+             '--out', str(outdir), *yes])
+    mock_exit.assert_called_once_with(err.Code.WRITE)
+    cap = capsys.readouterr()
+    assert f'{outdir / "foo.torrent"}: File exists\n' in cap.err
+    assert os.listdir(outdir) == ['foo.torrent']
+
+
+def test_bulk_edit_inplace_with_magnet(capsys, tmp_path):
+    magnet = 'magnet:?xt=urn:btih:e167b1fbb42ea72f051f4f50432703308efb8fd1&dn=My+Torrent'
+    with patch('sys.exit') as mock_exit:
+        run(['-i', magnet, '--inplace', '--comment', 'foo', '--notorrent'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: {magnet}: --inplace requires a torrent file as INPUT\n'
+
+
+def test_bulk_edit_magnet_with_existing_output_file(capsys, tmp_path):
+    torrent_files = _make_torrents(tmp_path, 'foo')
+    magnet = 'magnet:?xt=urn:btih:e167b1fbb42ea72f051f4f50432703308efb8fd1&dn=My+Torrent'
+    outdir = tmp_path / 'edited'
+    outdir.mkdir()
+    (outdir / 'My Torrent.torrent').write_text('existing')
+    run(['-i', str(torrent_files[0]), '-i', magnet, '--source', 'ASDF',
+         '--out', str(outdir), '--yes', '--novalidate'])
+    assert torf.Torrent.read(outdir / 'foo.torrent').source == 'ASDF'
+    assert torf.Torrent.read(outdir / 'My Torrent.torrent', validate=False).source == 'ASDF'
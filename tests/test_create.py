@@ -499,6 +499,52 @@ def test_max_piece_size_is_no_power_of_two(capsys, mock_content):
         assert cap.err == f'{_vars.__appname__}: Piece size must be divisible by 16 KiB: {exp_invalid_piece_size}\n'
 
 
+def test_piece_sizes_option_with_one_piece_size(capsys, mock_content):
+    run([str(mock_content), '--piece-sizes', '0.25'])
+    t = torf.Torrent.read('My Torrent.torrent')
+    assert t.piece_size == 262144
+
+def test_piece_sizes_option_creates_one_torrent_per_piece_size(capsys, mock_content, expected_hashes):
+    (mock_content / 'large file').write_bytes(os.urandom(1500000))
+    generate = torf.Torrent.generate
+    with patch.object(torf.Torrent, 'generate', autospec=True, side_effect=generate) as mock_generate:
+        run([str(mock_content), '--piece-sizes', '0.125,0.5,0.375', '--threads', '2'])
+    assert mock_generate.call_count == 0
+
+    for piece_size, suffix in ((131072, '128 KiB'), (524288, '512 KiB'), (393216, '384 KiB')):
+        t = torf.Torrent.read(f'My Torrent.{suffix.replace(" ", "")}.torrent')
+        assert t.piece_size == piece_size
+        assert t.hashes == expected_hashes(mock_content, piece_size)
+
+    # Progress is only reported for the shared read pass
+    cap = capsys.readouterr()
+    assert cap.out.rindex('Progress\t') < cap.out.index('Torrent\tMy Torrent.128KiB.torrent\n')
+    assert cap.out.count('Info Hash\t') == 3
+
+def test_piece_sizes_option_with_out_directory(capsys, mock_content, tmp_path):
+    outdir = tmp_path / 'torrents'
+    outdir.mkdir()
+    run([str(mock_content), '--piece-sizes', '0.25,1', '--out', str(outdir)])
+    assert sorted(os.listdir(outdir)) == ['My Torrent.1MiB.torrent', 'My Torrent.256KiB.torrent']
+    assert torf.Torrent.read(outdir / 'My Torrent.256KiB.torrent').piece_size == 262144
+    assert torf.Torrent.read(outdir / 'My Torrent.1MiB.torrent').piece_size == 1048576
+
+def test_piece_sizes_option_with_out_file(capsys, mock_content):
+    with patch('sys.exit') as mock_exit:
+        run([str(mock_content), '--piece-sizes', '0.25,1', '--out', 'out.torrent'])
+    mock_exit.assert_called_once_with(err.Code.WRITE)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: out.torrent: Not a directory\n'
+    assert not os.path.exists('out.torrent')
+
+def test_piece_sizes_option_with_invalid_piece_size(capsys, mock_content):
+    with patch('sys.exit') as mock_exit:
+        run([str(mock_content), '--piece-sizes', '1,foo'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    cap = capsys.readouterr()
+    assert cap.err == f'{_vars.__appname__}: foo: Invalid piece size\n'
+
+
 def test_default_date(capsys, mock_content):
     content_path = str(mock_content)
     exp_torrent_filename = os.path.basename(content_path) + '.torrent'
@@ -332,6 +332,48 @@ def test_edit_path_with_exclude_regex_option(create_torrent, tmp_path, assert_to
         assert new.size == len('image data')
 
 
+def _make_big_content(tmp_path):
+    content = tmp_path / 'big content'
+    content.mkdir()
+    (content / 'a').write_bytes(os.urandom(800000))
+    (content / 'b').write_bytes(os.urandom(98760))
+    run([str(content), '-o', str(tmp_path / 'orig.torrent')])
+    return content, torf.Torrent.read(str(tmp_path / 'orig.torrent'))
+
+
+def test_edit_path_rehashes_only_changed_pieces(capsys, tmp_path, expected_hashes):
+    content, orig = _make_big_content(tmp_path)
+    (content / 'c').write_bytes(b'small file')
+    capsys.readouterr()
+    run(['-i', str(tmp_path / 'orig.torrent'), str(content), '-o', 'new.torrent', '--threads', '2'])
+    new = torf.Torrent.read('new.torrent')
+    assert new.piece_size == orig.piece_size
+    assert new.hashes == expected_hashes(content, orig.piece_size)
+    unchanged = orig.size // orig.piece_size
+    assert f'Unchanged Pieces\t{unchanged} of {new.pieces}\n' in capsys.readouterr().out
+
+
+def test_edit_path_rehashes_pieces_of_resized_file(capsys, tmp_path, expected_hashes):
+    content, orig = _make_big_content(tmp_path)
+    (content / 'b').write_bytes(os.urandom(98761))
+    capsys.readouterr()
+    run(['-i', str(tmp_path / 'orig.torrent'), str(content), '-o', 'new.torrent'])
+    new = torf.Torrent.read('new.torrent')
+    assert new.hashes == expected_hashes(content, orig.piece_size)
+    unchanged = 800000 // orig.piece_size
+    assert f'Unchanged Pieces\t{unchanged} of {new.pieces}\n' in capsys.readouterr().out
+
+
+def test_edit_path_with_noreuse_rehashes_everything(capsys, tmp_path, expected_hashes):
+    content, orig = _make_big_content(tmp_path)
+    (content / 'c').write_bytes(b'small file')
+    capsys.readouterr()
+    run(['-i', str(tmp_path / 'orig.torrent'), str(content), '-o', 'new.torrent', '--noreuse'])
+    new = torf.Torrent.read('new.torrent')
+    assert new.hashes == expected_hashes(content, new.piece_size)
+    assert 'Unchanged Pieces' not in capsys.readouterr().out
+
+
 def test_edit_name(create_torrent, tmp_path, assert_torrents_equal):
     outfile = str(tmp_path / 'out.torrent')
     with create_torrent() as infile:
@@ -0,0 +1,852 @@
+import errno
+import os
+import re
+import signal
+import time
+from unittest.mock import patch
+
+import pytest
+import torf
+
+from torfcli import _config as config
+from torfcli import _errors as err
+from torfcli import _hash, _utils, _vars, run
+
+
+def _create(path, *args):
+    run([str(path), '-y', *args])
+    return torf.Torrent.read(f'{os.path.basename(path)}.torrent')
+
+
+@pytest.mark.parametrize('piece_size', (16384, 32768, 1048576))
+def test_layout_segments(piece_size):
+    layout = _hash.Layout(['a', 'b', 'c', 'd'], [100000, 12345, 0, 70001], piece_size)
+    segments = [layout.get_segments(i) for i in range(layout.pieces)]
+    assert all(sum(length for _, _, length in s) == piece_size for s in segments[:-1])
+    assert sum(length for s in segments for _, _, length in s) == layout.size
+    assert not any(file_index == 2 for s in segments for file_index, _, _ in s)
+
+
+def test_generate_without_cache(content, expected_hashes):
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 131072
+    assert _hash.Hasher(threads=2).generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 131072)
+
+
+def test_generate_cancelled_by_callback(content):
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 131072
+    callback = lambda torrent, filepath, pieces_done, pieces_total: pieces_done >= 3 or None  # noqa: E731
+    assert _hash.Hasher().generate(torrent, callback=callback) is False
+
+
+def test_hash_cache_hits(capsys, content, tmp_path, expected_hashes):
+    cache_file = str(tmp_path / 'cache' / 'pieces.db')
+    t = _create(content, '--hash-cache', '--hash-cache-file', cache_file)
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    cap = capsys.readouterr()
+    assert f'Cache\t0 hits, {len(t.hashes)} misses\n' in cap.out
+
+    t = _create(content, '--hash-cache', '--hash-cache-file', cache_file)
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    cap = capsys.readouterr()
+    assert f'Cache\t{len(t.hashes)} hits, 0 misses\n' in cap.out
+
+
+def test_hash_cache_option_does_not_take_PATH(capsys, content, tmp_path, expected_hashes):
+    cache_file = tmp_path / 'pieces.db'
+    run(['--hash-cache-file', str(cache_file), '--hash-cache', str(content)])
+    t = torf.Torrent.read('content.torrent')
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    assert cache_file.exists()
+
+
+def test_hash_cache_ignores_modified_file(capsys, content, tmp_path, expected_hashes):
+    cache_file = str(tmp_path / 'pieces.db')
+    _create(content, '--hash-cache', '--hash-cache-file', cache_file)
+    capsys.readouterr()
+
+    # Same size, different content and mtime
+    (content / 'd').write_bytes(os.urandom(560008))
+    os.utime(content / 'd', ns=(0, 0))
+    t = _create(content, '--hash-cache', '--hash-cache-file', cache_file)
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    cap = capsys.readouterr()
+    misses = len(t.hashes) - (800000 + 98760) // t.piece_size
+    assert f'Cache\t{len(t.hashes) - misses} hits, {misses} misses\n' in cap.out
+
+
+def test_nohash_cache(capsys, content, tmp_path):
+    cache_file = tmp_path / 'pieces.db'
+    _create(content, '--hash-cache', '--hash-cache-file', str(cache_file), '--nohash-cache')
+    assert not cache_file.exists()
+    assert 'Cache\t' not in capsys.readouterr().out
+
+
+def test_hash_cache_is_size_bounded(content, tmp_path):
+    cache = _hash.PieceCache(str(tmp_path / 'pieces.db'), max_size=_hash.PieceCache.ENTRY_SIZE * 5)
+    for i in range(10):
+        cache.put([(bytes([i]) * 20, bytes([i]) * 20)])
+    keys = [bytes([i]) * 20 for i in range(10)]
+    assert cache.get(keys) == {key: key for key in keys[5:]}
+
+
+def test_invalid_hash_cache_size(capsys, content):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--hash-cache-size', '0'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: Invalid hash cache size: 0\n'
+
+
+def test_unusable_hash_cache_file(capsys, content, tmp_path):
+    cache_file = tmp_path / 'pieces.db'
+    cache_file.write_text('this is not a database')
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--hash-cache', '--hash-cache-file', str(cache_file)])
+    mock_exit.assert_called_once_with(err.Code.GENERIC)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: {cache_file}: file is not a database\n'
+
+
+@pytest.fixture
+def interrupt_after(monkeypatch):
+    # Interrupt hashing when `pieces` pieces are done; the piece that is being
+    # reported is already in the checkpoint
+    monkeypatch.setattr(_hash, 'CHECKPOINT_INTERVAL', 0)
+
+    def interrupt_after(pieces, signum=None, progress_cls=_hash._Progress):
+        def advance(self, *args, **kwargs):
+            if self._pieces_done >= pieces:
+                if signum:
+                    os.kill(os.getpid(), signum)
+                raise KeyboardInterrupt()
+            return orig_advance(self, *args, **kwargs)
+
+        orig_advance = progress_cls.advance
+        monkeypatch.setattr(progress_cls, 'advance', advance)
+        return lambda: monkeypatch.setattr(progress_cls, 'advance', orig_advance)
+
+    return interrupt_after
+
+
+def test_resume_create(capsys, content, interrupt_after, expected_hashes):
+    uninterrupt = interrupt_after(3)
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--resume'])
+    mock_exit.assert_called_once_with(err.Code.ABORTED)
+    assert os.path.exists('content.torrent.checkpoint')
+    assert not os.path.exists('content.torrent')
+    capsys.readouterr()
+
+    uninterrupt()
+    run([str(content), '--resume'])
+    t = torf.Torrent.read('content.torrent')
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    assert f'Resumed Pieces\t4 of {t.pieces}\n' in capsys.readouterr().out
+    assert not os.path.exists('content.torrent.checkpoint')
+
+
+def test_resume_create_after_SIGTERM(capsys, content, interrupt_after, expected_hashes):
+    uninterrupt = interrupt_after(2, signum=signal.SIGTERM)
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--resume'])
+    mock_exit.assert_called_once_with(err.Code.ABORTED)
+    assert os.path.exists('content.torrent.checkpoint')
+    capsys.readouterr()
+
+    uninterrupt()
+    run([str(content), '--resume'])
+    t = torf.Torrent.read('content.torrent')
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    assert f'Resumed Pieces\t3 of {t.pieces}\n' in capsys.readouterr().out
+
+
+def test_resume_create_ignores_pieces_of_modified_files(capsys, content, interrupt_after, expected_hashes):
+    uninterrupt = interrupt_after(60)
+    with patch('sys.exit'):
+        run([str(content), '--resume'])
+    capsys.readouterr()
+
+    (content / 'a').write_bytes(os.urandom(800000))
+    os.utime(content / 'a', ns=(0, 0))
+    uninterrupt()
+    run([str(content), '--resume'])
+    t = torf.Torrent.read('content.torrent')
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    pieces_of_a = 800000 // t.piece_size + 1
+    assert f'Resumed Pieces\t{61 - pieces_of_a} of {t.pieces}\n' in capsys.readouterr().out
+
+
+def test_resume_create_in_physical_order(capsys, content, interrupt_after, monkeypatch, expected_hashes):
+    monkeypatch.setattr(_hash, 'get_read_order', lambda layout, piece_indexes: (
+        sorted(piece_indexes, reverse=True), 'physical',
+    ))
+    uninterrupt = interrupt_after(3)
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--resume', '--physical-order'])
+    mock_exit.assert_called_once_with(err.Code.ABORTED)
+    capsys.readouterr()
+
+    uninterrupt()
+    run([str(content), '--resume', '--physical-order'])
+    t = torf.Torrent.read('content.torrent')
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    assert f'Resumed Pieces\t4 of {t.pieces}\n' in capsys.readouterr().out
+
+
+def test_checkpoint_keeps_resumed_hashes_when_restarted(content, tmp_path):
+    layout = _hash.Layout([str(content / name) for name in 'abd'], [800000, 98760, 560008], 16384)
+    identities = layout.get_identities()
+    hashes = {0: b'a' * 20, 5: b'b' * 20, 89: b'c' * 20}
+    checkpoint = _hash.Checkpoint(str(tmp_path / 'checkpoint'))
+    checkpoint.start(layout, identities, hashes)
+    # Nothing is lost if we are killed right away
+    assert _hash.Checkpoint(str(tmp_path / 'checkpoint')).load(layout, identities) == hashes
+
+    checkpoint.add(3, b'd' * 20)
+    checkpoint.add(1, None)
+    checkpoint.close()
+    assert _hash.Checkpoint(str(tmp_path / 'checkpoint')).load(layout, identities) == {**hashes, 3: b'd' * 20}
+
+
+def test_resume_verify(capsys, content, interrupt_after):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    # Corrupt the last piece
+    with open(content / 'd', 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\x00' if byte == b'\xff' else b'\xff')
+    capsys.readouterr()
+
+    uninterrupt = interrupt_after(5, progress_cls=_hash._VerifyProgress)
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--resume'])
+    mock_exit.assert_called_once_with(err.Code.ABORTED)
+    assert os.path.exists('content.torrent.checkpoint')
+    capsys.readouterr()
+
+    uninterrupt()
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--resume'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    cap = capsys.readouterr()
+    assert f'Resumed Pieces\t6 of {t.pieces}\n' in cap.out
+    assert f'Corruption in piece {t.pieces}' in cap.out
+    assert not os.path.exists('content.torrent.checkpoint')
+
+
+def test_resume_verify_requires_torrent_file(capsys, content):
+    magnet = 'magnet:?xt=urn:btih:e167b1fbb42ea72f051f4f50432703308efb8fd1'
+    with patch('sys.exit') as mock_exit:
+        run(['-i', magnet, str(content), '--resume'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: {magnet}: --resume requires a torrent file as INPUT\n'
+
+
+@pytest.mark.parametrize('processes', (1, 3))
+def test_generate_in_processes(content, processes, expected_hashes):
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 131072
+    assert _hash.Hasher(processes=processes).generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 131072)
+
+
+def test_generate_in_processes_with_small_ring_buffer(content, monkeypatch, expected_hashes):
+    monkeypatch.setattr(_hash, 'RING_BUFFER_SIZE', 0)
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    assert _hash.Hasher(processes=4).generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+
+
+def test_verify_in_processes(capsys, content):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    with open(content / 'a', 'r+b') as f:
+        f.write(b'\x00' * 10)
+    capsys.readouterr()
+
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--processes', '2'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    cap = capsys.readouterr()
+    assert f'Corruption in piece 1 in {content / "a"}\n' in cap.out
+    assert f'Corruption in piece {t.pieces}' not in cap.out
+
+
+def test_invalid_number_of_processes(capsys, content):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--processes', '-1'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: Invalid number of processes: -1\n'
+
+
+@pytest.fixture
+def two_devices(monkeypatch):
+    # Pretend file "d" is on another device
+    def get_device(path):
+        return os.makedev(8, 16) if os.path.basename(path) == 'd' else os.makedev(8, 0)
+    monkeypatch.setattr(_utils, 'get_device', get_device)
+
+
+@pytest.mark.parametrize('processes', (0, 2))
+def test_generate_from_parallel_devices(content, two_devices, processes, expected_hashes):
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 131072
+    hasher = _hash.Hasher(processes=processes, parallel_devices=True)
+    assert hasher.generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 131072)
+    assert set(hasher.device_throughput) == {'8:0', '8:16'}
+    assert [line.split(':')[:2] for line in hasher.stats['Throughput']] == [['8', '0'], ['8', '16']]
+
+
+def test_verify_from_parallel_devices(capsys, content, two_devices):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    (content / 'b').unlink()
+    with open(content / 'd', 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\x00' if byte == b'\xff' else b'\xff')
+    capsys.readouterr()
+
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--parallel-devices'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    cap = capsys.readouterr()
+    assert f'{content / "b"}: No such file or directory\n' in cap.out
+    assert f'Corruption in piece {t.pieces} in {content / "d"}\n' in cap.out
+    assert 'Throughput\t8:0: ' in cap.out
+    assert '\t8:16: ' in cap.out
+
+
+def test_read_order_from_extents(monkeypatch):
+    # File "a" is stored after file "b" and its second half before its first half
+    extents = {
+        'a': [(0, 50000, 32768), (32768, 10000, 32768)],
+        'b': [(0, 0, 16384)],
+    }
+    monkeypatch.setattr(_hash, '_get_extents', lambda filepath: extents[filepath])
+    layout = _hash.Layout(['a', 'b'], [65536, 16384], 16384)
+    assert _hash.get_read_order(layout, range(layout.pieces)) == ([4, 2, 3, 0, 1], 'physical')
+
+
+def test_read_order_falls_back_to_inodes(content, monkeypatch):
+    def _get_extents(filepath):
+        raise OSError(95, 'Operation not supported')
+    monkeypatch.setattr(_hash, '_get_extents', _get_extents)
+    filepaths = [str(content / name) for name in ('a', 'b', 'c', 'd')]
+    layout = _hash.Layout(filepaths, [800000, 98760, 0, 560008], 16384)
+    order, method = _hash.get_read_order(layout, range(layout.pieces))
+    assert method == 'inode'
+    inodes = [os.stat(filepath).st_ino for filepath in filepaths]
+    assert [inodes[layout.get_segments(i)[0][0]] for i in order] == sorted(
+        inodes[layout.get_segments(i)[0][0]] for i in range(layout.pieces)
+    )
+
+
+def test_generate_in_physical_order(content, monkeypatch, expected_hashes):
+    monkeypatch.setattr(_hash, 'get_read_order', lambda layout, piece_indexes: (
+        sorted(piece_indexes, reverse=True), 'physical',
+    ))
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 131072
+    hasher = _hash.Hasher(physical_order=True)
+    assert hasher.generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 131072)
+    assert hasher.stats['Read Order'] == 'physical'
+
+
+def test_verify_in_physical_order(capsys, content):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    with open(content / 'a', 'r+b') as f:
+        f.write(b'\x00' * 10)
+    capsys.readouterr()
+
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--physical-order'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    cap = capsys.readouterr()
+    assert f'Corruption in piece 1 in {content / "a"}\n' in cap.out
+    assert f'Corruption in piece {t.pieces}' not in cap.out
+    assert 'Read Order\t' in cap.out
+
+
+@pytest.mark.parametrize('processes', (0, 2))
+@pytest.mark.parametrize('cache_policy', config.CACHE_POLICIES)
+def test_generate_with_cache_policy(content, cache_policy, processes, expected_hashes):
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    assert _hash.Hasher(cache_policy=cache_policy, processes=processes).generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+
+
+def test_direct_reads_fall_back_to_dropping_cache(content, monkeypatch, expected_hashes):
+    orig_open = os.open
+
+    def open_without_direct(path, flags, *args, **kwargs):
+        if flags & os.O_DIRECT:
+            raise OSError(22, 'Invalid argument')
+        return orig_open(path, flags, *args, **kwargs)
+    monkeypatch.setattr(os, 'open', open_without_direct)
+
+    fadvise_calls = []
+    monkeypatch.setattr(_hash, '_fadvise', lambda fd, offset, length, advice: fadvise_calls.append(advice))
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    assert _hash.Hasher(cache_policy='direct').generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+    assert set(fadvise_calls) == {'POSIX_FADV_DONTNEED'}
+
+
+def test_verify_with_cache_policy(capsys, content):
+    run([str(content)])
+    (content / 'b').write_bytes(os.urandom(98760))
+    capsys.readouterr()
+
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--cache-policy', 'direct'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    assert f'Corruption in piece 50 in {content / "b"}\n' in capsys.readouterr().out
+
+
+def test_invalid_cache_policy(capsys, content):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--cache-policy', 'foo'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: Invalid cache policy: foo\n'
+
+
+@pytest.mark.parametrize('processes', (0, 2))
+@pytest.mark.parametrize('max_memory', (1, 65536, 1048576))
+def test_generate_with_prefetching(content, max_memory, processes, expected_hashes):
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    hasher = _hash.Hasher(max_memory=max_memory, processes=processes)
+    assert hasher.generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+    depth_max = int(hasher.stats['Prefetch Queue'].split()[-3])
+    assert depth_max <= max(1, max_memory // 16384)
+    assert hasher.stats['Prefetch Stalls'].endswith(f' of {torrent.pieces} pieces')
+
+
+def test_prefetching_reports_read_errors(content):
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    (content / 'd').unlink()
+    with pytest.raises(torf.ReadError, match=rf'^{content / "d"}: No such file or directory$'):
+        _hash.Hasher(max_memory=1048576).generate(torrent)
+
+
+def test_verify_with_prefetching(capsys, content):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    capsys.readouterr()
+    run(['-i', 'content.torrent', str(content), '--max-memory', '0.5'])
+    cap = capsys.readouterr()
+    assert 'Prefetch Queue\t' in cap.out
+    assert 'Prefetch Stalls\t' in cap.out
+    assert f' of {t.pieces} pieces\n' in cap.out
+
+
+def test_invalid_max_memory(capsys, content):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--max-memory', '-1'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: Invalid maximum memory: -1\n'
+
+
+def _get_buffer_pool_stats(messages):
+    regex = re.compile(r'^Buffer pool: (\d+) buffers of (\d+) bytes allocated for (\d+) reads$')
+    return [tuple(int(n) for n in regex.match(msg).groups())
+            for msg in messages if msg.startswith('Buffer pool: ')]
+
+
+@pytest.mark.parametrize('max_memory', (0, 65536))
+def test_buffers_are_reused(caplog, content, max_memory, expected_hashes):
+    caplog.set_level('DEBUG', logger='torfcli._hash')
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    assert _hash.Hasher(threads=2, max_memory=max_memory).generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+    stats = _get_buffer_pool_stats(caplog.messages)
+    if max_memory:
+        # Prefetcher reads into its own buffers
+        allocations, size, reads = stats.pop(0)
+        assert (size, reads) == (16384, torrent.pieces)
+        assert allocations <= 65536 // 16384 + 1
+    [(allocations, size, reads)] = stats
+    assert (size, reads) == (16384, torrent.pieces)
+    assert allocations <= 2 * 2 + 1
+
+
+def test_buffers_are_reused_for_multiple_piece_sizes(caplog, content, expected_hashes):
+    caplog.set_level('DEBUG', logger='torfcli._hash')
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    sibling = torf.Torrent(content)
+    sibling.piece_size = 32768
+    assert _hash.Hasher().generate(torrent, siblings=(sibling,)) is True
+    assert sibling.hashes == expected_hashes(content, 32768)
+    assert _get_buffer_pool_stats(caplog.messages) == [(2, 16384, torrent.pieces)]
+
+
+@pytest.fixture
+def sparse_content(tmp_path):
+    base = tmp_path / 'sparse'
+    base.mkdir()
+    (base / 'a').write_bytes(os.urandom(50000))
+    with open(base / 'image', 'wb') as f:
+        f.truncate(8 * 1048576)
+        f.seek(4 * 1048576)
+        f.write(os.urandom(100000))
+        f.flush()
+        os.fsync(f.fileno())
+    if _hash._get_data_ranges(str(base / 'image')) in (None, [(0, 8 * 1048576)]):
+        pytest.skip('File system does not support holes')
+    return base
+
+
+def test_is_hole():
+    data_ranges = [(100, 200), (300, 400)]
+    assert _hash._is_hole(data_ranges, 0, 100)
+    assert not _hash._is_hole(data_ranges, 0, 101)
+    assert not _hash._is_hole(data_ranges, 150, 10)
+    assert not _hash._is_hole(data_ranges, 199, 10)
+    assert _hash._is_hole(data_ranges, 200, 100)
+    assert not _hash._is_hole(data_ranges, 250, 500)
+    assert _hash._is_hole(data_ranges, 400, 1000)
+    assert _hash._is_hole([], 0, 1000)
+    assert not _hash._is_hole(None, 0, 1000)
+
+
+def test_generate_sparse_file(sparse_content, monkeypatch, expected_hashes):
+    torrent = torf.Torrent(sparse_content)
+    torrent.piece_size = 65536
+    hasher = _hash.Hasher(sparse=True)
+    read_pieces = []
+    orig_read_piece_into = _hash._FileReader.read_piece_into
+    monkeypatch.setattr(_hash._FileReader, 'read_piece_into', lambda self, piece_index, buffer: (
+        read_pieces.append(piece_index) or orig_read_piece_into(self, piece_index, buffer)
+    ))
+    assert hasher.generate(torrent) is True
+    assert torrent.hashes == expected_hashes(sparse_content, 65536)
+    sparse_pieces = int(hasher.stats['Sparse Pieces'].split()[0])
+    assert sparse_pieces >= torrent.pieces - 4
+    assert len(read_pieces) == torrent.pieces - sparse_pieces
+
+
+def test_verify_sparse_file(capsys, sparse_content):
+    run([str(sparse_content)])
+    # Write data into a hole
+    with open(sparse_content / 'image', 'r+b') as f:
+        f.seek(7 * 1048576)
+        f.write(b'\x01')
+    capsys.readouterr()
+
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'sparse.torrent', str(sparse_content), '--sparse'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    cap = capsys.readouterr()
+    assert 'Sparse Pieces\t' in cap.out
+    assert 'Corruption in piece ' in cap.out
+
+
+@pytest.fixture
+def hardlinked_content(tmp_path):
+    def hardlinked_content(size_a, size_c):
+        base = tmp_path / 'linked'
+        base.mkdir()
+        (base / 'a').write_bytes(os.urandom(size_a))
+        os.link(base / 'a', base / 'b')
+        (base / 'c').write_bytes(os.urandom(size_c))
+        os.link(base / 'a', base / 'd')
+        return base
+    return hardlinked_content
+
+
+@pytest.mark.parametrize('processes', (0, 2))
+@pytest.mark.parametrize(
+    argnames='size_a, size_c',
+    argvalues=(
+        (98304, 32768),  # Piece-aligned links
+        (100000, 5000),  # Unaligned links
+    ),
+)
+def test_generate_with_hardlinks(hardlinked_content, size_a, size_c, processes, expected_hashes):
+    content = hardlinked_content(size_a, size_c)
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    hasher = _hash.Hasher(hardlinks=True, processes=processes)
+    assert hasher.generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+    assert hasher.stats['Hardlinks'] == f'3 linked files, {_utils.bytes2string(2 * size_a)} saved'
+
+
+@pytest.mark.parametrize('processes', (0, 2))
+@pytest.mark.parametrize('options', ({'max_memory': 1048576}, {'parallel_devices': True}), ids=str)
+@pytest.mark.parametrize(
+    argnames='size_a, size_c',
+    argvalues=(
+        (98304, 32768),  # Piece-aligned links
+        (100000, 5000),  # Unaligned links
+    ),
+)
+def test_generate_with_hardlinks_and_readers_that_read_ahead(hardlinked_content, two_devices,
+                                                             size_a, size_c, options, processes, expected_hashes):
+    content = hardlinked_content(size_a, size_c)
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    hasher = _hash.Hasher(hardlinks=True, processes=processes, **options)
+    assert hasher.generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+
+
+def test_unread_hardlink_aliases(hardlinked_content):
+    content = hardlinked_content(98304, 32768)
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    layout = _hash.Layout([str(fp) for fp in torrent.filepaths], [f.size for f in torrent.files], 16384)
+    hardlinks = _hash._Hardlinks(layout, max_size=0)
+    # Files are a, b, c and d; b and d are links to a with 6 pieces each
+    assert hardlinks.get_unread_aliases(range(layout.pieces)) == {*range(6, 12), *range(14, 20)}
+    # Aliases are read if their original isn't read or read later
+    assert hardlinks.get_unread_aliases(range(layout.pieces), skip=range(6)) == set()
+    assert hardlinks.get_unread_aliases(reversed(range(layout.pieces))) == set()
+
+
+def test_hardlink_cache_is_size_bounded(hardlinked_content, monkeypatch, expected_hashes):
+    monkeypatch.setattr(_hash, 'HARDLINK_CACHE_SIZE', 99999)
+    content = hardlinked_content(100000, 5000)
+    torrent = torf.Torrent(content)
+    torrent.piece_size = 16384
+    hasher = _hash.Hasher(hardlinks=True)
+    assert hasher.generate(torrent) is True
+    assert torrent.hashes == expected_hashes(content, 16384)
+    assert hasher.stats['Hardlinks'] == '3 linked files, 0 B saved'
+
+
+def test_verify_with_hardlinks(capsys, hardlinked_content):
+    content = hardlinked_content(100000, 5000)
+    run([str(content)])
+    capsys.readouterr()
+    run(['-i', 'linked.torrent', str(content), '--hardlinks'])
+    assert f'Hardlinks\t3 linked files, {_utils.bytes2string(200000)} saved\n' in capsys.readouterr().out
+
+
+def test_thread_tuner_finds_fastest_number_of_threads(monkeypatch):
+    now = 0
+    monkeypatch.setattr(_hash.time, 'monotonic', lambda: now)
+    tuner = _hash._ThreadTuner(maximum=16)
+    assert tuner.threads == 8
+    # Throughput peaks at 11 threads
+    seen = []
+    for _ in range(20):
+        seen.append(tuner.threads)
+        now += _hash.TUNE_INTERVAL
+        with tuner.run(length=1000 - (tuner.threads - 11) ** 2):
+            pass
+    assert seen[:4] == [8, 9, 10, 11]
+    assert set(seen[4:]) <= {10, 11, 12}
+    assert tuner.best == 11
+
+
+def test_thread_tuner_stays_within_bounds(monkeypatch):
+    now = 0
+    monkeypatch.setattr(_hash.time, 'monotonic', lambda: now)
+    tuner = _hash._ThreadTuner(maximum=2)
+    seen = []
+    for i in range(10):
+        seen.append(tuner.threads)
+        now += _hash.TUNE_INTERVAL
+        with tuner.run(length=1000 * i):
+            pass
+    assert set(seen) == {1, 2}
+
+
+def test_generate_with_auto_threads(capsys, content, expected_hashes):
+    t = _create(content, '--threads', 'auto')
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    assert 'Tuned Threads\t' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('threads', ('foo', '-1'))
+def test_invalid_number_of_threads(capsys, content, threads):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--threads', threads])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: Invalid number of threads: {threads}\n'
+
+
+def test_rate_limiter_does_not_split_reads(monkeypatch):
+    now = 0
+    delays = []
+    monkeypatch.setattr(_hash.time, 'monotonic', lambda: now)
+    monkeypatch.setattr(_hash.time, 'sleep', delays.append)
+    limiter = _hash._RateLimiter(rate=1000)
+    # One second worth of reading is allowed right away
+    limiter.consume(1000)
+    assert delays == []
+    # Large reads are allowed but the next read pays for them
+    limiter.consume(3000)
+    assert delays == []
+    limiter.consume(10)
+    assert delays == [3]
+    now += 3.5
+    limiter.consume(10)
+    assert delays == [3]
+
+
+def test_generate_with_max_read_rate(content, monkeypatch, expected_hashes):
+    consumed = []
+    consume = _hash._RateLimiter.consume
+
+    def mock_consume(self, length):
+        consumed.append(length)
+        consume(self, length)
+
+    monkeypatch.setattr(_hash._RateLimiter, 'consume', mock_consume)
+    t = _create(content, '--max-read-rate', '1000')
+    assert t.hashes == expected_hashes(content, t.piece_size)
+    assert sum(consumed) == t.size
+
+
+@pytest.mark.parametrize('option, value, msg', (
+    ('--max-read-rate', '-1', 'Invalid maximum read rate: -1'),
+    ('--ionice', 'foo', 'Invalid I/O priority: foo'),
+    ('--ionice', 'idle:8', 'Invalid I/O priority: idle:8'),
+    ('--ionice', 'idle:x', 'Invalid I/O priority: idle:x'),
+    ('--cpus', '1-x', 'Invalid CPU list: 1-x'),
+))
+def test_invalid_scheduling_options(capsys, content, option, value, msg):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), option, value])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: {msg}\n'
+
+
+def test_scheduling_options_are_applied(content):
+    with patch('torfcli._utils.set_scheduling') as mock_set_scheduling:
+        _create(content, '--nice', '5', '--ionice', 'best-effort:6', '--cpus', '0-1')
+    mock_set_scheduling.assert_called_once_with(nice=5, ionice=('best-effort', 6), cpus={0, 1})
+
+
+def test_set_scheduling(monkeypatch):
+    calls = []
+    monkeypatch.setattr(_utils.os, 'nice', lambda n: calls.append(('nice', n)))
+    monkeypatch.setattr(_utils, 'set_io_priority', lambda *args: calls.append(('ionice', *args)))
+    monkeypatch.setattr(_utils.os, 'sched_setaffinity', lambda pid, cpus: calls.append(('cpus', cpus)),
+                        raising=False)
+    _utils.set_scheduling()
+    assert calls == []
+    _utils.set_scheduling(nice=3, ionice=('idle', 0), cpus={1})
+    assert calls == [('nice', 3), ('ionice', 'idle', 0), ('cpus', {1})]
+
+
+@pytest.mark.parametrize('threads', ('1', '4', 'auto'))
+def test_verify_reports_errors_in_piece_order(capsys, content, monkeypatch, threads):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    for name in ('a', 'd'):
+        with open(content / name, 'r+b') as f:
+            f.seek(-10, os.SEEK_END)
+            f.write(b'\x00' * 10)
+    capsys.readouterr()
+
+    # Read last piece first
+    monkeypatch.setattr(_hash, 'get_read_order',
+                        lambda layout, piece_indexes: (sorted(piece_indexes, reverse=True), 'inode'))
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--physical-order', '--threads', threads])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    errors = re.findall(r'Corruption in piece (\d+)', capsys.readouterr().out)
+    assert errors == ['49', str(t.pieces)]
+
+
+def test_verify_calls_callback_in_piece_order(content, monkeypatch):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    monkeypatch.setattr(_hash, 'get_read_order',
+                        lambda layout, piece_indexes: (sorted(piece_indexes, reverse=True), 'inode'))
+    piece_indexes = []
+
+    def callback(torrent, filepath, pieces_done, pieces_total, piece_index, piece_hash, exception):
+        piece_indexes.append(piece_index)
+
+    hasher = _hash.Hasher(threads=4, physical_order=True)
+    assert hasher.verify(t, str(content), callback=callback) is True
+    assert piece_indexes == list(range(t.pieces))
+
+
+def test_iter_in_piece_order():
+    results = [(2, 'c'), (0, 'a'), (3, 'd'), (1, 'b')]
+    assert list(_hash._iter_in_piece_order(results, range(4))) == [(0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')]
+    results = [(7, 'c'), (2, 'a'), (5, 'b')]
+    assert list(_hash._iter_in_piece_order(results, [2, 5, 7])) == [(2, 'a'), (5, 'b'), (7, 'c')]
+
+
+def test_sample_includes_first_and_last_piece_of_each_file(content):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    sample = _hash.Sample(t, count=10, seed='foo')
+    # Files a, b and d; c is empty
+    boundaries = {0, 48, 54, t.pieces - 1}
+    assert boundaries.issubset(sample.piece_indexes)
+    assert len(sample.piece_indexes) == 10
+    assert sample.piece_indexes == sorted(sample.piece_indexes)
+    assert sample.piece_indexes == _hash.Sample(t, count=10, seed='foo').piece_indexes
+    assert sample.piece_indexes != _hash.Sample(t, count=10, seed='bar').piece_indexes
+
+
+def test_sample_confidence(content):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    assert _hash.Sample(t, count=t.pieces, seed='foo').get_max_corrupt_pieces() == 0
+    assert _hash.Sample(t, count=1000, seed='foo').get_max_corrupt_pieces() == 0
+    max_corrupt = [_hash.Sample(t, count=count, seed='foo').get_max_corrupt_pieces() for count in (10, 30, 60)]
+    assert max_corrupt == sorted(max_corrupt, reverse=True)
+    assert 0 < max_corrupt[-1] < max_corrupt[0] <= t.pieces
+
+
+def test_get_changed_pieces():
+    layout = _hash.Layout(filepaths=('a', 'b', 'c'), sizes=(10, 0, 15), piece_size=4)
+    old = [(1, 10, 100), (2, 0, 100), (3, 15, 100)]
+    assert _hash.get_changed_pieces(layout, old, old) == []
+    assert _hash.get_changed_pieces(layout, old, [(1, 10, 101), *old[1:]]) == [0, 1, 2]
+    assert _hash.get_changed_pieces(layout, old, [*old[:2], None]) == [2, 3, 4, 5, 6]
+    # Errors of empty files are reported at the piece at their offset
+    assert _hash.get_changed_pieces(layout, old, [old[0], (9, 0, 100), old[2]]) == [2]
+    assert _hash.get_changed_pieces(layout, [None, *old[1:]], old) == [0, 1, 2]
+    assert _hash.get_changed_pieces(layout, old[:2], old) == list(range(7))
+
+
+def test_verified_state(tmp_path):
+    state = _hash.VerifiedState(str(tmp_path / 'sub' / 'verified.db'))
+    assert state.get('abc', 'path') is None
+    state.put('abc', 'path', [(1, 2, 3, 4), None])
+    identities, verified_at = state.get('abc', 'path')
+    assert identities == [(2, 3, 4), None]
+    assert abs(verified_at - time.time()) < 10
+    assert state.get('abc', 'other/path') is None
+    assert state.get('def', 'path') is None
+
+
+def test_verify_in_processes_with_read_error(capsys, content, monkeypatch):
+    run([str(content)])
+    capsys.readouterr()
+    seek = _hash._FileReader._seek
+
+    def failing_seek(self, file_index, offset):
+        if self._layout.filepaths[file_index].endswith(os.sep + 'd'):
+            raise OSError(errno.EIO, 'Input/output error')
+        seek(self, file_index, offset)
+
+    monkeypatch.setattr(_hash._FileReader, '_seek', failing_seek)
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--processes', '2'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    assert f'{content / "d"}: Input/output error\n' in capsys.readouterr().out
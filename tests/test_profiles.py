@@ -1,7 +1,10 @@
 import datetime
+import os
 import textwrap
 from unittest.mock import patch
 
+import torf
+
 from torfcli import _errors as err
 from torfcli import _vars, run
 
@@ -132,3 +135,77 @@ def test_illegal_configfile_arguments(capsys, cfgfile, mock_content, mock_create
         cap = capsys.readouterr()
         assert cap.err == f'{_vars.__appname__}: {cfgfile}: Not allowed in config file: {arg}\n'
         assert mock_create_mode.call_args is None
+
+
+def test_each_profile_creates_one_torrent_per_profile(capsys, cfgfile, mock_content):
+    cfgfile.write_text(textwrap.dedent('''
+    [foo]
+    tracker = http://foo/announce
+    source = FOO
+
+    [bar]
+    tracker = http://bar/announce
+    private
+    xseed
+    '''))
+    generate = torf.Torrent.generate
+    with patch.object(torf.Torrent, 'generate', autospec=True, side_effect=generate) as mock_generate:
+        run([str(mock_content), '--profile', 'foo', '--profile', 'bar', '--each-profile'])
+    assert mock_generate.call_count == 1
+
+    foo = torf.Torrent.read('My Torrent.foo.torrent')
+    bar = torf.Torrent.read('My Torrent.bar.torrent')
+    assert foo.trackers == [['http://foo/announce']]
+    assert foo.source == 'FOO'
+    assert bar.trackers == [['http://bar/announce']]
+    assert bar.private is True
+    assert bar.randomize_infohash is True
+    assert foo.hashes == bar.hashes
+    assert foo.infohash != bar.infohash
+
+    cap = capsys.readouterr()
+    assert cap.out.index('Profile\tfoo\n') < cap.out.index('Torrent\tMy Torrent.foo.torrent\n')
+    assert cap.out.index('Profile\tbar\n') < cap.out.index('Torrent\tMy Torrent.bar.torrent\n')
+    assert f'Info Hash\t{foo.infohash}\n' in cap.out
+    assert f'Info Hash\t{bar.infohash}\n' in cap.out
+
+
+def test_each_profile_with_out_directory(capsys, cfgfile, mock_content, tmp_path):
+    cfgfile.write_text(textwrap.dedent('''
+    [foo]
+    source = FOO
+
+    [bar]
+    source = BAR
+    '''))
+    outdir = tmp_path / 'torrents'
+    outdir.mkdir()
+    run([str(mock_content), '--profile', 'foo', '--profile', 'bar', '--each-profile', '-o', str(outdir)])
+    assert sorted(os.listdir(outdir)) == ['My Torrent.bar.torrent', 'My Torrent.foo.torrent']
+    assert torf.Torrent.read(outdir / 'My Torrent.foo.torrent').source == 'FOO'
+    assert torf.Torrent.read(outdir / 'My Torrent.bar.torrent').source == 'BAR'
+
+def test_each_profile_with_out_file(capsys, cfgfile, mock_content):
+    cfgfile.write_text(textwrap.dedent('''
+    [foo]
+    source = FOO
+
+    [bar]
+    source = BAR
+    '''))
+    with patch('sys.exit') as mock_exit:
+        run([str(mock_content), '--profile', 'foo', '--profile', 'bar', '--each-profile', '-o', 'out.torrent'])
+    mock_exit.assert_called_once_with(err.Code.WRITE)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: out.torrent: Not a directory\n'
+
+
+def test_each_profile_with_input(capsys, cfgfile, create_torrent):
+    cfgfile.write_text(textwrap.dedent('''
+    [foo]
+    comment = Foo
+    '''))
+    with create_torrent() as infile:
+        with patch('sys.exit') as mock_exit:
+            run(['-i', infile, '--profile', 'foo', '--each-profile', '-o', 'out.torrent'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: --each-profile can only be used to create torrents\n'
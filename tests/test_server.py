@@ -0,0 +1,189 @@
+import json
+import os
+import socket
+import sys
+import threading
+from unittest.mock import patch
+
+import pytest
+import torf
+
+from torfcli import _errors as err
+from torfcli import _server, _vars, run
+
+
+@pytest.fixture
+def server(tmp_path):
+    socket_path = str(tmp_path / 'torf.sock')
+    srv = _server._Server(socket_path)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield socket_path
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+def _request(socket_path, *requests):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        f = sock.makefile('rwb')
+        events = []
+        for request in requests:
+            f.write(json.dumps(request).encode() + b'\n')
+            f.flush()
+            while True:
+                event = json.loads(f.readline())
+                events.append(event)
+                if event['event'] != 'progress' and event['event'] != 'record':
+                    break
+        return events
+
+
+def test_health(server):
+    assert _request(server, {'command': 'health'}) == [
+        {'event': 'health', 'status': 'ok', 'version': _vars.__version__},
+    ]
+
+
+def test_invalid_request(server):
+    assert _request(server, ['foo'], {'command': 'foo'}) == [
+        {'event': 'error', 'error': "Invalid request: Not a JSON object: ['foo']"},
+        {'event': 'error', 'error': 'Unknown command: foo'},
+    ]
+
+
+def test_create_job(server, mock_content):
+    events = _request(server, {'command': 'run', 'args': [str(mock_content), '--private']})
+    assert events[-1]['event'] == 'result'
+    assert events[-1]['exit_code'] == 0
+    assert events[-1]['info']['Name'] == 'My Torrent'
+    assert events[-1]['info']['Torrent'] == 'My Torrent.torrent'
+    assert all(event['job'] == events[-1]['job'] for event in events)
+    assert torf.Torrent.read('My Torrent.torrent').private is True
+
+
+def test_create_job_reports_progress(server, mock_content, monkeypatch):
+    from torfcli import _main
+    monkeypatch.setattr(_main, 'PROGRESS_INTERVAL', 0)
+    events = _request(server, {'command': 'run', 'args': [str(mock_content)]})
+    progress = [event for event in events if event['event'] == 'progress']
+    assert progress[-1]['fraction_done'] == 1
+    assert progress[-1]['pieces_done'] == progress[-1]['pieces_total']
+
+
+def test_cfg_overrides(server, mock_content):
+    events = _request(server, {'command': 'run', 'args': [str(mock_content)],
+                               'cfg': {'comment': 'Hello', 'notorrent': True}})
+    assert events[-1]['info']['Comment'] == ['Hello']
+    assert not os.path.exists('My Torrent.torrent')
+
+
+@pytest.mark.parametrize('cfg, error', (
+    ({'threads': 'abc'}, 'Invalid number of threads: abc'),
+    ({'no_such_option': 'foo'}, 'Unrecognized arguments: --no-such-option=foo'),
+    ({'comment': {'foo': 'bar'}}, "Invalid cfg: comment: {'foo': 'bar'}"),
+))
+def test_invalid_cfg_overrides(server, mock_content, cfg, error):
+    events = _request(server, {'command': 'run', 'args': [str(mock_content)], 'cfg': cfg})
+    assert events[-1]['exit_code'] == err.Code.CLI
+    assert events[-1]['info'] == {'Error': [error]}
+    assert not os.path.exists('My Torrent.torrent')
+
+
+def test_cfg_overrides_with_lists_and_numbers(server, mock_content):
+    events = _request(server, {'command': 'run', 'args': [str(mock_content)],
+                               'cfg': {'tracker': ['http://foo', 'http://bar'], 'max_piece_size': 1,
+                                       'private': True, 'noxseed': False, 'comment': '-x'}})
+    assert events[-1]['exit_code'] == 0
+    t = torf.Torrent.read('My Torrent.torrent')
+    assert t.trackers == [['http://foo'], ['http://bar']]
+    assert t.private is True
+    assert t.comment == '-x'
+
+
+def test_failing_job(server):
+    events = _request(server, {'command': 'run', 'args': ['-i', 'nonexisting.torrent']},
+                      {'command': 'metrics'})
+    assert events[0] == {'event': 'result', 'job': events[0]['job'], 'exit_code': err.Code.READ,
+                         'info': {'Error': ['nonexisting.torrent: No such file or directory']}}
+    assert events[1]['jobs_failed'] == 1
+    assert events[1]['jobs_running'] == 0
+
+
+@pytest.mark.parametrize('args, cfg, error', (
+    (['--nice', '5'], {}, '--nice must be given to --serve'),
+    ([], {'cpus': '0'}, '--cpus must be given to --serve'),
+))
+def test_job_with_scheduling_options(server, mock_content, monkeypatch, args, cfg, error):
+    from torfcli import _utils
+    monkeypatch.setattr(_utils.os, 'nice', lambda n: pytest.fail(f'os.nice({n}) called'))
+    events = _request(server, {'command': 'run', 'args': [str(mock_content), *args], 'cfg': cfg})
+    assert events[-1]['exit_code'] == err.Code.CLI
+    assert events[-1]['info'] == {'Error': [error]}
+    assert not os.path.exists('My Torrent.torrent')
+
+
+def test_serve_applies_scheduling_options(tmp_path):
+    with patch('torfcli._utils.set_scheduling') as mock_set_scheduling, \
+         patch('torfcli._server.serve') as mock_serve:
+        run(['--serve', str(tmp_path / 'torf.sock'), '--nice', '5'])
+    mock_set_scheduling.assert_called_once_with(nice=5, ionice=None, cpus=None)
+    assert mock_serve.call_count == 1
+
+
+def test_scheduling_options_are_applied_to_server_only(tmp_path, mock_content, monkeypatch):
+    from torfcli import _utils
+    calls = []
+    monkeypatch.setattr(_utils.os, 'nice', lambda n: calls.append(n))
+    socket_path = str(tmp_path / 'torf.sock')
+    srv = _server._Server(socket_path, scheduling={'nice': 5, 'ionice': None, 'cpus': None})
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        for args in ([], ['--nice', '5']):
+            events = _request(socket_path, {'command': 'run', 'args': [str(mock_content), *args],
+                                            'cfg': {'notorrent': True}})
+            assert events[-1]['exit_code'] == 0
+    finally:
+        srv.shutdown()
+        srv.server_close()
+    assert calls == []
+
+
+def test_stale_socket_is_removed(tmp_path):
+    socket_path = str(tmp_path / 'torf.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.close()
+    _server._remove_stale_socket(socket_path)
+    assert not os.path.exists(socket_path)
+
+
+def test_socket_in_use(server):
+    with pytest.raises(err.WriteError, match=r'Address already in use$'):
+        _server._remove_stale_socket(server)
+
+
+def test_concurrent_jobs(server):
+    # Jobs fail right after parsing arguments, so parsing is most likely to
+    # happen at the same time
+    def request(results):
+        for _ in range(50):
+            events = _request(server, {'command': 'run', 'args': ['-i', 'nonexisting.torrent', 'some/path']})
+            results.append(events[-1]['info']['Error'])
+
+    results = []
+    threads = [threading.Thread(target=request, args=(results,)) for _ in range(8)]
+    # Switch threads often to provoke races
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert results == [['nonexisting.torrent: No such file or directory']] * 400
@@ -1,8 +1,10 @@
+import gc
+import weakref
 from types import SimpleNamespace
 
 import pytest
 
-from torfcli import _utils
+from torfcli import _errors, _utils
 
 
 def test_bytes2string__rounding():
@@ -33,3 +35,36 @@ def test_bytes2string__trailing_zeroes():
 def test_get_torrent_filepath(torrent, cfg, exp_return_value):
     return_value = _utils.get_torrent_filepath(torrent, cfg)
     assert return_value == exp_return_value
+
+
+def test_parse_cpus():
+    assert _utils.parse_cpus('3') == {3}
+    assert _utils.parse_cpus('0-3,6') == {0, 1, 2, 3, 6}
+    for string in ('', 'foo', '3-1', '-1', '1,,2'):
+        with pytest.raises(_errors.CliError, match=rf'^Invalid CPU list: {string}$'):
+            _utils.parse_cpus(string)
+
+
+def test_get_cpu_count(monkeypatch):
+    monkeypatch.setattr(_utils.os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3}, raising=False)
+    monkeypatch.setattr(_utils, '_get_cgroup_cpu_quota', lambda: None)
+    assert _utils.get_cpu_count() == 4
+    monkeypatch.setattr(_utils, '_get_cgroup_cpu_quota', lambda: 1.5)
+    assert _utils.get_cpu_count() == 2
+    monkeypatch.setattr(_utils, '_get_cgroup_cpu_quota', lambda: 0.1)
+    assert _utils.get_cpu_count() == 1
+
+
+def test_imap_per_device_releases_yielded_results():
+    class Result:
+        pass
+
+    refs = []
+    items = ((device, i) for i, device in enumerate(('sda', 'sdb', 'sda')))
+    for i, (item, future) in enumerate(_utils.imap_per_device(lambda item: Result(), items, device_jobs=1)):
+        assert item == i
+        result = future.result()
+        refs.append(weakref.ref(result))
+        del future
+        gc.collect()
+        assert [ref() is None for ref in refs] == [True] * i + [False]
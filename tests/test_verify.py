@@ -6,7 +6,7 @@ import pytest
 import torf
 
 from torfcli import _errors as err
-from torfcli import _vars, run
+from torfcli import _hash, _vars, run
 
 
 def test_torrent_unreadable(capsys, mock_content):
@@ -268,10 +268,188 @@ def test_PATH_argument_with_trailing_slash(capsys, create_torrent):
     with create_torrent() as torrent_file:
         torrent_name = torf.Torrent.read(torrent_file).name
 
-        with patch('torf.Torrent.verify') as mock_verify:
+        with patch('torfcli._hash.Hasher.verify') as mock_verify:
             run(['-i', torrent_file, 'some/path'])
-        assert mock_verify.call_args_list[0][0][0] == 'some/path'
+        assert mock_verify.call_args_list[0][0][1] == 'some/path'
 
-        with patch('torf.Torrent.verify') as mock_verify:
+        with patch('torfcli._hash.Hasher.verify') as mock_verify:
             run(['-i', torrent_file, 'some/path/'])
-        assert mock_verify.call_args_list[0][0][0] == f'some/path/{torrent_name}'
+        assert mock_verify.call_args_list[0][0][1] == f'some/path/{torrent_name}'
+
+
+def _corrupt_pieces(content, *piece_indexes):
+    # Flip first byte of pieces in `content`, which must all be in file "a"
+    with open(content / 'a', 'r+b') as f:
+        for piece_index in piece_indexes:
+            f.seek(piece_index * 16384)
+            byte = f.read(1)
+            f.seek(piece_index * 16384)
+            f.write(b'\x00' if byte == b'\xff' else b'\xff')
+
+
+@pytest.mark.parametrize('args, exp_errors', (
+    ((), ['2', '4', '6']),
+    (('--max-errors', '2'), ['2', '4']),
+    (('--fail-fast',), ['2']),
+))
+def test_verify_with_max_errors(capsys, content, args, exp_errors):
+    run([str(content)])
+    _corrupt_pieces(content, 1, 3, 5)
+    capsys.readouterr()
+
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), *args])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    out = capsys.readouterr().out
+    assert re.findall(r'Corruption in piece (\d+)', out) == exp_errors
+    assert ('Stopped\t' in out) == bool(args)
+
+
+def test_verify_with_max_errors_does_not_read_if_files_are_missing(capsys, content, monkeypatch):
+    run([str(content)])
+    (content / 'a').unlink()
+    (content / 'd').unlink()
+    capsys.readouterr()
+    monkeypatch.setattr(_hash.Hasher, '_iter_hashes', None)
+
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--max-errors', '2'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    out = capsys.readouterr().out
+    assert f'{content / "a"}: No such file or directory\n' in out
+    assert f'{content / "d"}: No such file or directory\n' in out
+    assert 'Stopped\tAfter 2 errors\n' in out
+
+
+def test_invalid_max_errors(capsys, content):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), '--max-errors', '-1'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: Invalid maximum number of errors: -1\n'
+
+
+@pytest.mark.parametrize('args', (('--sample', '0.1'), ('--sample-pieces', '9')))
+def test_verify_sample(capsys, content, args):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    capsys.readouterr()
+    run(['-i', 'content.torrent', str(content), *args, '--sample-seed', '123'])
+    out = capsys.readouterr().out
+    assert f'Sample\t9 of {t.pieces} pieces\n' in out
+    assert 'Sample Seed\t123\n' in out
+    assert re.search(r'^Confidence\t95% that fewer than \d+ pieces \(\d+\.\d\d%\) are corrupt$', out, re.MULTILINE)
+
+    # Corrupt pieces that are in the sample are found
+    sample = _hash.Sample(t, count=9, seed='123')
+    _corrupt_pieces(content, sample.piece_indexes[1])
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), *args, '--sample-seed', '123'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    out = capsys.readouterr().out
+    assert re.findall(r'Corruption in piece (\d+)', out) == [str(sample.piece_indexes[1] + 1)]
+    assert 'Confidence\t' not in out
+
+
+@pytest.mark.parametrize('args, msg', (
+    (('--sample', '1.5'), 'Invalid sample fraction: 1.5'),
+    (('--sample-pieces', '-1'), 'Invalid number of sample pieces: -1'),
+    (('--sample', '0.1', '--sample-pieces', '10'), '--sample and --sample-pieces cannot be combined'),
+))
+def test_invalid_sample_options(capsys, content, args, msg):
+    with patch('sys.exit') as mock_exit:
+        run([str(content), *args])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: {msg}\n'
+
+
+def test_verify_quick(capsys, content, tmp_path):
+    verified_file = str(tmp_path / 'verified.db')
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    capsys.readouterr()
+
+    # Everything is verified the first time
+    run(['-i', 'content.torrent', '--quick', '--quick-file', verified_file, str(content)])
+    out = capsys.readouterr().out
+    assert 'Last Verified\tnever\n' in out
+    assert 'Changed Pieces\t' not in out
+
+    # Nothing is verified if nothing changed
+    run(['-i', 'content.torrent', '--quick', '--quick-file', verified_file, str(content)])
+    out = capsys.readouterr().out
+    assert f'Changed Pieces\t0 of {t.pieces}\n' in out
+
+    # Only pieces of files that changed are verified
+    _corrupt_pieces(content, 3)
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', '--quick', '--quick-file', verified_file, str(content)])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    out = capsys.readouterr().out
+    assert f'Changed Pieces\t49 of {t.pieces}\n' in out
+    assert re.findall(r'Corruption in piece (\d+)', out) == ['4']
+
+    # Failed verification is not remembered
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', '--quick', '--quick-file', verified_file, str(content)])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+
+
+def test_quick_option_does_not_take_PATH(capsys, content, tmp_path):
+    run([str(content)])
+    capsys.readouterr()
+    _corrupt_pieces(content, 3)
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', '--quick-file', str(tmp_path / 'verified.db'), '--quick', str(content)])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    assert re.findall(r'Corruption in piece (\d+)', capsys.readouterr().out) == ['4']
+
+
+def test_quick_cannot_be_combined_with_sample(capsys, content):
+    run([str(content)])
+    capsys.readouterr()
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--quick', '--sample', '0.1'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == (f'{_vars.__appname__}: '
+                                       '--quick cannot be combined with --sample\n')
+
+
+@pytest.mark.parametrize('args', (('--only', '*/B'), ('--only-regex', r'/b$')))
+def test_verify_only_matching_files(capsys, content, args):
+    run([str(content)])
+    t = torf.Torrent.read('content.torrent')
+    # Corrupt piece in "a" that isn't shared with "b"
+    _corrupt_pieces(content, 3)
+    capsys.readouterr()
+
+    # "b" is in pieces 48 to 54, which are shared with "a" and "d"
+    run(['-i', 'content.torrent', str(content), *args])
+    out = capsys.readouterr().out
+    assert 'Selected Files\t1 of 3\n' in out
+    assert f'Selected Pieces\t7 of {t.pieces}\n' in out
+
+    # Pieces shared with matching files are verified
+    _corrupt_pieces(content, 48)
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), *args])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    assert re.findall(r'Corruption in piece (\d+)', capsys.readouterr().out) == ['49']
+
+
+def test_verify_only_reports_missing_neighbours(capsys, content):
+    run([str(content)])
+    (content / 'a').unlink()
+    capsys.readouterr()
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--only', '*/b'])
+    mock_exit.assert_called_once_with(err.Code.VERIFY)
+    assert f'{content / "a"}: No such file or directory\n' in capsys.readouterr().out
+
+
+def test_verify_only_without_matching_files(capsys, content):
+    run([str(content)])
+    capsys.readouterr()
+    with patch('sys.exit') as mock_exit:
+        run(['-i', 'content.torrent', str(content), '--only', 'foo'])
+    mock_exit.assert_called_once_with(err.Code.CLI)
+    assert capsys.readouterr().err == f'{_vars.__appname__}: No files match --only or --only-regex\n'
@@ -9,6 +9,7 @@
 # GNU General Public License for more details
 # http://www.gnu.org/licenses/gpl-3.0.txt
 
+import signal
 import sys
 
 
@@ -18,6 +19,9 @@ def run(args=sys.argv[1:]):
     # Only parse --json, --human and --nohuman so UI can report errors.
     ui = _ui.UI(_config.parse_early_args(args))
 
+    # Handle SIGTERM like Ctrl-C so we can clean up (e.g. save checkpoints)
+    prev_sigterm_handler = signal.signal(signal.SIGTERM, _raise_KeyboardInterrupt)
+
     # Parse the rest of the args; report any errors as specified by early args.
     torrent = None
     try:
@@ -32,4 +36,9 @@ def run(args=sys.argv[1:]):
         except KeyboardInterrupt:
             ui.error(_errors.Error('Aborted', code=_errors.Code.ABORTED))
     finally:
+        signal.signal(signal.SIGTERM, prev_sigterm_handler)
         ui.terminate(torrent)
+
+
+def _raise_KeyboardInterrupt(signum, frame):
+    raise KeyboardInterrupt()
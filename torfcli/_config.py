@@ -22,22 +22,61 @@ from . import _errors, _utils, _vars
 
 DEFAULT_CONFIG_FILE = os.path.join(BaseDirectory.xdg_config_home, _vars.__appname__, 'config')
 DEFAULT_CREATOR = f'{_vars.__appname__} {_vars.__version__}'
+DEFAULT_HASH_CACHE_FILE = os.path.join(BaseDirectory.xdg_cache_home, _vars.__appname__, 'pieces.db')
+DEFAULT_HASH_CACHE_SIZE = 64
+DEFAULT_VERIFIED_FILE = os.path.join(BaseDirectory.xdg_cache_home, _vars.__appname__, 'verified.db')
+# How to use the page cache when reading files: normally, with sequential
+# read-ahead, removing hashed data from the cache or bypassing it with O_DIRECT
+CACHE_POLICIES = ('keep', 'sequential', 'drop', 'direct')
 VERSION_TEXT = f'{_vars.__appname__} {_vars.__version__} <{_vars.__url__}>'
 HELP_TEXT = f"""
 {_vars.__appname__} - {_vars.__description__}
 
 USAGE
     {_vars.__appname__} PATH [OPTIONS] [-o TORRENT]    # Create torrent
+    {_vars.__appname__} PATH... [OPTIONS] [-o DIR]     # Create multiple torrents
     {_vars.__appname__} -i INPUT                       # Display torrent
+    {_vars.__appname__} -i INPUT -i INPUT...           # Display multiple torrents
     {_vars.__appname__} -i INPUT [OPTIONS] -o TORRENT  # Edit torrent
     {_vars.__appname__} -i TORRENT PATH                # Verify file content
+    {_vars.__appname__} --verify-from MANIFEST         # Verify multiple torrents
+    {_vars.__appname__} --serve SOCKET                 # Process jobs from socket
 
 ARGUMENTS
-  PATH                     Path to torrent's content file or directory
-  --in, -i INPUT           Read metainfo from torrent file or magnet URI
-  --out, -o TORRENT        Write metainfo to TORRENT (default: NAME.torrent)
+  PATH                     Path to torrent's content file or directory; may be
+                           given multiple times to create multiple torrents
+  --in, -i INPUT           Read metainfo from torrent file or magnet URI; may
+                           be given multiple times, be a glob pattern
+                           (e.g. "*.torrent") or a directory to display or
+                           edit multiple torrents
+  --in-from FILE           Read one INPUT per line from FILE ("-" for stdin)
+  --verify-from MANIFEST   Verify each "TORRENT<TAB>PATH" line in MANIFEST
+                           ("-" for stdin)
+  --device-jobs JOBS       Number of torrents to verify at the same time per
+                           storage device (default: 1)
+  --fail-fast              Stop verifying at the first error
+  --max-errors ERRORS      Stop verifying after ERRORS errors
+  --sample FRACTION        Verify only FRACTION (0 to 1) of all pieces,
+                           including the first and last piece of each file
+  --sample-pieces PIECES   Verify only PIECES pieces, including the first and
+                           last piece of each file
+  --sample-seed SEED       Pick the same random pieces as a previous
+                           --sample or --sample-pieces run
+  --quick                  Verify only files that changed since the last
+                           successful verification
+  --quick-file FILE        Where --quick stores successful verifications
+                           (default: ~/.cache/{_vars.__appname__}/verified.db)
+  --only PATTERN           Verify only files that match this glob pattern
+  --only-regex PATTERN     Verify only files that match this regular
+                           expression
+  --out, -o TORRENT        Write metainfo to TORRENT (default: NAME.torrent);
+                           directory for all torrents if multiple torrents
+                           are created
+  --each                   Create one torrent for each subdirectory of PATH
+  --inplace                Overwrite INPUT instead of writing to TORRENT
   --reuse, -r REUSE        Copy pieces from existing torrent file if possible
-  --noreuse, -R            Ignore any --reuse paths
+  --noreuse, -R            Ignore any --reuse paths and don't copy
+                           unchanged pieces from INPUT
 
   FILES SELECTION
     --exclude, -e PATTERN  Exclude files that match this glob pattern
@@ -66,6 +105,8 @@ ARGUMENTS
     --merge JSON           Insert or remove arbitrary metainfo (see man page)
     --xseed, -x            Randomize info hash
     --max-piece-size SIZE  Maximum piece size in multiples of 1 MiB
+    --piece-sizes SIZES    Comma-separated list of piece sizes in multiples of
+                           1 MiB; creates one torrent per piece size
     --notracker, -T        Remove trackers from INPUT
     --nowebseed, -W        Remove webseeds from INPUT
     --noprivate, -P        Remove private flag from INPUT
@@ -84,7 +125,35 @@ ARGUMENTS
                            (default: ~/.config/{_vars.__appname__}/config
     --noconfig, -F         Ignore configuration file
     --profile, -z PROFILE  Use options from PROFILE
-    --threads THREADS      Number of threads to use for hashing
+    --each-profile         Create one torrent per --profile instead of
+                           combining them
+    --threads THREADS      Number of threads to use for hashing or "auto" to
+                           find the fastest number while hashing
+    --processes PROCESSES  Hash in PROCESSES worker processes instead of
+                           threads
+    --parallel-devices     Read files on different storage devices at the
+                           same time
+    --physical-order       Read pieces in the order they are stored on disk
+    --cache-policy POLICY  How to use the page cache while hashing: keep,
+                           sequential, drop or direct (default: keep)
+    --max-memory SIZE      Read up to SIZE multiples of 1 MiB ahead of hashing
+                           in a background thread
+    --sparse               Don't read holes in sparse files
+    --hardlinks            Read hard-linked files only once
+    --max-read-rate RATE   Read at most RATE multiples of 1 MiB per second
+    --nice NICE            Add NICE to the CPU scheduling niceness
+    --ionice CLASS[:LEVEL] I/O scheduling class (idle, best-effort or
+                           realtime) and priority from 0 to 7
+    --cpus CPUS            Run only on CPUS, e.g. "0-3,6"
+    --resume               Save hashing progress in TORRENT.checkpoint and
+                           continue from there if it exists
+    --hash-cache           Remember piece hashes of unchanged files
+    --hash-cache-file FILE Where --hash-cache stores piece hashes
+                           (default: ~/.cache/{_vars.__appname__}/pieces.db)
+    --nohash-cache         Don't use piece hash cache
+    --hash-cache-size SIZE Maximum size of piece hash cache in multiples of
+                           1 MiB (default: {DEFAULT_HASH_CACHE_SIZE})
+    --serve SOCKET         Process JSON jobs from Unix domain socket SOCKET
 
   TEXT OUTPUT
     --json, -j             Print output as JSON object
@@ -112,9 +181,23 @@ class CLIParser(argparse.ArgumentParser):
 
 _cliparser = CLIParser(add_help=False)
 
-_cliparser.add_argument('PATH', nargs='?')
-_cliparser.add_argument('--in', '-i', default='')
+_cliparser.add_argument('PATH', nargs='*')
+_cliparser.add_argument('--in', '-i', default=[], action='append')
+_cliparser.add_argument('--in-from', default='')
+_cliparser.add_argument('--verify-from', default='')
+_cliparser.add_argument('--device-jobs', type=int, default=1)
+_cliparser.add_argument('--fail-fast', action='store_true')
+_cliparser.add_argument('--max-errors', type=int, default=0)
+_cliparser.add_argument('--sample', type=float, default=0)
+_cliparser.add_argument('--sample-pieces', type=int, default=0)
+_cliparser.add_argument('--sample-seed', default='')
+_cliparser.add_argument('--quick', action='store_true')
+_cliparser.add_argument('--quick-file', default=DEFAULT_VERIFIED_FILE)
+_cliparser.add_argument('--only', default=[], action='append')
+_cliparser.add_argument('--only-regex', default=[], action='append')
 _cliparser.add_argument('--out', '-o', default='')
+_cliparser.add_argument('--each', action='store_true')
+_cliparser.add_argument('--inplace', action='store_true')
 _cliparser.add_argument('--reuse', '-r', default=[], action='append')
 _cliparser.add_argument('--noreuse', '-R', action='store_true')
 _cliparser.add_argument('--exclude', '-e', default=[], action='append')
@@ -133,6 +216,7 @@ _cliparser.add_argument('--source', '-s', default='')
 _cliparser.add_argument('--merge', type=DictFromJSON, action='append')
 _cliparser.add_argument('--xseed', '-x', action='store_true')
 _cliparser.add_argument('--max-piece-size', default=0, type=float)
+_cliparser.add_argument('--piece-sizes', default='')
 
 _cliparser.add_argument('--notracker', '-T', action='store_true')
 _cliparser.add_argument('--nowebseed', '-W', action='store_true')
@@ -150,7 +234,25 @@ _cliparser.add_argument('--yes', '-y', action='store_true')
 _cliparser.add_argument('--config', '-f')
 _cliparser.add_argument('--noconfig', '-F', action='store_true')
 _cliparser.add_argument('--profile', '-z', default=[], action='append')
-_cliparser.add_argument('--threads', type=int, default=0)
+_cliparser.add_argument('--each-profile', action='store_true')
+_cliparser.add_argument('--threads', default=0)
+_cliparser.add_argument('--processes', type=int, default=0)
+_cliparser.add_argument('--parallel-devices', action='store_true')
+_cliparser.add_argument('--physical-order', action='store_true')
+_cliparser.add_argument('--cache-policy', default='keep')
+_cliparser.add_argument('--max-memory', type=float, default=0)
+_cliparser.add_argument('--sparse', action='store_true')
+_cliparser.add_argument('--hardlinks', action='store_true')
+_cliparser.add_argument('--max-read-rate', type=float, default=0)
+_cliparser.add_argument('--nice', type=int, default=0)
+_cliparser.add_argument('--ionice', default='')
+_cliparser.add_argument('--cpus', default='')
+_cliparser.add_argument('--resume', action='store_true')
+_cliparser.add_argument('--hash-cache', action='store_true')
+_cliparser.add_argument('--hash-cache-file', default=DEFAULT_HASH_CACHE_FILE)
+_cliparser.add_argument('--nohash-cache', action='store_true')
+_cliparser.add_argument('--hash-cache-size', type=float, default=DEFAULT_HASH_CACHE_SIZE)
+_cliparser.add_argument('--serve', default='')
 
 _cliparser.add_argument('--json', '-j', action='store_true')
 _cliparser.add_argument('--metainfo', '-m', action='store_true')
@@ -173,7 +275,30 @@ def parse_early_args(args):
 
 
 def parse_args(args):
-    cfg = vars(_cliparser.parse_args(args))
+    cfg = vars(_cliparser.parse_intermixed_args(args))
+
+    # Multiple PATHs or --each create one torrent per PATH
+    cfg['PATHS'] = cfg['PATH']
+    cfg['PATH'] = cfg['PATHS'][0] if cfg['PATHS'] else None
+
+    # Multiple INPUTs, glob patterns or --in-from read multiple torrents
+    cfg['INS'] = cfg['in']
+    cfg['in'] = cfg['INS'][0] if cfg['INS'] else ''
+
+    cfg['batch'] = (
+        len(cfg['PATHS']) > 1
+        or cfg['each']
+        or len(cfg['INS']) > 1
+        or bool(cfg['in_from'])
+        or any(_utils.is_glob(string) or os.path.isdir(string) for string in cfg['INS'])
+    )
+
+    # --inplace overwrites INPUT, so there must be one
+    if cfg['inplace'] and not cfg['INS'] and not cfg['in_from']:
+        raise _errors.CliError('--inplace requires --in or --in-from')
+
+    # One configuration per profile for --each-profile (see get_cfg())
+    cfg['profile_cfgs'] = []
 
     # Validate creation date
     if cfg['date']:
@@ -193,6 +318,24 @@ def parse_args(args):
         except torf.PieceSizeError as e:
             raise _errors.CliError(e)
 
+    # Validate piece sizes
+    piece_sizes = []
+    for string in cfg['piece_sizes'].split(',') if cfg['piece_sizes'] else ():
+        try:
+            piece_size = int(float(string) * 1048576)
+        except ValueError:
+            raise _errors.CliError(f'{string}: Invalid piece size')
+        try:
+            torf.Torrent(
+                piece_size_min=131072,     # 128 kiB
+                piece_size_max=134217728,  # 128 MiB
+            ).piece_size = piece_size
+        except torf.PieceSizeError as e:
+            raise _errors.CliError(e)
+        if piece_size not in piece_sizes:
+            piece_sizes.append(piece_size)
+    cfg['piece_sizes'] = piece_sizes
+
     # Validate tracker URLs
     for tier in cfg['tracker']:
         for url in tier.split(','):
@@ -209,13 +352,73 @@ def parse_args(args):
             raise _errors.CliError(e)
 
     # Validate regular expressions
-    for regex in itertools.chain(cfg['exclude_regex'], cfg['include_regex']):
+    for regex in itertools.chain(cfg['exclude_regex'], cfg['include_regex'], cfg['only_regex']):
         try:
             re.compile(regex)
         except re.error as e:
             raise _errors.CliError(f'Invalid regular expression: {regex}: '
                                    f'{str(e)[0].upper()}{str(e)[1:]}')
 
+    if cfg['device_jobs'] < 1:
+        raise _errors.CliError(f'Invalid number of device jobs: {cfg["device_jobs"]}')
+
+    if cfg['max_errors'] < 0:
+        raise _errors.CliError(f'Invalid maximum number of errors: {cfg["max_errors"]}')
+    elif cfg['fail_fast']:
+        cfg['max_errors'] = 1
+
+    if not 0 <= cfg['sample'] <= 1:
+        raise _errors.CliError(f'Invalid sample fraction: {cfg["sample"]:g}')
+    elif cfg['sample_pieces'] < 0:
+        raise _errors.CliError(f'Invalid number of sample pieces: {cfg["sample_pieces"]}')
+    elif cfg['sample'] and cfg['sample_pieces']:
+        raise _errors.CliError('--sample and --sample-pieces cannot be combined')
+
+    # "--threads auto" adjusts the number of hashing threads while hashing
+    cfg['auto_threads'] = cfg['threads'] == 'auto'
+    if cfg['auto_threads']:
+        cfg['threads'] = 0
+    else:
+        try:
+            threads = int(cfg['threads'])
+        except ValueError:
+            threads = -1
+        if threads < 0:
+            raise _errors.CliError(f'Invalid number of threads: {cfg["threads"]}')
+        cfg['threads'] = threads
+
+    if cfg['processes'] < 0:
+        raise _errors.CliError(f'Invalid number of processes: {cfg["processes"]}')
+
+    if cfg['cache_policy'] not in CACHE_POLICIES:
+        raise _errors.CliError(f'Invalid cache policy: {cfg["cache_policy"]}')
+    elif cfg['cache_policy'] == 'direct' and not hasattr(os, 'O_DIRECT'):
+        raise _errors.CliError('Cache policy "direct" is not supported on this platform')
+
+    if cfg['max_memory'] < 0:
+        raise _errors.CliError(f'Invalid maximum memory: {cfg["max_memory"]:g}')
+
+    if cfg['max_read_rate'] < 0:
+        raise _errors.CliError(f'Invalid maximum read rate: {cfg["max_read_rate"]:g}')
+
+    # "--ionice CLASS[:LEVEL]" is turned into (CLASS, LEVEL)
+    if cfg['ionice']:
+        ioclass, _, level = cfg['ionice'].partition(':')
+        try:
+            level = int(level) if level else 0
+        except ValueError:
+            level = -1
+        if ioclass not in _utils.IO_PRIORITY_CLASSES or not 0 <= level <= 7:
+            raise _errors.CliError(f'Invalid I/O priority: {cfg["ionice"]}')
+        cfg['ionice'] = (ioclass, level)
+    else:
+        cfg['ionice'] = None
+
+    cfg['cpus'] = _utils.parse_cpus(cfg['cpus']) if cfg['cpus'] else None
+
+    if cfg['hash_cache_size'] <= 0:
+        raise _errors.CliError(f'Invalid hash cache size: {cfg["hash_cache_size"]:g}')
+
     cfg['validate'] = not cfg['novalidate']
 
     return cfg
@@ -252,26 +455,37 @@ def get_cfg(cliargs):
         raise _errors.ConfigError(f'{cfgfile}: {e}')
 
     # Apply profiles specified in config file or on CLI
-    def apply_profile(profname):
+    def get_profile_args(profname):
         prof = filecfg.get(profname)
         if prof is None:
             raise _errors.ConfigError(f'{cfgfile}: No such profile: {profname}')
         else:
-            profargs.extend(_cfg2args(prof))
-
-    profargs = []
-    for profname in cfg['profile']:
-        apply_profile(profname)
+            return _cfg2args(prof)
 
     # Combine arguments from profiles with arguments from global config and CLI
-    args = _cfg2args(filecfg) + profargs + cliargs
-    try:
-        return parse_args(args)
-    except _errors.CliError as e:
-        raise _errors.ConfigError(f'{cfgfile}: {e}')
+    def parse_combined_args(profnames):
+        profargs = []
+        for profname in profnames:
+            profargs.extend(get_profile_args(profname))
+        args = _cfg2args(filecfg) + profargs + cliargs
+        try:
+            return parse_args(args)
+        except _errors.CliError as e:
+            raise _errors.ConfigError(f'{cfgfile}: {e}')
+
+    cfg = parse_combined_args(cfg['profile'])
+
+    # Make one configuration per profile instead of combining all profiles
+    if cfg['each_profile']:
+        for profname in cfg['profile']:
+            profcfg = parse_combined_args((profname,))
+            profcfg['profile'] = [profname]
+            cfg['profile_cfgs'].append(profcfg)
+    return cfg
 
 def _check_illegal_configfile_arguments(cfg, cfgfile):
-    for arg in ('in', 'name', 'out', 'config', 'noconfig', 'profile', 'help', 'version'):
+    for arg in ('in', 'in-from', 'verify-from', 'inplace', 'name', 'out', 'serve',
+                'config', 'noconfig', 'profile', 'help', 'version'):
         if arg in cfg:
             raise _errors.ConfigError(f'{cfgfile}: Not allowed in config file: {arg}')
 
@@ -279,9 +493,24 @@ def _check_illegal_configfile_arguments(cfg, cfgfile):
 _re_bool = re.compile(r'^(\S+)$')
 _re_assign = re.compile(r'^(\S+)\s*=\s*(.*)\s*$')
 
+# Parsed config files mapped to (mtime, size, cfg) so long-running processes
+# (e.g. --serve) don't parse the same file for every job
+_readfile_cache = {}
+
 def _readfile(filepath):
     """Read INI-style file into dictionary"""
+    try:
+        stat = os.stat(filepath)
+    except OSError as e:
+        raise _errors.ConfigError(f'{filepath}: {os.strerror(e.errno)}')
+    cached = _readfile_cache.get(filepath)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    cfg = _parsefile(filepath)
+    _readfile_cache[filepath] = (stat.st_mtime_ns, stat.st_size, cfg)
+    return cfg
 
+def _parsefile(filepath):
     # Catch any errors from the OS
     try:
         with open(filepath, 'r') as f:
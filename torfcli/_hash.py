@@ -0,0 +1,2026 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details
+# http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+Piece hashing for features that torf doesn't provide
+
+Torrents are verified with the :class:`Hasher` in this module, which reports
+errors in piece order. When creating or editing torrents, torf is used by
+default and the :class:`Hasher` only if an option asks for something torf
+can't do.
+"""
+
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import queue
+import random
+import signal
+import sqlite3
+import struct
+import threading
+import time
+
+import torf
+
+from . import _errors, _utils
+
+_log = logging.getLogger(__name__)
+
+# Seconds between writes to checkpoint files
+CHECKPOINT_INTERVAL = 10
+
+# Maximum number of bytes in the shared memory ring buffer of hashing processes
+RING_BUFFER_SIZE = 256 * 1048576
+
+# Seconds between adjustments of the number of hashing threads
+TUNE_INTERVAL = 2
+
+# Maximum number of bytes of hard-linked files that are kept in memory
+HARDLINK_CACHE_SIZE = 64 * 1048576
+
+# Confidence level of the estimated number of corrupt pieces after verifying a
+# random sample of pieces
+SAMPLE_CONFIDENCE = 0.95
+
+# FIEMAP ioctl from linux/fiemap.h
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_FLAG_SYNC = 0x1
+_FIEMAP_EXTENT_LAST = 0x1
+_FIEMAP_MAX_EXTENTS = 256
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+
+def get_hasher(cfg, known_hashes=None, checkpoint_path=None):
+    """
+    Return :class:`Hasher` instance or `None` if no option needs it
+
+    Without a :class:`Hasher`, torf generates the piece hashes of new torrents.
+    Verification always needs a :class:`Hasher`, so the caller falls back to
+    a default instance.
+
+    :param known_hashes: Mapping of piece indexes to piece hashes that don't
+        need to be read
+    :param checkpoint_path: Path to :class:`Checkpoint` file or `None`
+    """
+    cache = None
+    if cfg['hash_cache'] and not cfg['nohash_cache']:
+        cache = PieceCache(cfg['hash_cache_file'], max_size=cfg['hash_cache_size'] * 1048576)
+    checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+
+    if (cache or known_hashes or checkpoint
+            or cfg['processes'] or cfg['parallel_devices'] or cfg['physical_order']
+            or cfg['cache_policy'] != 'keep' or cfg['max_memory'] or cfg['sparse'] or cfg['hardlinks']
+            or cfg['auto_threads'] or cfg['max_read_rate']):
+        return Hasher(threads=cfg['threads'], auto_threads=cfg['auto_threads'], processes=cfg['processes'],
+                      parallel_devices=cfg['parallel_devices'], physical_order=cfg['physical_order'],
+                      cache_policy=cfg['cache_policy'], max_memory=int(cfg['max_memory'] * 1048576),
+                      sparse=cfg['sparse'], hardlinks=cfg['hardlinks'],
+                      max_read_rate=int(cfg['max_read_rate'] * 1048576), cache=cache,
+                      known_hashes=known_hashes, checkpoint=checkpoint)
+
+
+def get_unchanged_hashes(old_files, old_hashes, new_files, piece_size):
+    """
+    Find pieces that are identical in two file lists
+
+    Files are identified by their path in the torrent (without the torrent
+    name) and their size. They are expected to have the same content if both
+    are equal.
+
+    :param old_files: Sequence of :class:`torf.File` with known piece hashes
+    :param old_hashes: Sequence of piece hashes of `old_files`
+    :param new_files: Sequence of :class:`torf.File`
+    :param int piece_size: Piece size of `old_hashes`
+
+    :return: Dictionary that maps piece indexes of `new_files` to piece hashes
+        from `old_hashes`
+    """
+    def get_layout(files):
+        # Single-file torrents only have the name in their path
+        return Layout(filepaths=[tuple(f.parts[1:] or f.parts) for f in files],
+                      sizes=[f.size for f in files],
+                      piece_size=piece_size)
+
+    def get_signatures(layout):
+        for piece_index in range(layout.pieces):
+            yield tuple((layout.filepaths[file_index], layout.sizes[file_index], offset, length)
+                        for file_index, offset, length in layout.get_segments(piece_index))
+
+    old_layout = get_layout(old_files)
+    if old_layout.pieces != len(old_hashes):
+        return {}
+    old_pieces = dict(zip(get_signatures(old_layout), old_hashes))
+    return {piece_index: old_pieces[signature]
+            for piece_index, signature in enumerate(get_signatures(get_layout(new_files)))
+            if signature in old_pieces}
+
+
+def get_read_order(layout, piece_indexes):
+    """
+    Sort pieces by the location of their first byte on disk
+
+    The physical location of each file is taken from the FIEMAP ioctl. If that
+    isn't supported for all files, they are sorted by device and inode, which
+    often resembles the order they were written in.
+
+    :param layout: :class:`Layout` instance
+    :param piece_indexes: Sequence of piece indexes in `layout`
+
+    :return: `(piece_indexes, method)` tuple where `method` is ``"physical"``
+        or ``"inode"``
+    """
+    try:
+        extents = [_get_extents(filepath) if size else [] for filepath, size in zip(layout.filepaths, layout.sizes)]
+    except OSError:
+        extents = None
+
+    def get_location(file_index, offset):
+        # Find physical offset of logical `offset` or the closest preceding
+        # extent if `offset` is in a hole
+        file_extents = extents[file_index]
+        if not file_extents:
+            return 0
+        i = max(0, bisect.bisect_right(file_extents, (offset, math.inf)) - 1)
+        logical, physical, _ = file_extents[i]
+        return physical + max(0, offset - logical)
+
+    devices = []
+    inodes = []
+    for filepath in layout.filepaths:
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            devices.append(0)
+            inodes.append(0)
+        else:
+            devices.append(stat.st_dev)
+            inodes.append(stat.st_ino)
+
+    def get_key(piece_index):
+        file_index, offset, _ = layout.get_segments(piece_index)[0]
+        if extents is None:
+            return (devices[file_index], inodes[file_index], offset)
+        else:
+            return (devices[file_index], get_location(file_index, offset))
+
+    return sorted(piece_indexes, key=get_key), 'inode' if extents is None else 'physical'
+
+
+def _get_extents(filepath):
+    # Return sorted `(logical_offset, physical_offset, length)` tuples or raise
+    # OSError if FIEMAP is not supported
+    import fcntl
+    extents = []
+    start = 0
+    with open(filepath, 'rb') as f:
+        while True:
+            request = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size * _FIEMAP_MAX_EXTENTS)
+            _FIEMAP_HEADER.pack_into(request, 0, start, 2**64 - 1 - start, _FIEMAP_FLAG_SYNC,
+                                     0, _FIEMAP_MAX_EXTENTS, 0)
+            fcntl.ioctl(f.fileno(), _FS_IOC_FIEMAP, request)
+            mapped_extents = _FIEMAP_HEADER.unpack_from(request)[3]
+            if mapped_extents == 0:
+                return extents
+            for i in range(mapped_extents):
+                logical, physical, length, _, _, flags, *_ = _FIEMAP_EXTENT.unpack_from(
+                    request, _FIEMAP_HEADER.size + i * _FIEMAP_EXTENT.size,
+                )
+                extents.append((logical, physical, length))
+            if flags & _FIEMAP_EXTENT_LAST:
+                return extents
+            start = logical + length
+
+
+def _iter_in_piece_order(results, piece_indexes):
+    # Yield `(piece_index, ...)` tuples from `results` in the order of the
+    # sorted `piece_indexes`, holding back pieces until all previous pieces are
+    # yielded
+    pending = {}
+    piece_indexes = iter(piece_indexes)
+    next_index = next(piece_indexes, None)
+    for result in results:
+        pending[result[0]] = result
+        while next_index in pending:
+            yield pending.pop(next_index)
+            next_index = next(piece_indexes, None)
+
+
+def _get_data_ranges(filepath):
+    # Return sorted `(start, end)` tuples of the parts of `filepath` that are
+    # not holes or `None` if holes can't be detected
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        data_ranges = []
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # No more data after `pos`
+                    break
+                return None
+            pos = os.lseek(fd, start, os.SEEK_HOLE)
+            data_ranges.append((start, pos))
+        return data_ranges
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def _is_hole(data_ranges, offset, length):
+    # Whether `length` bytes at `offset` are outside of all `data_ranges`
+    if data_ranges is None:
+        return False
+    i = bisect.bisect_right(data_ranges, (offset, math.inf))
+    if i > 0 and data_ranges[i - 1][1] > offset:
+        return False
+    if i < len(data_ranges) and data_ranges[i][0] < offset + length:
+        return False
+    return True
+
+
+@functools.lru_cache
+def _get_zeros_hash(length):
+    # Hash `length` zeros without allocating them all at once
+    piece_hash = hashlib.sha1()
+    zeros = bytes(min(length, 1048576))
+    for pos in range(0, length, len(zeros)):
+        piece_hash.update(zeros[:length - pos])
+    return piece_hash.digest()
+
+
+class Hasher:
+    """
+    Hash pieces and report progress like :meth:`torf.Torrent.generate` and
+    :meth:`torf.Torrent.verify`
+
+    :param int threads: Number of hashing threads or 0 for one per CPU core
+    :param bool auto_threads: Whether to adjust the number of hashing threads
+        to the highest throughput with `threads` as the maximum (see
+        :class:`_ThreadTuner`)
+    :param int processes: Number of hashing processes or 0 to hash in threads
+    :param bool parallel_devices: Whether to read files on different devices at
+        the same time
+    :param bool physical_order: Whether to read pieces in the order they are
+        stored on disk (see :func:`get_read_order`)
+    :param str cache_policy: How files are read (see :data:`_config.CACHE_POLICIES`)
+    :param int max_memory: Number of bytes to read ahead in a background
+        thread or 0 to read pieces when they are needed
+    :param bool sparse: Whether to skip reading pieces that are entirely in
+        holes of sparse files
+    :param bool hardlinks: Whether to read files with multiple paths in the
+        torrent only once
+    :param max_read_rate: Maximum number of bytes per second to read or 0 for
+        no limit
+    :param cache: :class:`PieceCache` instance or `None`
+    :param known_hashes: Mapping of piece indexes to piece hashes that don't
+        need to be read
+    :param checkpoint: :class:`Checkpoint` instance or `None`
+    """
+
+    def __init__(self, threads=0, auto_threads=False, processes=0, parallel_devices=False, physical_order=False,
+                 cache_policy='keep', max_memory=0, sparse=False, hardlinks=False, max_read_rate=0, cache=None,
+                 known_hashes=None, checkpoint=None):
+        self._threads = threads or _utils.get_cpu_count()
+        self._auto_threads = auto_threads
+        self._processes = processes
+        self._parallel_devices = parallel_devices
+        self._physical_order = physical_order
+        self._cache_policy = cache_policy
+        self._max_memory = max_memory
+        self._sparse = sparse
+        self._hardlinks = hardlinks
+        # One limit for all readers
+        self._rate_limiter = _RateLimiter(max_read_rate) if max_read_rate else None
+        self._cache = cache
+        self._known_hashes = dict(known_hashes or {})
+        self._checkpoint = checkpoint
+        self.stats = {}
+        # Bytes per second per device name while reading from multiple devices
+        self.device_throughput = {}
+
+    def generate(self, torrent, callback=None, interval=0, siblings=()):
+        """
+        Set ``pieces`` in `torrent`'s metainfo
+
+        `callback` gets the same arguments as the callback of
+        :meth:`torf.Torrent.generate`.
+
+        `siblings` is a sequence of torrents with the same files as `torrent`
+        but different piece sizes. Their pieces are hashed in the same read
+        pass. Progress is reported for `torrent` only. The cache, known hashes
+        and checkpoint are not used in that case.
+
+        :raise torf.TorfError: if hashing fails
+
+        :return: `True` if all pieces were hashed, `False` if `callback`
+            cancelled
+        """
+        if torrent.path is None:
+            raise RuntimeError('generate() called with no path specified')
+        layout = Layout(
+            filepaths=[str(fp) for fp in torrent.filepaths],
+            sizes=[f.size for f in torrent.files],
+            piece_size=torrent.piece_size,
+        )
+        if layout.size < 1:
+            raise torf.PathError(torrent.path, msg='Empty or all files excluded')
+
+        progress = _Progress(callback, interval, torrent, layout.pieces)
+        if siblings:
+            return self._generate_piece_sizes(layout, (torrent, *siblings), progress)
+
+        identities = layout.get_identities() if self._cache or self._checkpoint else None
+        hashes = {i: h for i, h in self._known_hashes.items() if i < layout.pieces}
+        if self._known_hashes:
+            self.stats['Unchanged Pieces'] = f'{len(hashes)} of {layout.pieces}'
+        hashes.update(self._get_resumed_hashes(layout, identities, exclude=hashes))
+        hashes.update(self._get_sparse_hashes(layout, exclude=hashes))
+        hashes.update(self._get_cached_hashes(layout, identities, exclude=hashes))
+        self._start_checkpoint(layout, identities, hashes)
+        progress.advance(len(hashes), filepath=layout.filepaths[0])
+
+        hashed = {}
+        todo = self._get_read_order(layout, [i for i in range(layout.pieces) if i not in hashes])
+        try:
+            for piece_index, piece_hash, exception in self._iter_hashes(layout, todo):
+                if exception:
+                    raise exception
+                hashed[piece_index] = piece_hash
+                if self._checkpoint:
+                    self._checkpoint.add(piece_index, piece_hash)
+                if progress.advance(1, filepath=layout.get_filepath(piece_index)):
+                    return False
+        finally:
+            if self._checkpoint:
+                self._checkpoint.close()
+
+        self._fill_cache(layout, identities, hashed)
+        hashes.update(hashed)
+        torrent.metainfo['info']['pieces'] = b''.join(hashes[i] for i in range(layout.pieces))
+        if self._checkpoint:
+            self._checkpoint.remove()
+        return True
+
+    def verify(self, torrent, path, callback=None, interval=0, max_errors=0, pieces=None):
+        """
+        Check if `path` contains the data specified in `torrent`
+
+        `callback` gets the same arguments as the callback of
+        :meth:`torf.Torrent.verify`. If there is no `callback`, the first error
+        is raised. The cache is never used for verification.
+
+        Pieces of files that are missing or have the wrong size are never read.
+        If `max_errors` is not 0, verification stops after that many errors
+        were reported.
+
+        If `pieces` is not `None`, only pieces with these indexes are verified.
+        Files that are missing or have the wrong size are only reported if any
+        of their pieces are verified.
+
+        :raise torf.TorfError: if `torrent` is invalid or if there is no
+            `callback` and verification fails
+
+        :return: `True` if `path` is verified successfully, `False` otherwise
+        """
+        torrent.validate()
+        progress = _VerifyProgress(callback, interval, torrent, torrent.pieces)
+        if torrent.mode == 'singlefile' and os.path.isdir(path):
+            return progress.fail(torf.VerifyIsDirectoryError(path))
+        elif torrent.mode == 'multifile' and not os.path.isdir(path):
+            return progress.fail(torf.VerifyNotDirectoryError(path))
+
+        layout = Layout.from_content_path(torrent, path)
+        exp_hashes = torrent.hashes
+        exp_file_sizes = tuple(zip(layout.filepaths, layout.sizes))
+
+        if pieces is None:
+            pieces = range(layout.pieces)
+        else:
+            pieces = sorted(set(pieces))
+            progress = _VerifyProgress(callback, interval, torrent, len(pieces))
+
+        # Don't read pieces of missing files or files with the wrong size
+        file_errors, bad_pieces = self._get_file_errors(layout, frozenset(pieces))
+        errors = _ErrorCounter(max_errors)
+        if errors.is_exceeded_by(file_errors):
+            # Don't read anything if missing files are enough to give up
+            self.stats['Stopped'] = errors.description
+            for piece_index in sorted(file_errors):
+                exceptions = errors.add(file_errors[piece_index])
+                progress.advance(piece_index, layout.get_filepath(piece_index), None, exceptions)
+                if errors.is_reached:
+                    return False
+
+        identities = layout.get_identities() if self._checkpoint else None
+        known_hashes = self._get_resumed_hashes(layout, identities, exclude=bad_pieces)
+        known_hashes.update(self._get_sparse_hashes(layout, exclude=bad_pieces.union(known_hashes)))
+        self._start_checkpoint(layout, identities, known_hashes)
+
+        success = not file_errors
+        try:
+            skip = bad_pieces.union(known_hashes)
+            # Report pieces in order even if they are read in a different order
+            # so errors are always reported in the same order
+            piece_indexes = self._get_read_order(layout, pieces)
+            results = _iter_in_piece_order(self._iter_hashes(layout, piece_indexes, skip=skip), pieces)
+            for piece_index, piece_hash, exception in results:
+                piece_hash = piece_hash or known_hashes.get(piece_index)
+                exceptions = list(file_errors.get(piece_index, ()))
+                if exception:
+                    exceptions.append(exception)
+                elif not exceptions and piece_hash is not None and piece_hash != exp_hashes[piece_index]:
+                    exceptions.append(torf.VerifyContentError(
+                        layout.get_filepath(piece_index), piece_index, layout.piece_size, exp_file_sizes,
+                    ))
+                if exceptions:
+                    success = False
+                    exceptions = errors.add(exceptions)
+                if self._checkpoint and piece_index not in known_hashes:
+                    self._checkpoint.add(piece_index, piece_hash)
+                if progress.advance(piece_index, layout.get_filepath(piece_index), piece_hash, exceptions):
+                    return False
+                if errors.is_reached:
+                    self.stats['Stopped'] = errors.description
+                    return False
+        finally:
+            if self._checkpoint:
+                self._checkpoint.close()
+
+        if self._checkpoint:
+            self._checkpoint.remove()
+        return success
+
+    def _generate_piece_sizes(self, layout, torrents, progress):
+        # Read blocks that fit evenly into every piece size and feed each block
+        # into one SHA1 stream per piece size
+        block_size = math.gcd(*(torrent.piece_size for torrent in torrents))
+        blocks = Layout(layout.filepaths, layout.sizes, block_size)
+        streams = [_PieceStream(torrent.piece_size) for torrent in torrents]
+        reader = self._get_reader(blocks, range(blocks.pieces))
+        buffers = _BufferPool(block_size, count=2)
+        pending = ()
+        previous_buffer = None
+        pieces_reported = 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(streams), self._threads)) as pool:
+                for block_index in range(blocks.pieces):
+                    # Read next block while the previous block is being hashed
+                    buffer = buffers.acquire()
+                    block = memoryview(buffer)[:reader.read_piece_into(block_index, memoryview(buffer))]
+                    for future in pending:
+                        future.result()
+                    if previous_buffer is not None:
+                        buffers.release(previous_buffer)
+                    pending = [pool.submit(stream.update, block) for stream in streams]
+                    previous_buffer = buffer
+
+                    pieces_done = len(streams[0].hashes)
+                    if pieces_done > pieces_reported:
+                        filepath = blocks.get_filepath(block_index)
+                        if progress.advance(pieces_done - pieces_reported, filepath=filepath):
+                            return False
+                        pieces_reported = pieces_done
+                for future in pending:
+                    future.result()
+        finally:
+            reader.close()
+            buffers.log_stats()
+
+        for stream in streams:
+            stream.finish()
+        progress.advance(len(streams[0].hashes) - pieces_reported, filepath=layout.filepaths[-1])
+        for torrent, stream in zip(torrents, streams):
+            torrent.metainfo['info']['pieces'] = b''.join(stream.hashes)
+        return True
+
+    def _iter_hashes(self, layout, piece_indexes, skip=()):
+        # Read pieces sequentially, hash them in parallel and yield
+        # `(piece_index, piece_hash, exception)` tuples in order; pieces in
+        # `skip` are not read and their hash is `None`
+        if self._processes:
+            yield from self._iter_hashes_in_processes(layout, piece_indexes, skip)
+            return
+
+        hardlinks = self._get_hardlinks(layout)
+        aliases = hardlinks.get_unread_aliases(piece_indexes, skip) if hardlinks else set()
+        reader = self._get_reader(layout, [i for i in piece_indexes if i not in skip and i not in aliases],
+                                  hardlink_cache=hardlinks and hardlinks.cache)
+        if self._auto_threads:
+            tuner = _ThreadTuner(maximum=self._threads)
+        else:
+            tuner = None
+        threads = tuner.maximum if tuner else self._threads
+        # imap_ordered() processes up to `threads * 2` items ahead plus the one
+        # that is being read
+        buffers = _BufferPool(layout.piece_size, count=threads * 2 + 1)
+        # Hashes of pieces that are also needed for other pieces or the
+        # exception that prevented reading them
+        futures = {}
+
+        def read_pieces():
+            # Read each piece into a buffer from the pool, which is released
+            # by hash_piece()
+            for piece_index in piece_indexes:
+                if piece_index in skip:
+                    yield piece_index, None, 0
+                    continue
+                if piece_index in aliases:
+                    hardlinks.add_alias(layout, piece_index)
+                    yield piece_index, futures[hardlinks.aliases[piece_index]], 0
+                    continue
+                buffer = buffers.acquire()
+                try:
+                    length = reader.read_piece_into(piece_index, memoryview(buffer))
+                except torf.TorfError as e:
+                    buffers.release(buffer)
+                    if hardlinks and piece_index in hardlinks.originals:
+                        futures[piece_index] = e
+                    yield piece_index, e, 0
+                else:
+                    if hardlinks and piece_index in hardlinks.originals:
+                        futures[piece_index] = concurrent.futures.Future()
+                    yield piece_index, buffer, length
+
+        def hash_piece(item):
+            piece_index, data, length = item
+            if isinstance(data, concurrent.futures.Future):
+                # Same piece as an earlier piece that was submitted before
+                return data.result()
+            elif isinstance(data, bytearray):
+                try:
+                    with tuner.run(length) if tuner else contextlib.nullcontext():
+                        piece_hash = hashlib.sha1(memoryview(data)[:length]).digest()
+                finally:
+                    buffers.release(data)
+                if piece_index in futures:
+                    futures[piece_index].set_result(piece_hash)
+                return piece_hash
+
+        try:
+            for (piece_index, data, _), future in _utils.imap_ordered(hash_piece, read_pieces(),
+                                                                      workers=threads):
+                exception = data if isinstance(data, torf.TorfError) else None
+                yield piece_index, future.result(), exception
+        finally:
+            reader.close()
+            buffers.log_stats()
+            if tuner:
+                self.stats['Tuned Threads'] = tuner.best
+            if hardlinks:
+                hardlinks.report(self.stats)
+
+    def _iter_hashes_in_processes(self, layout, piece_indexes, skip):
+        # Read pieces into free slots of a shared memory ring buffer and let
+        # worker processes hash them in place
+        slots = max(2, min(self._processes * 2, RING_BUFFER_SIZE // layout.piece_size))
+        piece_indexes = list(piece_indexes)
+        hardlinks = self._get_hardlinks(layout)
+        aliases = hardlinks.get_unread_aliases(piece_indexes, skip) if hardlinks else set()
+        reader = self._get_reader(layout, [i for i in piece_indexes if i not in skip and i not in aliases],
+                                  hardlink_cache=hardlinks and hardlinks.cache)
+        pool = None
+        free_slots = list(range(slots))
+        pending = collections.deque()
+        results = {}
+        # Pieces that are waiting for the hash of an identical piece and
+        # results of pieces that are identical to later pieces
+        waiting = {}
+        original_results = {}
+        piece_indexes = iter(piece_indexes)
+        exhausted = False
+        try:
+            pool = _ProcessPool(self._processes, slot_size=layout.piece_size, slots=slots)
+            while True:
+                while free_slots and not exhausted:
+                    piece_index = next(piece_indexes, None)
+                    if piece_index is None:
+                        exhausted = True
+                        break
+                    pending.append(piece_index)
+                    if piece_index in skip:
+                        results[piece_index] = (None, None)
+                        continue
+                    if piece_index in aliases:
+                        hardlinks.add_alias(layout, piece_index)
+                        original = hardlinks.aliases[piece_index]
+                        if original in waiting:
+                            waiting[original].append(piece_index)
+                        else:
+                            results[piece_index] = original_results[original]
+                        continue
+                    slot = free_slots.pop()
+                    try:
+                        with pool.get_slot(slot) as view:
+                            length = reader.read_piece_into(piece_index, view)
+                    except torf.TorfError as e:
+                        # The traceback references views of the shared memory,
+                        # which can't be closed while they exist
+                        e = _without_traceback(e)
+                        free_slots.append(slot)
+                        results[piece_index] = (None, e)
+                        if hardlinks and piece_index in hardlinks.originals:
+                            original_results[piece_index] = (None, e)
+                    else:
+                        pool.submit(slot, piece_index, length)
+                        if hardlinks and piece_index in hardlinks.originals:
+                            waiting[piece_index] = []
+
+                # Yield pieces in order as soon as they are available
+                while pending and pending[0] in results:
+                    piece_index = pending.popleft()
+                    yield (piece_index, *results.pop(piece_index))
+
+                if not pending and exhausted:
+                    break
+                elif pending:
+                    slot, piece_index, piece_hash = pool.get_result()
+                    free_slots.append(slot)
+                    results[piece_index] = (piece_hash, None)
+                    if piece_index in waiting:
+                        original_results[piece_index] = (piece_hash, None)
+                        for alias in waiting.pop(piece_index):
+                            results[alias] = (piece_hash, None)
+        finally:
+            if pool:
+                pool.close()
+            reader.close()
+            if hardlinks:
+                hardlinks.report(self.stats)
+
+    def _get_read_order(self, layout, piece_indexes):
+        if self._physical_order:
+            piece_indexes, method = get_read_order(layout, piece_indexes)
+            self.stats['Read Order'] = method
+        return piece_indexes
+
+    def _get_hardlinks(self, layout):
+        if self._hardlinks:
+            return _Hardlinks(layout, max_size=HARDLINK_CACHE_SIZE)
+
+    def _get_reader(self, layout, piece_indexes, hardlink_cache=None):
+        # Return reader for `piece_indexes`, which must be read in that order
+        reader = None
+        if self._parallel_devices:
+            devices = [_utils.get_device(filepath) for filepath in layout.filepaths]
+            if len(set(devices)) > 1:
+                self.device_throughput.clear()
+                reader = _DeviceReader(layout, devices, piece_indexes, queue_size=self._threads * 2,
+                                       cache_policy=self._cache_policy, hardlink_cache=hardlink_cache,
+                                       rate_limiter=self._rate_limiter,
+                                       throughput=self.device_throughput, stats=self.stats)
+        if reader is None:
+            reader = _get_file_reader(layout, self._cache_policy, hardlink_cache, self._rate_limiter)
+        if self._max_memory:
+            reader = _Prefetcher(reader, layout, piece_indexes, max_memory=self._max_memory, stats=self.stats)
+        return reader
+
+    @staticmethod
+    def _get_file_errors(layout, pieces):
+        # Return mapping of piece indexes to exceptions for files that are
+        # missing or have the wrong size and the indexes of all their pieces;
+        # each exception is mapped to the first piece of its file in `pieces`
+        file_errors = collections.defaultdict(list)
+        bad_pieces = set()
+        for file_index, (filepath, size) in enumerate(zip(layout.filepaths, layout.sizes)):
+            try:
+                actual_size = os.stat(filepath).st_size
+            except OSError as e:
+                exception = torf.ReadError(e.errno, filepath)
+            else:
+                if actual_size == size:
+                    continue
+                exception = torf.VerifyFileSizeError(filepath, actual_size, size)
+            piece_indexes = layout.get_piece_indexes(file_index)
+            first_piece_index = layout.get_first_piece_index(file_index)
+            if first_piece_index not in pieces:
+                first_piece_index = next((i for i in piece_indexes if i in pieces), None)
+            if first_piece_index is not None:
+                file_errors[first_piece_index].append(exception)
+            bad_pieces.update(piece_indexes)
+        return dict(file_errors), bad_pieces
+
+    def _get_resumed_hashes(self, layout, identities, exclude):
+        if self._checkpoint:
+            resumed = {piece_index: piece_hash
+                       for piece_index, piece_hash in self._checkpoint.load(layout, identities).items()
+                       if piece_index not in exclude}
+            self.stats['Resumed Pieces'] = f'{len(resumed)} of {layout.pieces}'
+            return resumed
+        return {}
+
+    def _get_sparse_hashes(self, layout, exclude):
+        # Pieces that are entirely in holes of sparse files only contain zeros
+        if self._sparse:
+            data_ranges = [_get_data_ranges(filepath) if size else []
+                           for filepath, size in zip(layout.filepaths, layout.sizes)]
+            sparse = {}
+            for piece_index in range(layout.pieces):
+                if piece_index not in exclude:
+                    segments = layout.get_segments(piece_index)
+                    if all(_is_hole(data_ranges[file_index], offset, length)
+                           for file_index, offset, length in segments):
+                        sparse[piece_index] = _get_zeros_hash(sum(length for _, _, length in segments))
+            self.stats['Sparse Pieces'] = f'{len(sparse)} of {layout.pieces}'
+            return sparse
+        return {}
+
+    def _start_checkpoint(self, layout, identities, hashes):
+        if self._checkpoint:
+            self._checkpoint.start(layout, identities, hashes)
+
+    def _get_cached_hashes(self, layout, identities, exclude):
+        if self._cache:
+            keys = {self._cache.get_key(layout, i, identities): i
+                    for i in range(layout.pieces) if i not in exclude}
+            cached = self._cache.get(keys)
+            self.stats['Cache'] = f'{self._cache.hits} hits, {self._cache.misses} misses'
+            return ((keys[key], piece_hash) for key, piece_hash in cached.items())
+        return ()
+
+    def _fill_cache(self, layout, identities, hashes):
+        if self._cache:
+            # Don't cache pieces from files that changed while we were reading
+            new_identities = layout.get_identities()
+            items = []
+            for piece_index, piece_hash in hashes.items():
+                file_indexes = [file_index for file_index, _, _ in layout.get_segments(piece_index)]
+                if all(new_identities[i] == identities[i] for i in file_indexes):
+                    key = self._cache.get_key(layout, piece_index, new_identities)
+                    items.append((key, piece_hash))
+            self._cache.put(items)
+
+
+class Layout:
+    """
+    Map pieces to files
+
+    :param filepaths: Sequence of file system paths in torrent order
+    :param sizes: Sequence of file sizes
+    :param int piece_size: Piece size
+    """
+
+    def __init__(self, filepaths, sizes, piece_size):
+        self.filepaths = tuple(filepaths)
+        self.sizes = tuple(sizes)
+        self.piece_size = piece_size
+        self.offsets = tuple(itertools.accumulate(self.sizes, initial=0))[:-1]
+        self.size = sum(self.sizes)
+        self.pieces = math.ceil(self.size / piece_size) if piece_size else 0
+
+    @classmethod
+    def from_content_path(cls, torrent, path):
+        """Return layout of `torrent`'s files in `path`, which may have a different name"""
+        return cls(
+            filepaths=[os.sep.join((str(path), *f.parts[1:])) for f in torrent.files],
+            sizes=[f.size for f in torrent.files],
+            piece_size=torrent.piece_size,
+        )
+
+    def get_segments(self, piece_index):
+        """Return list of `(file_index, file_offset, length)` tuples that make up a piece"""
+        start = piece_index * self.piece_size
+        end = min(start + self.piece_size, self.size)
+        file_index = bisect.bisect_right(self.offsets, start) - 1
+        segments = []
+        while start < end:
+            file_end = self.offsets[file_index] + self.sizes[file_index]
+            length = min(end, file_end) - start
+            if length > 0:
+                segments.append((file_index, start - self.offsets[file_index], length))
+                start += length
+            file_index += 1
+        return segments
+
+    def get_piece_indexes(self, file_index):
+        """Return range of piece indexes that contain any bytes of a file"""
+        start = self.offsets[file_index]
+        end = start + self.sizes[file_index]
+        return range(start // self.piece_size, math.ceil(end / self.piece_size) if end > start else 0)
+
+    def get_first_piece_index(self, file_index):
+        """Return index of the first piece of a file or, for empty files, the piece at its offset"""
+        piece_indexes = self.get_piece_indexes(file_index)
+        if piece_indexes:
+            return piece_indexes[0]
+        return min(self.offsets[file_index] // self.piece_size, self.pieces - 1)
+
+    def get_filepath(self, piece_index):
+        """Return file system path of the last file in a piece"""
+        return self.filepaths[self.get_segments(piece_index)[-1][0]]
+
+    def get_identities(self):
+        """
+        Return `(device, inode, size, mtime_ns)` tuple for each file
+
+        Files that can't be accessed get `None`.
+        """
+        identities = []
+        for filepath in self.filepaths:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                identities.append(None)
+            else:
+                identities.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+        return identities
+
+
+class _FileReader:
+    """
+    Read pieces from files, keeping the current file open
+
+    :param str cache_policy: One of :data:`_config.CACHE_POLICIES` except for
+        ``"direct"`` (see :class:`_DirectFileReader`)
+    :param hardlink_cache: :class:`_HardlinkCache` instance or `None`
+    :param rate_limiter: :class:`_RateLimiter` instance or `None`
+    """
+
+    def __init__(self, layout, cache_policy='keep', hardlink_cache=None, rate_limiter=None):
+        self._layout = layout
+        self._cache_policy = cache_policy
+        self._hardlink_cache = hardlink_cache
+        self._rate_limiter = rate_limiter
+        self._file_index = None
+        self._fh = None
+
+    def read_piece_into(self, piece_index, buffer):
+        # Read piece into writable `buffer` without copying and return its length
+        pos = 0
+        for file_index, offset, length in self._layout.get_segments(piece_index):
+            self._readinto_segment(file_index, offset, buffer[pos:pos + length])
+            pos += length
+        return pos
+
+    def read_segment(self, file_index, offset, length):
+        """Return `length` bytes at `offset` from the file at `file_index`"""
+        if self._hardlink_cache:
+            data = bytearray(length)
+            self._readinto_segment(file_index, offset, memoryview(data))
+            return data
+        if self._rate_limiter:
+            self._rate_limiter.consume(length)
+        return self._read(file_index, offset, length)
+
+    def _readinto_segment(self, file_index, offset, view):
+        # Get data of hard-linked files from memory if possible
+        if self._hardlink_cache and self._hardlink_cache.readinto(file_index, offset, view):
+            return
+        if self._rate_limiter:
+            self._rate_limiter.consume(len(view))
+        self._readinto(file_index, offset, view)
+        if self._hardlink_cache:
+            self._hardlink_cache.store(file_index, offset, view)
+
+    def _read(self, file_index, offset, length):
+        filepath = self._layout.filepaths[file_index]
+        try:
+            self._seek(file_index, offset)
+            data = self._fh.read(length)
+            self._drop(offset, length)
+        except OSError as e:
+            raise torf.ReadError(e.errno, filepath)
+        if len(data) != length:
+            raise torf.ReadError(0, filepath)
+        return data
+
+    def _readinto(self, file_index, offset, view):
+        filepath = self._layout.filepaths[file_index]
+        try:
+            self._seek(file_index, offset)
+            length = len(view)
+            while view:
+                bytes_read = self._fh.readinto(view)
+                if not bytes_read:
+                    raise torf.ReadError(0, filepath)
+                view = view[bytes_read:]
+            self._drop(offset, length)
+        except OSError as e:
+            raise torf.ReadError(e.errno, filepath)
+
+    def _seek(self, file_index, offset):
+        if file_index != self._file_index:
+            self.close()
+            self._fh = open(self._layout.filepaths[file_index], 'rb')
+            self._file_index = file_index
+            if self._cache_policy in ('sequential', 'drop'):
+                _fadvise(self._fh.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+        if self._fh.tell() != offset:
+            self._fh.seek(offset)
+
+    def _drop(self, offset, length):
+        # Remove hashed data from page cache
+        if self._cache_policy == 'drop':
+            _fadvise(self._fh.fileno(), offset, length, 'POSIX_FADV_DONTNEED')
+
+    def close(self):
+        if self._fh is not None:
+            if self._cache_policy == 'drop':
+                # Also remove anything the kernel has read ahead
+                _fadvise(self._fh.fileno(), 0, 0, 'POSIX_FADV_DONTNEED')
+            self._fh.close()
+            self._fh = None
+            self._file_index = None
+
+
+class _DirectFileReader(_FileReader):
+    """
+    Read pieces with ``O_DIRECT`` so the page cache isn't used at all
+
+    Reads are aligned to :attr:`ALIGNMENT` and go into a reusable page-aligned
+    buffer. Files on file systems that don't support ``O_DIRECT`` are read
+    normally and removed from the page cache afterwards.
+    """
+
+    ALIGNMENT = 4096
+
+    def __init__(self, layout, hardlink_cache=None, rate_limiter=None):
+        super().__init__(layout, cache_policy='direct', hardlink_cache=hardlink_cache, rate_limiter=rate_limiter)
+        self._fd = None
+        self._direct = False
+        self._buffer = mmap.mmap(-1, self.ALIGNMENT)
+
+    def _read(self, file_index, offset, length):
+        data = bytearray(length)
+        self._readinto(file_index, offset, memoryview(data))
+        return data
+
+    def _readinto(self, file_index, offset, view):
+        filepath = self._layout.filepaths[file_index]
+        start = offset - offset % self.ALIGNMENT
+        end = offset + len(view)
+        size = -(-(end - start) // self.ALIGNMENT) * self.ALIGNMENT
+        if len(self._buffer) < size:
+            self._buffer.close()
+            self._buffer = mmap.mmap(-1, size)
+        try:
+            self._open(file_index)
+            with memoryview(self._buffer) as buffer:
+                bytes_read = os.preadv(self._fd, [buffer[:size]], start)
+                if bytes_read < end - start:
+                    raise torf.ReadError(0, filepath)
+                view[:] = buffer[offset - start:end - start]
+            if not self._direct:
+                _fadvise(self._fd, offset, len(view), 'POSIX_FADV_DONTNEED')
+        except OSError as e:
+            raise torf.ReadError(e.errno, filepath)
+
+    def _open(self, file_index):
+        if file_index != self._file_index:
+            self.close()
+            filepath = self._layout.filepaths[file_index]
+            try:
+                self._fd = os.open(filepath, os.O_RDONLY | os.O_DIRECT)
+                self._direct = True
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self._fd = os.open(filepath, os.O_RDONLY)
+                self._direct = False
+            self._file_index = file_index
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._file_index = None
+
+
+def _get_file_reader(layout, cache_policy, hardlink_cache=None, rate_limiter=None):
+    if cache_policy == 'direct':
+        return _DirectFileReader(layout, hardlink_cache=hardlink_cache, rate_limiter=rate_limiter)
+    return _FileReader(layout, cache_policy=cache_policy, hardlink_cache=hardlink_cache,
+                       rate_limiter=rate_limiter)
+
+
+def _fadvise(fd, offset, length, advice):
+    # posix_fadvise() is not available on all platforms and it's only advice
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+class _DeviceReader:
+    """
+    Read pieces from files on multiple devices at the same time
+
+    Each device gets a thread that reads the device's segments of all pieces
+    in `piece_indexes` sequentially. :meth:`read_piece_into` puts pieces back
+    together from the segments of each device.
+
+    :param devices: Device ID for each file in `layout`
+    :param piece_indexes: Indexes of the pieces that are read in that order
+    :param int queue_size: How many segments to read ahead per device
+    :param str cache_policy: See :data:`_config.CACHE_POLICIES`
+    :param hardlink_cache: :class:`_HardlinkCache` instance or `None`
+    :param rate_limiter: :class:`_RateLimiter` instance or `None`
+    :param dict throughput: Updated with bytes per second per device name
+    :param dict stats: Gets ``Throughput`` of each device when closed
+    """
+
+    def __init__(self, layout, devices, piece_indexes, queue_size, cache_policy, hardlink_cache, rate_limiter,
+                 throughput, stats):
+        self._layout = layout
+        self._cache_policy = cache_policy
+        self._hardlink_cache = hardlink_cache
+        self._rate_limiter = rate_limiter
+        self._devices = devices
+        self._throughput = throughput
+        self._stats = stats
+        self._stop = threading.Event()
+        self._start_time = time.monotonic()
+        self._bytes_read = collections.Counter()
+
+        segments = collections.defaultdict(list)
+        for piece_index in piece_indexes:
+            for segment in layout.get_segments(piece_index):
+                segments[devices[segment[0]]].append(segment)
+        self._queues = {device: queue.Queue(maxsize=queue_size) for device in segments}
+        self._threads = [
+            threading.Thread(target=self._read_segments, args=(device, segments[device]), daemon=True)
+            for device in segments
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def read_piece_into(self, piece_index, buffer):
+        pos = 0
+        for part in self._get_parts(piece_index):
+            buffer[pos:pos + len(part)] = part
+            pos += len(part)
+        return pos
+
+    def _get_parts(self, piece_index):
+        # Get all segments, even after an error, to stay in sync with readers
+        parts = [self._queues[self._devices[file_index]].get()
+                 for file_index, _, _ in self._layout.get_segments(piece_index)]
+        for part in parts:
+            if isinstance(part, BaseException):
+                raise part
+        return parts
+
+    def _read_segments(self, device, segments):
+        reader = _get_file_reader(self._layout, self._cache_policy, self._hardlink_cache, self._rate_limiter)
+        name = self._get_device_name(device)
+        try:
+            for file_index, offset, length in segments:
+                try:
+                    data = reader.read_segment(file_index, offset, length)
+                except torf.TorfError as e:
+                    data = e
+                else:
+                    self._bytes_read[name] += length
+                    self._throughput[name] = self._bytes_read[name] / (time.monotonic() - self._start_time)
+                while not self._stop.is_set():
+                    try:
+                        self._queues[device].put(data, timeout=0.1)
+                    except queue.Full:
+                        pass
+                    else:
+                        break
+                else:
+                    return
+        finally:
+            reader.close()
+
+    @staticmethod
+    def _get_device_name(device):
+        if device is None:
+            return 'unknown'
+        return f'{os.major(device)}:{os.minor(device)}'
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        if self._throughput:
+            self._stats['Throughput'] = [
+                f'{name}: {_utils.bytes2string(rate, trailing_zeros=True)}/s'
+                for name, rate in sorted(self._throughput.items())
+            ]
+
+
+class _Hardlinks:
+    """
+    Find files that are the same file on disk (hard links or the same path)
+
+    :attr:`aliases` maps indexes of pieces to indexes of earlier pieces that
+    contain the same part of the same file. Other parts of these files are
+    served from :attr:`cache` after they were read once.
+
+    :param max_size: Maximum number of bytes in :attr:`cache`
+    """
+
+    def __init__(self, layout, max_size):
+        keys = {}
+        for file_index, identity in enumerate(layout.get_identities()):
+            if identity and layout.sizes[file_index] > 0:
+                keys[file_index] = identity[:2]
+        counts = collections.Counter(keys.values())
+        keys = {file_index: key for file_index, key in keys.items() if counts[key] > 1}
+
+        self.aliases = {}
+        first_pieces = {}
+        for piece_index in range(layout.pieces):
+            segments = layout.get_segments(piece_index)
+            if len(segments) == 1 and segments[0][0] in keys:
+                file_index, offset, length = segments[0]
+                signature = (keys[file_index], offset, length)
+                if signature in first_pieces:
+                    self.aliases[piece_index] = first_pieces[signature]
+                else:
+                    first_pieces[signature] = piece_index
+        self.originals = set(self.aliases.values())
+        self.cache = _HardlinkCache(layout, keys, max_size) if keys else None
+        self._files = len(keys)
+        self._bytes_saved = 0
+
+    def get_unread_aliases(self, piece_indexes, skip=()):
+        """
+        Return set of pieces that don't need to be read because their original
+        is read before them
+
+        Readers must be created without these pieces because they may read
+        ahead in a fixed order.
+
+        :param piece_indexes: Indexes of pieces in the order they are read
+        :param skip: Indexes of pieces that are not read
+        """
+        read = set()
+        unread = set()
+        for piece_index in piece_indexes:
+            if piece_index not in skip:
+                if self.aliases.get(piece_index) in read:
+                    unread.add(piece_index)
+                else:
+                    read.add(piece_index)
+        return unread
+
+    def add_alias(self, layout, piece_index):
+        """Count piece that doesn't need to be read"""
+        self._bytes_saved += sum(length for _, _, length in layout.get_segments(piece_index))
+
+    def report(self, stats):
+        if self._files:
+            bytes_saved = self._bytes_saved + self.cache.bytes_saved
+            stats['Hardlinks'] = f'{self._files} linked files, {_utils.bytes2string(bytes_saved)} saved'
+
+
+class _HardlinkCache:
+    """
+    Keep the content of linked files in memory after it was read once
+
+    :param keys: Mapping of file indexes to IDs of linked files
+    :param max_size: Maximum number of bytes kept in memory
+    """
+
+    def __init__(self, layout, keys, max_size):
+        self._sizes = layout.sizes
+        self._keys = keys
+        self._first_files = {}
+        for file_index, key in sorted(keys.items()):
+            self._first_files.setdefault(key, file_index)
+        self._max_size = max_size
+        self._contents = {}
+        self._bytes_stored = collections.Counter()
+        self._lock = threading.Lock()
+        self.bytes_saved = 0
+
+    def store(self, file_index, offset, data):
+        """Remember `data` read from the first of linked files"""
+        key = self._keys.get(file_index)
+        if key is not None and self._first_files[key] == file_index:
+            with self._lock:
+                if key not in self._contents:
+                    size = self._sizes[file_index]
+                    if size > self._max_size:
+                        return
+                    self._max_size -= size
+                    self._contents[key] = bytearray(size)
+                self._contents[key][offset:offset + len(data)] = data
+                self._bytes_stored[key] += len(data)
+
+    def readinto(self, file_index, offset, view):
+        """Copy content of another linked file into `view` if it was read completely"""
+        key = self._keys.get(file_index)
+        if key is not None and self._first_files[key] != file_index:
+            with self._lock:
+                if key in self._contents and self._bytes_stored[key] == self._sizes[file_index]:
+                    view[:] = memoryview(self._contents[key])[offset:offset + len(view)]
+                    self.bytes_saved += len(view)
+                    return True
+        return False
+
+
+class _RateLimiter:
+    """
+    Token bucket that limits reading to `rate` bytes per second
+
+    Reads are never split up. A read may take more tokens than there are, but
+    the next read has to wait until the bucket is no longer empty. Up to one
+    second worth of tokens can be saved up.
+    """
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = rate
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, length):
+        """Wait until `length` bytes may be read"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._last_time) * self._rate)
+            self._last_time = now
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0
+            self._tokens -= length
+        if delay:
+            time.sleep(delay)
+
+
+class _ThreadTuner:
+    """
+    Find the number of hashing threads with the highest throughput
+
+    Throughput is measured for :data:`TUNE_INTERVAL` seconds. Then a thread is
+    added or removed. If throughput got worse, the next change goes the other
+    way. The number of threads stays between 1 and `maximum`.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.threads = max(1, maximum // 2)
+        self._condition = threading.Condition()
+        self._running = 0
+        self._direction = 1
+        self._bytes = 0
+        self._start_time = time.monotonic()
+        self._last_throughput = None
+        self._throughputs = {}
+
+    @contextlib.contextmanager
+    def run(self, length):
+        """Wait until fewer than :attr:`threads` are hashing and hash `length` bytes"""
+        with self._condition:
+            while self._running >= self.threads:
+                self._condition.wait()
+            self._running += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._add(length)
+                self._condition.notify_all()
+
+    def _add(self, length):
+        self._bytes += length
+        now = time.monotonic()
+        elapsed = now - self._start_time
+        if elapsed >= TUNE_INTERVAL:
+            throughput = self._bytes / elapsed
+            self._throughputs[self.threads] = throughput
+            _log.debug('Hashing throughput with %d threads: %.0f B/s', self.threads, throughput)
+            if self._last_throughput is not None and throughput < self._last_throughput:
+                self._direction = -self._direction
+            self._last_throughput = throughput
+            threads = min(max(1, self.threads + self._direction), self.maximum)
+            if threads == self.threads:
+                # Bounce off the minimum or maximum
+                self._direction = -self._direction
+            self.threads = threads
+            self._bytes = 0
+            self._start_time = now
+
+    @property
+    def best(self):
+        """Number of threads with the highest measured throughput"""
+        if self._throughputs:
+            return max(self._throughputs, key=self._throughputs.get)
+        return self.threads
+
+
+class _BufferPool:
+    """
+    Reusable buffers for reading pieces with ``readinto()``
+
+    Up to `count` buffers of `size` bytes are allocated when they are needed.
+    After that, :meth:`acquire` blocks until a buffer is released.
+    """
+
+    def __init__(self, size, count):
+        self._size = size
+        self._count = count
+        self._free = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.allocations = 0
+        self.acquisitions = 0
+
+    def acquire(self):
+        with self._lock:
+            self.acquisitions += 1
+            if self._free.empty() and self.allocations < self._count:
+                self.allocations += 1
+                return bytearray(self._size)
+        return self._free.get()
+
+    def release(self, buffer):
+        self._free.put(buffer)
+
+    def log_stats(self):
+        _log.debug('Buffer pool: %d buffers of %d bytes allocated for %d reads',
+                   self.allocations, self._size, self.acquisitions)
+
+
+class _Prefetcher:
+    """
+    Read pieces in a background thread while previous pieces are hashed
+
+    :param reader: Reader that is used by the background thread
+    :param layout: :class:`Layout` instance
+    :param piece_indexes: Indexes of the pieces that are read in that order
+    :param int max_memory: Maximum number of bytes that are read ahead; one
+        piece is always read ahead
+    :param dict stats: Gets queue depth statistics when closed
+    """
+
+    def __init__(self, reader, layout, piece_indexes, max_memory, stats):
+        self._reader = reader
+        self._layout = layout
+        self._max_memory = max_memory
+        self._stats = stats
+        # Queued pieces plus the one that is being read
+        self._buffers = _BufferPool(layout.piece_size, count=max(1, max_memory // layout.piece_size) + 1)
+        self._queue = collections.deque()
+        self._bytes_queued = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._pieces_read = 0
+        self._depth_total = 0
+        self._depth_max = 0
+        self._stalls = 0
+        self._thread = threading.Thread(target=self._read_pieces, args=(list(piece_indexes),), daemon=True)
+        self._thread.start()
+
+    def read_piece_into(self, piece_index, buffer):
+        with self._condition:
+            depth = len(self._queue)
+            self._pieces_read += 1
+            self._depth_total += depth
+            self._depth_max = max(self._depth_max, depth)
+            if not depth:
+                self._stalls += 1
+            while not self._queue:
+                self._condition.wait()
+            queued_index, data, size = self._queue.popleft()
+            self._bytes_queued -= size
+            self._condition.notify_all()
+        assert queued_index == piece_index, f'Expected piece {queued_index}, not {piece_index}'
+        if isinstance(data, Exception):
+            raise data
+        buffer[:size] = memoryview(data)[:size]
+        self._buffers.release(data)
+        return size
+
+    def _read_pieces(self, piece_indexes):
+        for piece_index in piece_indexes:
+            size = sum(length for _, _, length in self._layout.get_segments(piece_index))
+            with self._condition:
+                while (not self._stopped and self._queue
+                       and self._bytes_queued + size > self._max_memory):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                self._bytes_queued += size
+            data = self._buffers.acquire()
+            try:
+                self._reader.read_piece_into(piece_index, memoryview(data))
+            except Exception as e:
+                self._buffers.release(data)
+                data = e
+            with self._condition:
+                self._queue.append((piece_index, data, size))
+                self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._reader.close()
+        self._buffers.log_stats()
+        if self._pieces_read:
+            self._stats['Prefetch Queue'] = (f'{self._depth_total / self._pieces_read:.1f} pieces on average, '
+                                             f'{self._depth_max} at most')
+            self._stats['Prefetch Stalls'] = f'{self._stalls} of {self._pieces_read} pieces'
+
+
+class _ProcessPool:
+    """
+    Worker processes that hash pieces in slots of a shared memory ring buffer
+
+    :param int processes: Number of worker processes
+    :param int slot_size: Maximum piece size
+    :param int slots: Number of pieces that fit into the ring buffer
+    """
+
+    def __init__(self, processes, slot_size, slots):
+        # multiprocessing is slow to import and rarely needed
+        import multiprocessing
+        from multiprocessing import shared_memory
+        self._slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_size * slots)
+        self._tasks = multiprocessing.SimpleQueue()
+        self._results = multiprocessing.Queue()
+        self._workers = [
+            multiprocessing.Process(target=_hash_slots, args=(self._shm.name, slot_size, self._tasks, self._results),
+                                    daemon=True)
+            for _ in range(processes)
+        ]
+        try:
+            for worker in self._workers:
+                worker.start()
+        except BaseException:
+            self.close()
+            raise
+
+    def get_slot(self, slot):
+        """Return writable memoryview of `slot`, which must be released after use"""
+        return self._shm.buf[slot * self._slot_size:(slot + 1) * self._slot_size]
+
+    def submit(self, slot, piece_index, length):
+        """Hash the first `length` bytes of `slot`"""
+        self._tasks.put((slot, piece_index, length))
+
+    def get_result(self):
+        """Wait for next hashed piece and return `(slot, piece_index, piece_hash)`"""
+        while True:
+            try:
+                return self._results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise _errors.Error('Hashing process died unexpectedly')
+
+    def close(self):
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self._workers:
+            if worker.pid is not None:
+                worker.join()
+        self._results.close()
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _without_traceback(exception):
+    # Remove tracebacks from `exception` and the exceptions it was raised from
+    e = exception
+    while e is not None:
+        e.__traceback__ = None
+        e = e.__cause__ or e.__context__
+    return exception
+
+
+def _hash_slots(shm_name, slot_size, tasks, results):
+    # Worker process of _ProcessPool; interrupting is the parent's job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        while True:
+            slot, piece_index, length = tasks.get()
+            start = slot * slot_size
+            with shm.buf[start:start + length] as piece:
+                piece_hash = hashlib.sha1(piece).digest()
+            results.put((slot, piece_index, piece_hash))
+    finally:
+        shm.close()
+
+
+class _PieceStream:
+    """Hash consecutive blocks of data that fit evenly into pieces"""
+
+    def __init__(self, piece_size):
+        self._piece_size = piece_size
+        self._hash = hashlib.sha1()
+        self._length = 0
+        self.hashes = []
+
+    def update(self, data):
+        self._hash.update(data)
+        self._length += len(data)
+        if self._length >= self._piece_size:
+            self.finish()
+
+    def finish(self):
+        if self._length > 0:
+            self.hashes.append(self._hash.digest())
+            self._hash = hashlib.sha1()
+            self._length = 0
+
+
+class _Progress:
+    """Call generate() callback at intervals and report cancellation"""
+
+    def __init__(self, callback, interval, torrent, pieces_total):
+        self._callback = callback
+        self._interval = interval
+        self._torrent = torrent
+        self._pieces_total = pieces_total
+        self._pieces_done = 0
+        self._last_call = -1
+
+    def advance(self, pieces, filepath):
+        self._pieces_done += pieces
+        if self._callback:
+            now = time.monotonic()
+            if self._pieces_done >= self._pieces_total or now - self._last_call >= self._interval:
+                self._last_call = now
+                return self._callback(self._torrent, filepath, self._pieces_done, self._pieces_total)
+
+
+class _VerifyProgress:
+    """Call verify() callback at intervals and report cancellation"""
+
+    def __init__(self, callback, interval, torrent, pieces_total):
+        self._callback = callback
+        self._interval = interval
+        self._torrent = torrent
+        self._pieces_total = pieces_total
+        self._pieces_done = 0
+        self._last_call = -1
+
+    def advance(self, piece_index, filepath, piece_hash, exceptions=()):
+        self._pieces_done += 1
+        if not self._callback:
+            if exceptions:
+                raise exceptions[0]
+            return
+
+        now = time.monotonic()
+        if exceptions or self._pieces_done >= self._pieces_total or now - self._last_call >= self._interval:
+            self._last_call = now
+            for exception in exceptions:
+                cancel = self._callback(self._torrent, _get_exception_path(exception),
+                                        self._pieces_done, self._pieces_total,
+                                        piece_index, piece_hash, exception)
+                if cancel is not None:
+                    return cancel
+            if not exceptions:
+                return self._callback(self._torrent, filepath,
+                                      self._pieces_done, self._pieces_total,
+                                      piece_index, piece_hash, None)
+
+    def fail(self, exception):
+        """Report `exception` that prevents verification and return `False`"""
+        if not self._callback:
+            raise exception
+        self._callback(self._torrent, _get_exception_path(exception),
+                       0, self._pieces_total, 0, None, exception)
+        return False
+
+
+class _ErrorCounter:
+    """Count reported errors up to `maximum` or forever if `maximum` is 0"""
+
+    def __init__(self, maximum):
+        self._maximum = maximum
+        self._count = 0
+
+    def add(self, exceptions):
+        """Count `exceptions` and return the ones that may be reported"""
+        if self._maximum:
+            exceptions = exceptions[:self._maximum - self._count]
+        self._count += len(exceptions)
+        return exceptions
+
+    def is_exceeded_by(self, file_errors):
+        """Whether `file_errors` alone reach the maximum"""
+        return bool(self._maximum) and sum(map(len, file_errors.values())) >= self._maximum
+
+    @property
+    def is_reached(self):
+        return bool(self._maximum) and self._count >= self._maximum
+
+    @property
+    def description(self):
+        return f'After {self._maximum} error{"s" if self._maximum != 1 else ""}'
+
+
+def _get_exception_path(exception):
+    return getattr(exception, 'filepath', getattr(exception, 'path', None))
+
+
+class Sample:
+    """
+    Reproducible random sample of pieces to verify
+
+    The first and last piece of each file are always included. The remaining
+    pieces up to `count` are picked randomly. If there are more first and last
+    pieces than `count`, the sample is bigger than `count`.
+
+    :param torrent: :class:`torf.Torrent` instance
+    :param int count: Number of pieces in the sample
+    :param str seed: Seed of the random number generator
+    """
+
+    def __init__(self, torrent, count, seed):
+        layout = Layout(
+            filepaths=[str(f) for f in torrent.files],
+            sizes=[f.size for f in torrent.files],
+            piece_size=torrent.piece_size,
+        )
+        boundaries = set()
+        for file_index in range(len(layout.filepaths)):
+            boundaries.add(layout.get_first_piece_index(file_index))
+            piece_indexes = layout.get_piece_indexes(file_index)
+            if piece_indexes:
+                boundaries.add(piece_indexes[-1])
+        others = [i for i in range(layout.pieces) if i not in boundaries]
+        picked = random.Random(seed).sample(others, k=min(len(others), max(0, count - len(boundaries))))
+        self.seed = seed
+        self.pieces_total = layout.pieces
+        self.piece_indexes = sorted(boundaries.union(picked))
+        self._others_total = len(others)
+        self._others_picked = len(picked)
+
+    def get_max_corrupt_pieces(self):
+        """
+        Return number of corrupt pieces that would most likely have been noticed
+
+        If the sample was verified successfully, fewer pieces than that are
+        corrupt with a confidence of :data:`SAMPLE_CONFIDENCE`. This is 0 if
+        every piece is in the sample.
+        """
+        total, picked = self._others_total, self._others_picked
+        if picked >= total:
+            return 0
+
+        def log_chance_of_missing(corrupt):
+            # Hypergeometric probability that none of `corrupt` pieces is picked
+            return (math.lgamma(total - corrupt + 1) - math.lgamma(total - corrupt - picked + 1)
+                    - math.lgamma(total + 1) + math.lgamma(total - picked + 1))
+
+        # Find the smallest number of corrupt pieces that is unlikely to be missed
+        max_log_chance = math.log(1 - SAMPLE_CONFIDENCE)
+        low, high = 1, total - picked + 1
+        while low < high:
+            middle = (low + high) // 2
+            if middle > total - picked or log_chance_of_missing(middle) <= max_log_chance:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+def get_changed_pieces(layout, old_identities, new_identities):
+    """
+    Return sorted list of indexes of pieces with files that have changed
+
+    Files with an identity of `None` are always considered changed.
+    """
+    if len(old_identities) != len(new_identities):
+        return list(range(layout.pieces))
+    piece_indexes = set()
+    for file_index, (old, new) in enumerate(zip(old_identities, new_identities)):
+        if old is None or old != new:
+            piece_indexes.add(layout.get_first_piece_index(file_index))
+            piece_indexes.update(layout.get_piece_indexes(file_index))
+    return sorted(piece_indexes)
+
+
+class VerifiedState:
+    """
+    SQLite database of torrents that were verified successfully
+
+    For each info hash and content path, the inode, size and modification time
+    of each file (see :meth:`Layout.get_identities`) is stored together with
+    the time of the verification. The device is not stored because it may
+    change when the system is restarted.
+
+    :param str filepath: Path to database file
+    """
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            try:
+                dirpath = os.path.dirname(self._filepath)
+                if dirpath:
+                    os.makedirs(dirpath, exist_ok=True)
+                self._db = sqlite3.connect(self._filepath, timeout=60)
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute('CREATE TABLE IF NOT EXISTS verified ('
+                                 'infohash TEXT NOT NULL, path TEXT NOT NULL, identities TEXT NOT NULL, '
+                                 'verified_at INTEGER NOT NULL, PRIMARY KEY (infohash, path))')
+            except (OSError, sqlite3.Error) as e:
+                self._raise(e)
+        return self._db
+
+    def _raise(self, exception):
+        msg = os.strerror(exception.errno) if isinstance(exception, OSError) else str(exception)
+        raise _errors.Error(f'{self._filepath}: {msg}')
+
+    def get(self, infohash, path):
+        """
+        Return `(identities, verified_at)` tuple from the last successful verification
+
+        `identities` is a list of `(inode, size, mtime_ns)` tuples or `None`
+        for each file and `verified_at` is a UNIX timestamp.
+
+        Return `None` if there was no successful verification.
+        """
+        db = self._connect()
+        try:
+            row = db.execute('SELECT identities, verified_at FROM verified WHERE infohash = ? AND path = ?',
+                             (infohash, os.path.abspath(path))).fetchone()
+        except sqlite3.Error as e:
+            self._raise(e)
+        if row:
+            identities = [None if identity is None else tuple(identity) for identity in json.loads(row[0])]
+            return identities, row[1]
+
+    def put(self, infohash, path, identities):
+        """
+        Store identities of files after a successful verification
+
+        :param identities: Identities as returned by
+            :meth:`Layout.get_identities`
+        """
+        db = self._connect()
+        try:
+            with db:
+                db.execute('INSERT OR REPLACE INTO verified (infohash, path, identities, verified_at) '
+                           'VALUES (?, ?, ?, ?)',
+                           (infohash, os.path.abspath(path),
+                            json.dumps(self.get_stored_identities(identities)), int(time.time())))
+        except sqlite3.Error as e:
+            self._raise(e)
+
+    @staticmethod
+    def get_stored_identities(identities):
+        """Remove device from `identities` as returned by :meth:`Layout.get_identities`"""
+        return [None if identity is None else tuple(identity[1:]) for identity in identities]
+
+
+class Checkpoint:
+    """
+    Piece hashes in a file so hashing can be resumed after it was interrupted
+
+    The file starts with a header that contains the piece size and the path,
+    size and identity (see :meth:`Layout.get_identities`) of each file. The
+    header is followed by one record per piece at the position of its piece
+    index, so pieces can be written in any order. A record is one byte that is
+    1 if the piece was hashed, followed by the piece hash. Records of pieces
+    that weren't hashed are zeros.
+
+    Hashes from files that don't have the same identity anymore are not used.
+
+    :param str filepath: Path to checkpoint file
+    """
+
+    MAGIC = b'torf checkpoint 1\n'
+    RECORD_SIZE = 21
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._fh = None
+        self._pending = {}
+        self._records_offset = 0
+        self._last_write = 0
+
+    def load(self, layout, identities):
+        """Return dictionary that maps piece indexes to still valid piece hashes"""
+        try:
+            with open(self._filepath, 'rb') as f:
+                if f.readline() != self.MAGIC:
+                    return {}
+                header = json.loads(f.readline())
+                records = f.read()
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            raise _errors.ReadError(f'{self._filepath}: {os.strerror(e.errno)}')
+        except ValueError:
+            # Incomplete header
+            return {}
+
+        # Checkpoint must be from the same files and piece size
+        if not isinstance(header, dict) or header != self._get_header(layout, header.get('identities')):
+            return {}
+        valid_files = [identity is not None and identity == tuple(old_identity or ())
+                       for identity, old_identity in zip(identities, header['identities'])]
+        hashes = {}
+        for piece_index in range(min(layout.pieces, len(records) // self.RECORD_SIZE)):
+            record = records[piece_index * self.RECORD_SIZE:(piece_index + 1) * self.RECORD_SIZE]
+            if record[0] == 1 and all(valid_files[file_index]
+                                      for file_index, _, _ in layout.get_segments(piece_index)):
+                hashes[piece_index] = record[1:]
+        return hashes
+
+    @staticmethod
+    def _get_header(layout, identities):
+        return {
+            'piece_size': layout.piece_size,
+            'filepaths': list(layout.filepaths),
+            'sizes': list(layout.sizes),
+            'identities': identities,
+        }
+
+    def start(self, layout, identities, hashes):
+        """
+        Replace any existing checkpoint with one that contains `hashes`
+
+        The existing checkpoint is only replaced after `hashes` are written so
+        they are not lost if we are killed.
+
+        :param dict hashes: Piece indexes mapped to piece hashes
+        """
+        header = self.MAGIC + json.dumps(self._get_header(layout, identities)).encode('utf-8') + b'\n'
+        records = bytearray(self.RECORD_SIZE * (max(hashes) + 1 if hashes else 0))
+        for piece_index, piece_hash in hashes.items():
+            offset = piece_index * self.RECORD_SIZE
+            records[offset:offset + self.RECORD_SIZE] = self._get_record(piece_hash)
+        _utils.write_file_atomic(self._filepath, header + records)
+        try:
+            self._fh = open(self._filepath, 'r+b')
+        except OSError as e:
+            raise _errors.WriteError(f'{self._filepath}: {os.strerror(e.errno)}')
+        self._pending = {}
+        self._records_offset = len(header)
+        self._last_write = time.monotonic()
+
+    def _get_record(self, piece_hash):
+        return b'\x01' + piece_hash if piece_hash else bytes(self.RECORD_SIZE)
+
+    def add(self, piece_index, piece_hash):
+        """Remember hash of piece or `None` if the piece could not be hashed"""
+        self._pending[piece_index] = piece_hash
+        if time.monotonic() - self._last_write >= CHECKPOINT_INTERVAL:
+            self.write()
+
+    def write(self):
+        """Write all added pieces to disk"""
+        if self._pending and self._fh:
+            try:
+                for piece_index in sorted(self._pending):
+                    self._fh.seek(self._records_offset + piece_index * self.RECORD_SIZE)
+                    self._fh.write(self._get_record(self._pending[piece_index]))
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+            except OSError as e:
+                raise _errors.WriteError(f'{self._filepath}: {os.strerror(e.errno)}')
+            self._pending = {}
+        self._last_write = time.monotonic()
+
+    def close(self):
+        """Write remaining pieces and close file"""
+        if self._fh:
+            try:
+                self.write()
+            finally:
+                self._fh.close()
+                self._fh = None
+
+    def remove(self):
+        """Close and delete file"""
+        self.close()
+        try:
+            os.unlink(self._filepath)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise _errors.WriteError(f'{self._filepath}: {os.strerror(e.errno)}')
+
+
+class PieceCache:
+    """
+    SQLite database of piece hashes keyed by file identity
+
+    A piece is identified by the piece size and by the device, inode, size,
+    modification time, offset and length of each file segment in it. If any
+    of that changes, the piece is hashed again.
+
+    SQLite handles concurrent access from multiple processes. The least
+    recently used entries are removed when the database gets bigger than
+    `max_size`.
+
+    :param str filepath: Path to database file
+    :param int max_size: Approximate maximum size of the database in bytes
+    """
+
+    # Approximate number of bytes per entry, including index and page overhead
+    ENTRY_SIZE = 100
+
+    def __init__(self, filepath, max_size):
+        self._filepath = filepath
+        self._max_entries = max(1, int(max_size / self.ENTRY_SIZE))
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self._db is None:
+            try:
+                dirpath = os.path.dirname(self._filepath)
+                if dirpath:
+                    os.makedirs(dirpath, exist_ok=True)
+                self._db = sqlite3.connect(self._filepath, timeout=60)
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute('CREATE TABLE IF NOT EXISTS pieces ('
+                                 'key BLOB PRIMARY KEY, hash BLOB NOT NULL, last_used INTEGER NOT NULL)')
+                self._db.execute('CREATE INDEX IF NOT EXISTS pieces_last_used ON pieces (last_used)')
+            except (OSError, sqlite3.Error) as e:
+                self._raise(e)
+        return self._db
+
+    def _raise(self, exception):
+        msg = os.strerror(exception.errno) if isinstance(exception, OSError) else str(exception)
+        raise _errors.Error(f'{self._filepath}: {msg}')
+
+    @staticmethod
+    def get_key(layout, piece_index, identities):
+        """Return unique key of a piece or `None` if any of its files is inaccessible"""
+        segments = []
+        for file_index, offset, length in layout.get_segments(piece_index):
+            identity = identities[file_index]
+            if identity is None:
+                return None
+            segments.append((*identity, offset, length))
+        return hashlib.sha1(repr((layout.piece_size, segments)).encode()).digest()
+
+    def get(self, keys):
+        """Return dictionary that maps each known key in `keys` to a piece hash"""
+        keys = [key for key in keys if key is not None]
+        db = self._connect()
+        found = {}
+        try:
+            with db:
+                for chunk in _chunks(keys, 500):
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = db.execute(f'SELECT key, hash FROM pieces WHERE key IN ({placeholders})', chunk)
+                    found.update(rows)
+                    db.execute(f'UPDATE pieces SET last_used = ? WHERE key IN ({placeholders})',
+                               (time.time_ns(), *chunk))
+        except sqlite3.Error as e:
+            self._raise(e)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, items):
+        """Store `(key, piece_hash)` tuples and remove least recently used entries"""
+        db = self._connect()
+        now = time.time_ns()
+        try:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO pieces (key, hash, last_used) VALUES (?, ?, ?)',
+                               ((key, piece_hash, now) for key, piece_hash in items if key is not None))
+                count = db.execute('SELECT COUNT(*) FROM pieces').fetchone()[0]
+                if count > self._max_entries:
+                    db.execute('DELETE FROM pieces WHERE key IN '
+                               '(SELECT key FROM pieces ORDER BY last_used LIMIT ?)',
+                               (count - self._max_entries,))
+        except sqlite3.Error as e:
+            self._raise(e)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -10,11 +10,16 @@
 # http://www.gnu.org/licenses/gpl-3.0.txt
 
 import datetime
+import fnmatch
+import math
 import os.path
+import random
+import re
+import threading
 
 import torf
 
-from . import _config, _errors, _utils, _vars
+from . import _config, _errors, _hash, _utils, _vars
 
 # Seconds between progress updates
 PROGRESS_INTERVAL = 0.5
@@ -27,16 +32,40 @@ def run(ui):
     elif cfg['version']:
         print(_config.VERSION_TEXT)
     else:
+        # Threads and processes that read and hash inherit these; with --serve,
+        # this includes the threads that run jobs
+        _utils.set_scheduling(nice=cfg['nice'], ionice=cfg['ionice'], cpus=cfg['cpus'])
+        if cfg['serve']:
+            from . import _server
+            return _server.serve(ui, cfg)
+
         # Figure out our modus operandi
-        if cfg['PATH'] and not cfg['in']:
+        is_input = cfg['in'] or cfg['in_from']
+        is_edit = (
+            # Create new torrent file
+            cfg['out'] or cfg['inplace']
+            # Create new magnet URI
+            or cfg['name'] or cfg['tracker'] or cfg['webseed']
+            or cfg['notracker'] or cfg['nowebseed']
+        )
+        if cfg['verify_from']:
+            if cfg['PATHS'] or is_input:
+                raise _errors.CliError('--verify-from cannot be combined with PATH or --in')
+            return _batch_verify_mode(ui, cfg)
+        elif cfg['profile_cfgs'] and is_input:
+            raise _errors.CliError('--each-profile can only be used to create torrents')
+        elif cfg['batch']:
+            if not is_input:
+                return _batch_create_mode(ui, cfg)
+            elif cfg['PATH']:
+                raise _errors.CliError('Multiple torrents can only be created, displayed or edited')
+            elif is_edit:
+                return _batch_edit_mode(ui, cfg)
+            else:
+                return _batch_info_mode(ui, cfg)
+        elif cfg['PATH'] and not cfg['in']:
             return _create_mode(ui, cfg)
-        elif cfg['in'] and (
-                # Create new torrent file
-                cfg['out']
-                # Create new magnet URI
-                or cfg['name'] or cfg['tracker'] or cfg['webseed']
-                or cfg['notracker'] or cfg['nowebseed']
-        ):
+        elif cfg['in'] and is_edit:
             return _edit_mode(ui, cfg)
         elif not cfg['PATH'] and not cfg['out'] and cfg['in']:
             return _info_mode(ui, cfg)
@@ -48,6 +77,41 @@ def run(ui):
 
 def _info_mode(ui, cfg):
     torrent = _utils.get_torrent(cfg, ui)
+    _show_info(ui, cfg, torrent)
+    return torrent
+
+def _batch_info_mode(ui, cfg):
+    # Read torrents in parallel but report them in the original order, one
+    # after the other, so output is deterministic
+    # Errors are returned with the torrent so they are reported in the right
+    # record
+    def read_torrent(torrent_input):
+        warnings = []
+        return _utils.get_torrent({**cfg, 'in': torrent_input}, ui, errors=warnings), warnings
+
+    jobs_total = 0
+    errors = []
+    inputs = _utils.get_batch_inputs(cfg)
+    workers = cfg['threads'] or _utils.get_cpu_count()
+    for torrent_input, future in _utils.imap_ordered(read_torrent, inputs, workers=workers):
+        jobs_total += 1
+        torrent = None
+        try:
+            torrent, warnings = future.result()
+            for warning in warnings:
+                ui.error(warning, exit=False)
+            _show_info(ui, cfg, torrent)
+            ui.info('Torrent', torrent_input)
+        except _errors.Error as e:
+            # Report error and continue with the next torrent
+            ui.error(e, exit=False)
+            errors.append(e)
+        ui.flush(torrent)
+
+    if errors:
+        raise _get_batch_error(errors, jobs_total)
+
+def _show_info(ui, cfg, torrent):
     ui.show_torrent(torrent)
     if not cfg['nomagnet']:
         try:
@@ -57,9 +121,81 @@ def _info_mode(ui, cfg):
                 raise _errors.Error(e)
             else:
                 ui.warn(_errors.Error(e))
-    return torrent
 
 def _create_mode(ui, cfg):
+    if cfg['profile_cfgs'] or len(cfg['piece_sizes']) > 1:
+        return _multi_create_mode(ui, cfg)
+
+    torrent = _get_new_torrent(cfg)
+    torrent_filepath = _utils.get_torrent_filepath(torrent, cfg)
+    ui.check_output_file_exists(torrent_filepath)
+    ui.show_torrent(torrent)
+    _hash_pieces(
+        ui=ui,
+        torrent=torrent,
+        reuse_paths=cfg['reuse'] if not cfg['noreuse'] else (),
+        threads=cfg['threads'],
+        hasher=_hash.get_hasher(cfg, checkpoint_path=_get_checkpoint_path(torrent_filepath, cfg)),
+    )
+    _write_torrent(ui, torrent, cfg)
+    return torrent
+
+def _multi_create_mode(ui, cfg):
+    # --out is the directory where all torrent files are written to
+    if not cfg['notorrent'] and cfg['out'] and not os.path.isdir(cfg['out']):
+        raise _errors.WriteError(f'{cfg["out"]}: Not a directory')
+
+    # Create one torrent per profile and piece size
+    jobs = []
+    for job_cfg in cfg['profile_cfgs'] or [cfg]:
+        job_cfg = {**job_cfg, 'PATH': cfg['PATH'], 'batch': True}
+        for piece_size in job_cfg['piece_sizes'] or [None]:
+            jobs.append((_get_new_torrent(job_cfg, piece_size=piece_size), job_cfg))
+
+    # Make sure we can write before we start hashing
+    for torrent, job_cfg in jobs:
+        ui.check_output_file_exists(_utils.get_torrent_filepath(torrent, job_cfg))
+
+    # Content is only read once for each distinct file list; all piece sizes
+    # are hashed in the same pass and torrents with the same files and piece
+    # size get a copy of the piece hashes
+    hashed = []
+    for i, (torrent, job_cfg) in enumerate(jobs):
+        if i > 0:
+            ui.flush(jobs[i - 1][0])
+        if cfg['profile_cfgs']:
+            ui.info('Profile', job_cfg['profile'][0])
+        ui.show_torrent(torrent)
+        # Torrents that were hashed together with a previous piece size are
+        # ready and show_torrent() already reported their info hash
+        if not torrent.is_ready:
+            for other in hashed:
+                if other.files == torrent.files and other.piece_size == torrent.piece_size:
+                    torrent.metainfo['info']['pieces'] = other.metainfo['info']['pieces']
+                    try:
+                        ui.info('Info Hash', torrent.infohash)
+                    except torf.TorfError as e:
+                        raise _errors.Error(e)
+                    break
+            else:
+                siblings = {}
+                for other, _ in jobs:
+                    if other.files == torrent.files and other.piece_size != torrent.piece_size:
+                        siblings.setdefault(other.piece_size, other)
+                _hash_pieces(
+                    ui=ui,
+                    torrent=torrent,
+                    reuse_paths=job_cfg['reuse'] if not job_cfg['noreuse'] else (),
+                    threads=job_cfg['threads'],
+                    hasher=_hash.get_hasher(job_cfg),
+                    siblings=tuple(siblings.values()),
+                )
+                hashed.append(torrent)
+                hashed.extend(siblings.values())
+        _write_torrent(ui, torrent, job_cfg)
+    return jobs[-1][0]
+
+def _get_new_torrent(cfg, piece_size=None):
     trackers = [tier.split(',') for tier in cfg['tracker']]
     try:
         torrent = torf.Torrent(
@@ -88,75 +224,65 @@ def _create_mode(ui, cfg):
     else:
         torrent.creation_date = datetime.datetime.now()
 
+    if piece_size is None and cfg['piece_sizes']:
+        piece_size = cfg['piece_sizes'][0]
+    if piece_size:
+        try:
+            torrent.piece_size = piece_size
+        except torf.TorfError as e:
+            raise _errors.Error(e)
+
     # Apply custom JSON objects from --merge
     _customize_torrent(torrent, cfg)
-
-    ui.check_output_file_exists(_utils.get_torrent_filepath(torrent, cfg))
-    ui.show_torrent(torrent)
-    _hash_pieces(
-        ui=ui,
-        torrent=torrent,
-        reuse_paths=cfg['reuse'] if not cfg['noreuse'] else (),
-        threads=cfg['threads'],
-    )
-    _write_torrent(ui, torrent, cfg)
     return torrent
 
+def _batch_create_mode(ui, cfg):
+    # --out is the directory where all torrent files are written to
+    if not cfg['notorrent'] and cfg['out'] and not os.path.isdir(cfg['out']):
+        raise _errors.WriteError(f'{cfg["out"]}: Not a directory')
+
+    # Create one torrent after the other in this process so we only pay for
+    # startup and configuration once. Each job gets the same number of hashing
+    # threads, which keeps the total number of threads bounded by --threads.
+    paths = _utils.get_batch_paths(cfg)
+    errors = []
+    for path in paths:
+        torrent = None
+        try:
+            torrent = _create_mode(ui, {**cfg, 'PATH': path})
+        except _errors.Error as e:
+            # Report error and continue with the next job
+            ui.error(e, exit=False)
+            errors.append(e)
+        ui.flush(torrent)
+
+    if errors:
+        raise _get_batch_error(errors, len(paths))
+
+def _get_batch_error(errors, jobs_total):
+    # Use the exit code of the errors if they all share the same code
+    codes = {e.exit_code for e in errors}
+    code = codes.pop() if len(codes) == 1 else _errors.Code.GENERIC
+    return _errors.Error(f'{len(errors)} of {jobs_total} jobs failed', code=code)
+
 def _edit_mode(ui, cfg):
+    _check_inplace(cfg)
     torrent = _utils.get_torrent(cfg, ui)
 
     # Make sure we can write before we start editing
-    ui.check_output_file_exists(_utils.get_torrent_filepath(torrent, cfg))
+    if not cfg['inplace']:
+        ui.check_output_file_exists(_utils.get_torrent_filepath(torrent, cfg))
 
     # Make changes according to CLI args
-    def set_or_remove(arg_name, attr_name):
-        if cfg.get('no' + arg_name):
-            setattr(torrent, attr_name, None)
-        elif cfg[arg_name]:
-            try:
-                setattr(torrent, attr_name, cfg[arg_name])
-            except torf.TorfError as e:
-                raise _errors.Error(e)
-    set_or_remove('comment', 'comment')
-    set_or_remove('private', 'private')
-    set_or_remove('source', 'source')
-    set_or_remove('xseed', 'randomize_infohash')
-
-    def list_set_or_remove(arg_name, attr_name, split_values_at=None):
-        if cfg.get('no' + arg_name):
-            setattr(torrent, attr_name, None)
-        if cfg[arg_name]:
-            old_list = getattr(torrent, attr_name) or []
-            if split_values_at is not None:
-                add_list = [tier.split(split_values_at) for tier in cfg[arg_name]]
-            else:
-                add_list = cfg[arg_name]
-            new_list = old_list + add_list
-            try:
-                setattr(torrent, attr_name, new_list)
-            except torf.TorfError as e:
-                raise _errors.Error(e)
-    list_set_or_remove('tracker', 'trackers', split_values_at=',')
-    list_set_or_remove('webseed', 'webseeds')
-
-    if cfg['nocreator']:
-        torrent.created_by = None
-    elif cfg['creator']:
-        torrent.created_by = cfg['creator']
-
-    if cfg['nodate']:
-        torrent.creation_date = None
-    elif cfg['date']:
-        torrent.creation_date = cfg['date']
-
-    # Apply custom JSON objects from --merge
-    _customize_torrent(torrent, cfg)
+    _edit_torrent(torrent, cfg)
 
     if cfg['PATH']:
-        list_set_or_remove('exclude', 'exclude_globs')
-        list_set_or_remove('exclude_regex', 'exclude_regexs')
-        list_set_or_remove('include', 'include_globs')
-        list_set_or_remove('include_regex', 'include_regexs')
+        # Remember the old file list so we can copy hashes of unchanged pieces
+        old_files, old_hashes, old_piece_size = tuple(torrent.files), torrent.hashes, torrent.piece_size
+        _list_set_or_remove(torrent, cfg, 'exclude', 'exclude_globs')
+        _list_set_or_remove(torrent, cfg, 'exclude_regex', 'exclude_regexs')
+        _list_set_or_remove(torrent, cfg, 'include', 'include_globs')
+        _list_set_or_remove(torrent, cfg, 'include_regex', 'include_regexs')
         try:
             torrent.path = cfg['PATH']
         except torf.TorfError as e:
@@ -166,8 +292,18 @@ def _edit_mode(ui, cfg):
             # custom name after setting path
             if cfg['name']:
                 torrent.name = cfg['name']
+            known_hashes = {}
+            if not cfg['noreuse'] and old_hashes and old_piece_size:
+                known_hashes = _hash.get_unchanged_hashes(old_files, old_hashes, torrent.files, old_piece_size)
+            if known_hashes:
+                # Unchanged pieces are only useful if the piece size stays the same
+                try:
+                    torrent.piece_size = old_piece_size
+                except torf.TorfError:
+                    known_hashes = {}
             ui.show_torrent(torrent)
-            _hash_pieces(ui, torrent)
+            _hash_pieces(ui, torrent, threads=cfg['threads'],
+                         hasher=_hash.get_hasher(cfg, known_hashes=known_hashes))
     else:
         if cfg['name']:
             torrent.name = cfg['name']
@@ -175,12 +311,161 @@ def _edit_mode(ui, cfg):
     _write_torrent(ui, torrent, cfg)
     return torrent
 
+def _batch_edit_mode(ui, cfg):
+    # --out is the directory where all torrent files are written to
+    if cfg['out'] and not os.path.isdir(cfg['out']):
+        raise _errors.WriteError(f'{cfg["out"]}: Not a directory')
+
+    # Output files that are written by this run; another torrent with the same
+    # file name would replace them, even with --yes
+    claimed_filepaths = set()
+    claimed_lock = threading.Lock()
+
+    def edit_torrent(torrent_input):
+        jobcfg = {**cfg, 'in': torrent_input}
+        _check_inplace(jobcfg)
+        warnings = []
+        torrent = _utils.get_torrent(jobcfg, ui, errors=warnings)
+        try:
+            orig_data = torrent.dump(validate=False)
+        except torf.TorfError as e:
+            raise _errors.Error(e)
+
+        # Only change what the user asked for. In particular, ['info'] is not
+        # touched unless explicitly requested so the info hash stays the same
+        # and no content is read.
+        _edit_torrent(torrent, jobcfg)
+        if cfg['name']:
+            torrent.name = cfg['name']
+
+        filepath = _utils.get_torrent_filepath(torrent, jobcfg)
+        try:
+            data = torrent.dump(validate=cfg['validate'])
+            infohash = torrent.infohash
+        except torf.TorfError as e:
+            raise _errors.Error(e)
+
+        is_changed = data != orig_data
+        # torrent_input may also be a magnet URI
+        try:
+            is_inplace = (
+                os.path.isfile(torrent_input)
+                and os.path.exists(filepath)
+                and os.path.samefile(filepath, torrent_input)
+            )
+        except OSError as e:
+            raise _errors.Error(e)
+        # Checking and claiming must be atomic because edit_torrent() runs in
+        # multiple threads
+        with claimed_lock:
+            claimed_filepath = os.path.realpath(filepath)
+            if claimed_filepath in claimed_filepaths:
+                raise _errors.WriteError(f'{filepath}: File exists')
+            elif os.path.exists(filepath) and not is_inplace and not cfg['yes']:
+                raise _errors.WriteError(f'{filepath}: File exists')
+            claimed_filepaths.add(claimed_filepath)
+        if not is_inplace or is_changed:
+            # Don't rewrite identical file
+            _utils.write_file_atomic(filepath, data)
+        return torrent, infohash, filepath, is_changed, warnings
+
+    # Edit torrents in parallel and report them in the original order
+    jobs_total = 0
+    errors = []
+    inputs = _utils.get_batch_inputs(cfg)
+    workers = cfg['threads'] or _utils.get_cpu_count()
+    for torrent_input, future in _utils.imap_ordered(edit_torrent, inputs, workers=workers):
+        jobs_total += 1
+        torrent = None
+        try:
+            torrent, infohash, filepath, is_changed, warnings = future.result()
+        except _errors.Error as e:
+            # Report error and continue with the next torrent
+            ui.error(e, exit=False)
+            errors.append(e)
+        else:
+            for warning in warnings:
+                ui.error(warning, exit=False)
+            ui.info('Name', torrent.name)
+            ui.info('Info Hash', infohash)
+            ui.info('Torrent', filepath)
+            ui.info('Changed', 'yes' if is_changed else 'no')
+        ui.flush(torrent)
+
+    if errors:
+        raise _get_batch_error(errors, jobs_total)
+
+def _check_inplace(cfg):
+    if cfg['inplace'] and not os.path.isfile(cfg['in']):
+        raise _errors.CliError(f'{cfg["in"]}: --inplace requires a torrent file as INPUT')
+
+def _edit_torrent(torrent, cfg):
+    # Apply metainfo changes from CLI args that don't require any content
+    _set_or_remove(torrent, cfg, 'comment', 'comment')
+    _set_or_remove(torrent, cfg, 'private', 'private')
+    _set_or_remove(torrent, cfg, 'source', 'source')
+    _set_or_remove(torrent, cfg, 'xseed', 'randomize_infohash')
+    _list_set_or_remove(torrent, cfg, 'tracker', 'trackers', split_values_at=',')
+    _list_set_or_remove(torrent, cfg, 'webseed', 'webseeds')
+
+    if cfg['nocreator']:
+        torrent.created_by = None
+    elif cfg['creator']:
+        torrent.created_by = cfg['creator']
+
+    if cfg['nodate']:
+        torrent.creation_date = None
+    elif cfg['date']:
+        torrent.creation_date = cfg['date']
+
+    # Apply custom JSON objects from --merge
+    _customize_torrent(torrent, cfg)
+
+def _set_or_remove(torrent, cfg, arg_name, attr_name):
+    if cfg.get('no' + arg_name):
+        setattr(torrent, attr_name, None)
+    elif cfg[arg_name]:
+        try:
+            setattr(torrent, attr_name, cfg[arg_name])
+        except torf.TorfError as e:
+            raise _errors.Error(e)
+
+def _list_set_or_remove(torrent, cfg, arg_name, attr_name, split_values_at=None):
+    if cfg.get('no' + arg_name):
+        setattr(torrent, attr_name, None)
+    if cfg[arg_name]:
+        old_list = getattr(torrent, attr_name) or []
+        if split_values_at is not None:
+            add_list = [tier.split(split_values_at) for tier in cfg[arg_name]]
+        else:
+            add_list = cfg[arg_name]
+        new_list = old_list + add_list
+        try:
+            setattr(torrent, attr_name, new_list)
+        except torf.TorfError as e:
+            raise _errors.Error(e)
+
 def _verify_mode(ui, cfg):
+    if cfg['resume'] and not os.path.isfile(cfg['in']):
+        raise _errors.CliError(f'{cfg["in"]}: --resume requires a torrent file as INPUT')
+
+    # Each of these options decides which pieces are verified
+    piece_options = [option for option, is_given in (
+        ('--resume', cfg['resume']),
+        ('--quick', cfg['quick']),
+        ('--sample', cfg['sample']),
+        ('--sample-pieces', cfg['sample_pieces']),
+        ('--only' if cfg['only'] else '--only-regex', cfg['only'] or cfg['only_regex']),
+    ) if is_given]
+    if len(piece_options) > 1:
+        raise _errors.CliError(f'{piece_options[0]} cannot be combined with {piece_options[1]}')
+
     torrent = _utils.get_torrent(cfg, ui)
-    # Append torrent's name to path if it ends with "/"
-    path = cfg['PATH']
-    if path[-1] == os.path.sep:
-        path = os.path.join(path, torrent.metainfo['info'].get('name', ''))
+    path = _get_verify_path(torrent, cfg['PATH'])
+    # Unlike torf, our own hasher reports errors in piece order when hashing
+    # in multiple threads
+    hasher = (_hash.get_hasher(cfg, checkpoint_path=_get_checkpoint_path(cfg['in'], cfg))
+              or _hash.Hasher(threads=cfg['threads']))
 
     ui.show_torrent(torrent)
     ui.info('Path', path)
@@ -190,11 +475,31 @@ def _verify_mode(ui, cfg):
     except torf.TorfError as e:
         raise _errors.Error(e)
 
+    sample = _get_sample(torrent, cfg, seed=_get_sample_seed(cfg))
+    if sample:
+        _show_sample(ui, sample)
+        piece_indexes = sample.piece_indexes
+    elif cfg['only'] or cfg['only_regex']:
+        piece_indexes = _get_matching_pieces(ui, cfg, torrent, path)
+    else:
+        piece_indexes = None
+
+    # Remember file identities before reading anything so that changes during
+    # verification are noticed next time
+    if cfg['quick']:
+        verified_state = _hash.VerifiedState(cfg['quick_file'])
+        layout = _hash.Layout.from_content_path(torrent, path)
+        identities = layout.get_identities()
+        piece_indexes = _get_changed_pieces(ui, verified_state, torrent, path, layout, identities)
+
     with ui.StatusReporter() as sr:
         try:
-            success = torrent.verify(path,
-                                     callback=sr.verify_callback,
-                                     interval=PROGRESS_INTERVAL)
+            sr.device_throughput = hasher.device_throughput
+            success = hasher.verify(torrent, path,
+                                    callback=sr.verify_callback,
+                                    interval=PROGRESS_INTERVAL,
+                                    max_errors=cfg['max_errors'],
+                                    pieces=piece_indexes)
         except torf.TorfError as e:
             raise _errors.Error(e)
         except KeyboardInterrupt:
@@ -202,24 +507,190 @@ def _verify_mode(ui, cfg):
             raise
         else:
             sr.keep_progress_summary()
+            for key, value in hasher.stats.items():
+                ui.info(key, value)
             if not success:
                 raise _errors.VerifyError(content=cfg['PATH'], torrent=cfg['in'])
+            elif sample:
+                ui.info('Confidence', _get_sample_confidence(sample))
+            elif cfg['quick']:
+                verified_state.put(torrent.infohash, path, identities)
     return torrent
 
-def _hash_pieces(ui, torrent, reuse_paths=None, threads=0):
+def _batch_verify_mode(ui, cfg):
+    for option, is_given in (
+        ('--resume', cfg['resume']),
+        ('--quick', cfg['quick']),
+        ('--only' if cfg['only'] else '--only-regex', cfg['only'] or cfg['only_regex']),
+    ):
+        if is_given:
+            raise _errors.CliError(f'{option} cannot be combined with --verify-from')
+
+    jobs = _utils.read_manifest(cfg['verify_from'])
+    cancelled = threading.Event()
+    # All torrents are sampled with the same seed so the run can be repeated
+    sample_seed = _get_sample_seed(cfg)
+
+    def verify(job):
+        torrent_filepath, path = job
+        warnings = []
+        torrent = _utils.get_torrent({**cfg, 'in': torrent_filepath}, ui, errors=warnings)
+        sample = _get_sample(torrent, cfg, seed=sample_seed)
+        exceptions = []
+
+        def callback(torrent, filepath, pieces_done, pieces_total, piece_index, piece_hash, exception):
+            if exception:
+                exceptions.append(exception)
+            if cancelled.is_set():
+                return True
+
+        try:
+            infohash = torrent.infohash
+            hasher = _hash.get_hasher(cfg) or _hash.Hasher(threads=cfg['threads'])
+            success = hasher.verify(torrent, _get_verify_path(torrent, path),
+                                    callback=callback,
+                                    interval=PROGRESS_INTERVAL,
+                                    max_errors=cfg['max_errors'],
+                                    pieces=sample.piece_indexes if sample else None)
+        except torf.TorfError as e:
+            raise _errors.Error(e)
+        return torrent, infohash, success, exceptions, sample, warnings
+
+    # Verify torrents on different devices in parallel and report results in
+    # the order of the manifest
+    items = (
+        (_utils.get_device(path), (torrent_filepath, path))
+        for torrent_filepath, path in jobs
+    )
+    errors = []
+    try:
+        for (torrent_filepath, path), future in _utils.imap_per_device(verify, items,
+                                                                       device_jobs=cfg['device_jobs']):
+            ui.info('Torrent', torrent_filepath)
+            ui.info('Path', path)
+            torrent = None
+            try:
+                torrent, infohash, success, exceptions, sample, warnings = future.result()
+            except _errors.Error as e:
+                # Report error and continue with the next torrent
+                ui.error(e, exit=False)
+                errors.append(e)
+            else:
+                for warning in warnings:
+                    ui.error(warning, exit=False)
+                ui.info('Info Hash', infohash)
+                if sample:
+                    _show_sample(ui, sample)
+                for exception in exceptions:
+                    ui.info('Error', str(exception))
+                ui.info('Verified', 'yes' if success else 'no')
+                if success and sample:
+                    ui.info('Confidence', _get_sample_confidence(sample))
+                if not success:
+                    e = _errors.VerifyError(content=path, torrent=torrent_filepath)
+                    ui.error(e, exit=False)
+                    errors.append(e)
+            ui.flush(torrent)
+    except KeyboardInterrupt:
+        cancelled.set()
+        raise
+
+    if errors:
+        raise _get_batch_error(errors, len(jobs))
+
+def _get_sample_seed(cfg):
+    # Random seed unless the user wants to repeat a previous sample
+    if cfg['sample'] or cfg['sample_pieces']:
+        return cfg['sample_seed'] or str(random.randrange(2**32))
+
+def _get_sample(torrent, cfg, seed):
+    # Return random sample of pieces to verify or `None` to verify all pieces
+    if cfg['sample'] or cfg['sample_pieces']:
+        count = cfg['sample_pieces'] or math.ceil(cfg['sample'] * torrent.pieces)
+        return _hash.Sample(torrent, count, seed=seed)
+
+def _show_sample(ui, sample):
+    ui.info('Sample', f'{len(sample.piece_indexes)} of {sample.pieces_total} pieces')
+    ui.info('Sample Seed', sample.seed)
+
+def _get_sample_confidence(sample):
+    max_corrupt_pieces = sample.get_max_corrupt_pieces()
+    if not max_corrupt_pieces:
+        return 'All pieces verified'
+    return (f'{_hash.SAMPLE_CONFIDENCE:.0%} that fewer than {max_corrupt_pieces} pieces '
+            f'({max_corrupt_pieces / sample.pieces_total:.2%}) are corrupt')
+
+def _get_matching_pieces(ui, cfg, torrent, path):
+    # Return indexes of pieces with any bytes of files that match --only or
+    # --only-regex; pieces that are shared with other files must be verified too
+    regexs = [re.compile(regex) for regex in cfg['only_regex']]
+
+    def is_match(filepath):
+        return (any(fnmatch.fnmatch(filepath.casefold(), glob.casefold()) for glob in cfg['only'])
+                or any(regex.search(filepath) for regex in regexs))
+
+    layout = _hash.Layout.from_content_path(torrent, path)
+    file_indexes = [i for i, file in enumerate(torrent.files) if is_match(str(file))]
+    if not file_indexes:
+        raise _errors.CliError('No files match --only or --only-regex')
+    piece_indexes = set()
+    for file_index in file_indexes:
+        piece_indexes.add(layout.get_first_piece_index(file_index))
+        piece_indexes.update(layout.get_piece_indexes(file_index))
+    ui.info('Selected Files', f'{len(file_indexes)} of {len(torrent.files)}')
+    ui.info('Selected Pieces', f'{len(piece_indexes)} of {torrent.pieces}')
+    return sorted(piece_indexes)
+
+def _get_changed_pieces(ui, verified_state, torrent, path, layout, identities):
+    # Return indexes of pieces in files that changed since the last successful
+    # verification or `None` to verify all pieces
+    record = verified_state.get(torrent.infohash, path)
+    if record is None:
+        ui.info('Last Verified', 'never')
+        return None
+    old_identities, verified_at = record
+    piece_indexes = _hash.get_changed_pieces(layout, old_identities,
+                                             verified_state.get_stored_identities(identities))
+    ui.info('Last Verified', datetime.datetime.fromtimestamp(verified_at).isoformat(sep=' ', timespec='seconds'))
+    ui.info('Changed Pieces', f'{len(piece_indexes)} of {torrent.pieces}')
+    return piece_indexes
+
+def _get_checkpoint_path(filepath, cfg):
+    # Checkpoint file is stored next to the torrent file
+    if cfg['resume']:
+        return f'{filepath}.checkpoint'
+
+def _get_verify_path(torrent, path):
+    # Append torrent's name to path if it ends with "/"
+    if path[-1] == os.path.sep:
+        path = os.path.join(path, torrent.metainfo['info'].get('name', ''))
+    return path
+
+def _hash_pieces(ui, torrent, reuse_paths=None, threads=0, hasher=None, siblings=()):
+    # `siblings` are torrents with the same files but different piece sizes
+    # that are hashed in the same read pass
+    if siblings and not hasher:
+        hasher = _hash.Hasher(threads=threads)
     with ui.StatusReporter() as sr:
         try:
             # Try reusing existing torrent and generate() if that fails
             success = False
-            if reuse_paths and torrent.files:
+            if reuse_paths and torrent.files and not siblings:
                 success = torrent.reuse(reuse_paths,
                                         callback=sr.reuse_callback,
                                         interval=PROGRESS_INTERVAL)
             if not success:
                 sr.reset()
-                success = torrent.generate(callback=sr.generate_callback,
-                                           interval=PROGRESS_INTERVAL,
-                                           threads=threads or None)
+                if hasher:
+                    sr.device_throughput = hasher.device_throughput
+                    success = hasher.generate(torrent,
+                                              callback=sr.generate_callback,
+                                              interval=PROGRESS_INTERVAL,
+                                              siblings=siblings)
+                else:
+                    success = torrent.generate(callback=sr.generate_callback,
+                                               interval=PROGRESS_INTERVAL,
+                                               threads=threads or _utils.get_cpu_count())
         except torf.TorfError as e:
             raise _errors.Error(e)
         except KeyboardInterrupt:
@@ -227,6 +698,9 @@ def _hash_pieces(ui, torrent, reuse_paths=None, threads=0):
             raise
         else:
             sr.keep_progress_summary()
+            if hasher:
+                for key, value in hasher.stats.items():
+                    ui.info(key, value)
             if success:
                 try:
                     ui.info('Info Hash', torrent.infohash)
@@ -0,0 +1,298 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details
+# http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+Job server that listens on a Unix domain socket
+
+Clients send one JSON object per line and get one JSON object per line back.
+Requests are processed in the order they are sent on a connection.
+Connections are processed concurrently.
+
+Requests:
+
+    {"command": "health"}
+    {"command": "metrics"}
+    {"command": "run", "args": ["path/to/content", "--private"], "cfg": {...}}
+
+"args" are command line arguments that are parsed like any other command line
+(including config file and profiles). "cfg" optionally overrides values in the
+resulting configuration.
+
+A "run" request produces any number of "progress" and "record" events followed
+by a "result" event:
+
+    {"event": "progress", "job": 1, "fraction_done": 0.5, ...}
+    {"event": "record", "job": 1, "info": {...}}
+    {"event": "result", "job": 1, "exit_code": 0, "info": {...}}
+"""
+
+import errno
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from . import _config, _errors, _main, _ui, _utils, _vars
+
+# The argument parser is global and changes itself while parsing
+_parse_lock = threading.Lock()
+
+# Scheduling options are applied to the server and inherited by all jobs
+_NO_SCHEDULING = {'nice': 0, 'ionice': None, 'cpus': None}
+
+
+def serve(ui, cfg):
+    """Process jobs from clients until SIGINT or SIGTERM"""
+    socket_path = cfg['serve']
+    _remove_stale_socket(socket_path)
+    server = _Server(socket_path, scheduling={key: cfg[key] for key in _NO_SCHEDULING})
+    ui.info('Socket', socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
+
+def _remove_stale_socket(socket_path):
+    # Remove socket file from previous server that didn't shut down cleanly
+    if os.path.exists(socket_path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+        except OSError as e:
+            raise _errors.WriteError(f'{socket_path}: {os.strerror(e.errno)}')
+        else:
+            raise _errors.WriteError(f'{socket_path}: {os.strerror(errno.EADDRINUSE)}')
+        finally:
+            sock.close()
+
+
+class _Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._job_ids = itertools.count(1)
+        self.jobs_started = 0
+        self.jobs_running = 0
+        self.jobs_succeeded = 0
+        self.jobs_failed = 0
+
+    def job_started(self):
+        with self._lock:
+            self.jobs_started += 1
+            self.jobs_running += 1
+            return next(self._job_ids)
+
+    def job_finished(self, exit_code):
+        with self._lock:
+            self.jobs_running -= 1
+            if exit_code == 0:
+                self.jobs_succeeded += 1
+            else:
+                self.jobs_failed += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'uptime': round(time.monotonic() - self._start_time),
+                'jobs_started': self.jobs_started,
+                'jobs_running': self.jobs_running,
+                'jobs_succeeded': self.jobs_succeeded,
+                'jobs_failed': self.jobs_failed,
+            }
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, scheduling=_NO_SCHEDULING):
+        self.metrics = _Metrics()
+        self.scheduling = scheduling
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        except OSError as e:
+            raise _errors.WriteError(f'{socket_path}: {os.strerror(e.errno)}')
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError(f'Not a JSON object: {request}')
+            except ValueError as e:
+                self._send({'event': 'error', 'error': f'Invalid request: {e}'})
+                continue
+
+            command = request.get('command')
+            try:
+                if command == 'health':
+                    self._send({'event': 'health', 'status': 'ok', 'version': _vars.__version__})
+                elif command == 'metrics':
+                    self._send({'event': 'metrics', **self.server.metrics.as_dict()})
+                elif command == 'run':
+                    self._run(request)
+                else:
+                    self._send({'event': 'error', 'error': f'Unknown command: {command}'})
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away
+                return
+
+    def _send(self, event):
+        self.wfile.write(_utils.json_dumps(event, indent=None).encode('utf-8'))
+        self.wfile.flush()
+
+    def _run(self, request):
+        job_id = self.server.metrics.job_started()
+        exit_code = _errors.Code.GENERIC
+        try:
+            exit_code = _run_job(request, emit=lambda event: self._send({**event, 'job': job_id}),
+                                 scheduling=self.server.scheduling)
+        finally:
+            self.server.metrics.job_finished(exit_code)
+
+
+def _run_job(request, emit, scheduling=_NO_SCHEDULING):
+    """
+    Run job described by `request` and return exit code
+
+    :param scheduling: Scheduling options of the server; jobs can only use the
+        same ones
+    """
+    ui = _EventUI(emit, {'json': True})
+    torrent = None
+    exit_code = 0
+    try:
+        args = request.get('args', [])
+        if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+            raise _errors.CliError(f'Invalid args: {args}')
+        overrides = request.get('cfg', {})
+        if not isinstance(overrides, dict):
+            raise _errors.CliError(f'Invalid cfg: {overrides}')
+        with _parse_lock:
+            cfg = _config.get_cfg(args + _get_override_args(overrides))
+        # Niceness is relative and everything is inherited by the next job
+        # that runs in this thread, so scheduling can't be changed per job
+        for key, value in scheduling.items():
+            if cfg[key] not in (value, _NO_SCHEDULING[key]):
+                raise _errors.CliError(f'--{key} must be given to --serve')
+        ui.cfg = {
+            **cfg,
+            **_NO_SCHEDULING,
+            # Report everything as events and don't start another server
+            'json': True, 'metainfo': False, 'help': False, 'version': False, 'serve': '',
+        }
+        torrent = _main.run(ui)
+    except _errors.Error as e:
+        ui.error(e, exit=False)
+        exit_code = e.exit_code
+    except Exception as e:
+        ui.error(e, exit=False)
+        exit_code = _errors.Code.GENERIC
+    finally:
+        ui.terminate(torrent, exit_code=exit_code)
+    return exit_code
+
+
+def _get_override_args(overrides):
+    # Turn "cfg" of a job into command line arguments so they are validated
+    # like any other arguments
+    args = []
+    for name, value in overrides.items():
+        option = '--' + name.replace('_', '-')
+        if value is True:
+            args.append(option)
+        elif value is False or value is None:
+            pass
+        elif isinstance(value, (str, int, float)):
+            args.append(f'{option}={value}')
+        elif isinstance(value, list) and all(isinstance(item, str) for item in value):
+            args.extend(f'{option}={item}' for item in value)
+        else:
+            raise _errors.CliError(f'Invalid cfg: {name}: {value}')
+    return args
+
+
+class _EventUI(_ui.UI):
+    """UI that reports everything to a callable instead of stdout"""
+
+    def __init__(self, emit, cfg):
+        self._emit = emit
+        super().__init__(cfg)
+
+    @_ui.UI.cfg.setter
+    def cfg(self, cfg):
+        self._cfg = cfg
+        self._fmt = _EventFormatter(cfg, emit=self._emit)
+
+    def StatusReporter(self):
+        return _EventStatusReporter(self)
+
+    def terminate(self, torrent, exit_code=0):
+        self._fmt.terminate(torrent, exit_code=exit_code)
+
+
+class _EventFormatter(_ui._JSONFormatter):
+    def __init__(self, cfg, emit):
+        super().__init__(cfg)
+        self._emit = emit
+
+    def info(self, key, value, newline=None):
+        if key in ('Progress', 'Reuse') and isinstance(value, dict):
+            self._emit({'event': 'progress', **value})
+        else:
+            super().info(key, value, newline=newline)
+
+    def flush(self, torrent):
+        self._emit({'event': 'record', 'info': self._info})
+        self._info = {}
+        self._flushed = True
+
+    def terminate(self, torrent, exit_code=0):
+        self._emit({'event': 'result', 'exit_code': int(exit_code), 'info': self._info})
+
+
+class _EventStatusReporter(_ui._StatusReporterBase):
+    def _get_hashing_progress_lines(self, info):
+        return {
+            'fraction_done': info.fraction_done,
+            'pieces_done': info.items_done,
+            'pieces_total': info.items_total,
+            'time_elapsed': round(info.time_elapsed.total_seconds()),
+            'time_left': round(info.time_left.total_seconds()),
+            'eta': round(info.eta.timestamp()),
+            'throughput': round(info.throughput),
+            'filepath': str(info.filepath),
+            'device_throughput': {name: round(rate) for name, rate in info.device_throughput.items()},
+        }
+
+    def _get_reuse_progress_lines(self, info):
+        return {
+            'fraction_done': info.fraction_done,
+            'files_done': info.items_done,
+            'files_total': info.items_total,
+            'filepath': str(info.filepath),
+        }
+
+    def _format_error(self, exception, torrent):
+        return str(exception)
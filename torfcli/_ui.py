@@ -138,6 +138,10 @@ class UI:
                       not self._fmt.dialog_yes_no(f'{filepath}: Overwrite file?')):
                     raise err.WriteError(f'{filepath}: File exists')
 
+    def flush(self, torrent):
+        """Finish output about `torrent` when reporting on multiple torrents"""
+        self._fmt.flush(torrent)
+
     def terminate(self, torrent):
         fmt = getattr(self, '_fmt', None)
         if fmt:
@@ -154,6 +158,11 @@ class _FormatterBase:
     def httpseeds(self, torrent):
         return torrent.httpseeds
 
+    def flush(self, torrent):
+        # Separate multiple torrents with an empty line
+        sys.stdout.write('\n')
+        _utils.flush(sys.stdout)
+
     def terminate(self, torrent):
         pass
 
@@ -294,6 +303,7 @@ class _JSONFormatter(_MachineFormatter):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._info = {}
+        self._flushed = False
 
     def private(self, torrent):
         return torrent.private
@@ -315,16 +325,38 @@ class _JSONFormatter(_MachineFormatter):
         else:
             self._info[key] = value
 
-    def terminate(self, torrent):
-        sys.stdout.write(_utils.json_dumps(self._info))
+    def flush(self, torrent):
+        # Print one compact JSON object per line for multiple torrents
+        sys.stdout.write(_utils.json_dumps(self._info, indent=None))
         _utils.flush(sys.stdout)
+        self._info = {}
+        self._flushed = True
+
+    def terminate(self, torrent):
+        # Don't print empty object after flush()
+        if not self._flushed:
+            sys.stdout.write(_utils.json_dumps(self._info))
+            _utils.flush(sys.stdout)
+        elif self._info:
+            self.flush(torrent)
 
 
 class _MetainfoFormatter(_JSONFormatter):
     def info(self, key, value, newline=None):
         pass
 
+    def flush(self, torrent):
+        if torrent is not None:
+            sys.stdout.write(_utils.json_dumps(self._metainfo(torrent), indent=None))
+            _utils.flush(sys.stdout)
+        self._flushed = True
+
     def terminate(self, torrent):
+        if not self._flushed:
+            sys.stdout.write(_utils.json_dumps(self._metainfo(torrent)))
+            _utils.flush(sys.stdout)
+
+    def _metainfo(self, torrent):
         if torrent is None:
             mi = {}
         elif self._cfg['verbose'] <= 0:
@@ -336,13 +368,15 @@ class _MetainfoFormatter(_JSONFormatter):
         elif self._cfg['verbose'] >= 2:
             # Show all fields
             mi = _utils.metainfo(torrent.metainfo, all_fields=True, remove_pieces=False)
-        sys.stdout.write(_utils.json_dumps(mi))
-        _utils.flush(sys.stdout)
+        return mi
 
 
 class _StatusReporterBase():
     def __init__(self, ui):
         self._ui = ui
+        # Mapping of device names to bytes per second that is updated while
+        # hashing (see _hash.Hasher.device_throughput)
+        self.device_throughput = {}
         self.reset()
 
     def reset(self):
@@ -360,6 +394,7 @@ class _StatusReporterBase():
             time_elapsed=datetime.timedelta(0),
             time_total=datetime.timedelta(0),
             eta=datetime.datetime.now() + datetime.timedelta(300),
+            device_throughput={},
         )
 
     def __enter__(self):
@@ -420,6 +455,7 @@ class _StatusReporterBase():
     def _update_progress_info_hashing(self, torrent, filepath, pieces_done, pieces_total):
         self._update_progress_info_common(torrent, filepath, pieces_done, pieces_total)
         info = self._info
+        info.device_throughput = dict(self.device_throughput)
         if pieces_done < pieces_total:
             self._progress.add(pieces_done)
             # Make sure we have enough samples to make estimates
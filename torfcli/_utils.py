@@ -10,12 +10,18 @@
 # http://www.gnu.org/licenses/gpl-3.0.txt
 
 import base64
+import collections
+import concurrent.futures
 import contextlib
 import datetime
+import errno
+import glob
 import io
 import json
+import math
 import os
 import sys
+import tempfile
 import time
 from collections import abc
 
@@ -24,13 +30,17 @@ import torf
 from . import _errors
 
 
-def get_torrent(cfg, ui):
+def get_torrent(cfg, ui, errors=None):
     """
     Read --in parameter and return torf.Torrent instance
 
     The --in parameter may be the path to a torrent file, a magnet URI or "-".
     If "-", stdin is read and interpreted as the content of a torrent file or a
     magnet URI.
+
+    Errors that don't prevent getting a torrent (e.g. failing to download the
+    "info" section of a magnet URI) are reported via `ui` or, if `errors` is a
+    list, appended to it so they can be reported by another thread.
     """
     # Create torf.Torrent instance from INPUT
     if not cfg['in']:
@@ -52,7 +62,10 @@ def get_torrent(cfg, ui):
             # interested in a complete torrent, e.g. when editing a magnet URI
             if not cfg['notorrent']:
                 def callback(exc):
-                    ui.error(_errors.Error(exc), exit=False)
+                    if errors is None:
+                        ui.error(_errors.Error(exc), exit=False)
+                    else:
+                        errors.append(_errors.Error(exc))
                 magnet.get_info(callback=callback)
             torrent = magnet.torrent()
             torrent.created_by = None
@@ -77,7 +90,10 @@ def get_torrent(cfg, ui):
 
 def get_torrent_filepath(torrent, cfg):
     """Return the file path of the output torrent file"""
-    if cfg['out']:
+    if cfg.get('inplace'):
+        # Overwrite input torrent file
+        return cfg['in']
+    elif cfg['out'] and not cfg.get('batch'):
         # User-given torrent file path
         return cfg['out']
     else:
@@ -85,13 +101,340 @@ def get_torrent_filepath(torrent, cfg):
         profiles = cfg.get('profile', ())
         if profiles:
             filename += '.' + '.'.join(profiles)
-        return filename + '.torrent'
+        if len(cfg.get('piece_sizes', ())) > 1:
+            filename += '.' + bytes2string(torrent.piece_size).replace(' ', '')
+        filename += '.torrent'
+        if cfg['out']:
+            # User-given directory for multiple torrent files
+            return os.path.join(cfg['out'], filename)
+        else:
+            return filename
+
+
+def get_batch_paths(cfg):
+    """
+    Return sequence of content paths for batch creation
+
+    Every PATH is used as is unless --each is given, in which case every
+    subdirectory of every PATH is used.
+    """
+    if not cfg['each']:
+        return tuple(cfg['PATHS'])
+
+    paths = []
+    for path in cfg['PATHS']:
+        try:
+            subdirs = sorted(entry.path for entry in os.scandir(path) if entry.is_dir())
+        except OSError as e:
+            raise _errors.ReadError(f'{path}: {os.strerror(e.errno)}')
+        if not subdirs:
+            raise _errors.ReadError(f'{path}: No subdirectories')
+        paths.extend(subdirs)
+    return tuple(paths)
+
+
+def get_batch_inputs(cfg):
+    """
+    Yield torrent file paths or magnet URIs from --in and --in-from
+
+    Glob patterns, directories and --in-from are read lazily so we don't need
+    to keep millions of file paths in memory. Directories are searched
+    recursively for torrent files.
+
+    :raise ReadError: if a glob pattern or directory doesn't yield anything
+    """
+    for string in cfg['INS']:
+        if is_glob(string):
+            matches = glob.iglob(string, recursive=True)
+            error = f'{string}: {os.strerror(errno.ENOENT)}'
+        elif os.path.isdir(string):
+            matches = glob.iglob(os.path.join(glob.escape(string), '**', '*.torrent'), recursive=True)
+            error = f'{string}: No torrent files found'
+        else:
+            yield string
+            continue
+
+        found = False
+        for match in matches:
+            found = True
+            yield match
+        if not found:
+            raise _errors.ReadError(error)
+
+    if cfg['in_from']:
+        try:
+            if cfg['in_from'] == '-' and not os.path.exists('-'):
+                f = sys.stdin
+            else:
+                f = open(cfg['in_from'], 'r')
+        except OSError as e:
+            raise _errors.ReadError(f'{cfg["in_from"]}: {os.strerror(e.errno)}')
+        with f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line:
+                    yield line
+
+
+def imap_ordered(func, iterable, workers):
+    """
+    Yield `(item, future)` tuples for each item in `iterable`
+
+    `func` is called with each item in `workers` threads. The futures are
+    yielded in the same order as the items. No more than ``workers * 2`` items
+    are processed ahead of the consumer to keep memory usage bounded.
+
+    If `iterable` raises an exception, it is raised after all previous items
+    are yielded.
+    """
+    pending = collections.deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        try:
+            for item in iterable:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft()
+        except Exception:
+            while pending:
+                yield pending.popleft()
+            raise
+        while pending:
+            yield pending.popleft()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def imap_per_device(func, items, device_jobs):
+    """
+    Yield `(item, future)` tuples for each `(device, item)` tuple in `items`
+
+    Items on the same device are processed by up to `device_jobs` threads in
+    the order they are given while different devices are processed
+    concurrently. The futures are yielded in the same order as the items.
+    """
+    executors = {}
+    # Yielded futures are removed so their results can be freed
+    pending = collections.deque()
+    try:
+        for device, item in items:
+            if device not in executors:
+                executors[device] = concurrent.futures.ThreadPoolExecutor(max_workers=device_jobs)
+            pending.append((item, executors[device].submit(func, item)))
+        while pending:
+            yield pending.popleft()
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_cpu_count():
+    """Return number of CPUs this process can use, considering CPU affinity and cgroup quota"""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    quota = _get_cgroup_cpu_quota()
+    if quota:
+        count = min(count, math.ceil(quota))
+    return max(1, count)
+
+
+def _get_cgroup_cpu_quota():
+    # Return number of CPUs the cgroup is allowed to use or `None`
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def parse_cpus(string):
+    """Return set of CPU numbers from comma-separated numbers and ranges like "0-3,6" """
+    cpus = set()
+    try:
+        for part in string.split(','):
+            first, _, last = part.partition('-')
+            first = int(first)
+            last = int(last) if last else first
+            if first < 0 or last < first:
+                raise ValueError(part)
+            cpus.update(range(first, last + 1))
+    except ValueError:
+        raise _errors.CliError(f'Invalid CPU list: {string}')
+    return cpus
+
+
+# Names of I/O scheduling classes mapped to their numbers (see ioprio_set(2))
+IO_PRIORITY_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# ioprio_set() system call numbers
+_IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30,
+    'armv7l': 314, 'ppc64le': 273, 's390x': 282,
+}
+
+
+def set_io_priority(ioclass, level=0):
+    """
+    Set I/O scheduling class and priority `level` of the calling thread
+
+    Threads and processes that are started afterwards inherit it.
+
+    :param str ioclass: Key in :attr:`IO_PRIORITY_CLASSES`
+    :param int level: Priority from 0 (highest) to 7 (lowest)
+
+    :raise Error: if the I/O priority can't be set
+    """
+    import ctypes
+    import ctypes.util
+    import platform
+    syscall_number = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if not sys.platform.startswith('linux') or syscall_number is None:
+        raise _errors.Error('Setting I/O priority is not supported on this platform')
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    # IOPRIO_WHO_PROCESS is 1 and 0 means the calling thread
+    ioprio = (IO_PRIORITY_CLASSES[ioclass] << 13) | level
+    if libc.syscall(syscall_number, 1, 0, ioprio) != 0:
+        raise _errors.Error(f'Failed to set I/O priority: {os.strerror(ctypes.get_errno())}')
+
+
+def set_scheduling(nice=0, ionice=None, cpus=None):
+    """
+    Apply CPU priority, I/O priority and CPU affinity to the calling thread
+
+    This must be called before any reading or hashing threads or processes are
+    started so they inherit it.
+
+    :param int nice: Value that is added to the niceness
+    :param ionice: `(ioclass, level)` tuple as accepted by
+        :func:`set_io_priority` or `None`
+    :param cpus: Set of CPU numbers to run on or `None`
+
+    :raise Error: if anything can't be applied
+    """
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError as e:
+            raise _errors.Error(f'Failed to set niceness: {os.strerror(e.errno)}')
+    if ionice:
+        set_io_priority(*ionice)
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except AttributeError:
+            raise _errors.Error('Setting CPU affinity is not supported on this platform')
+        except OSError as e:
+            raise _errors.Error(f'Failed to set CPU affinity: {os.strerror(e.errno)}')
+
+
+def get_device(path):
+    """Return ID of the device `path` or its closest existing parent is on"""
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+def read_manifest(filepath):
+    """
+    Return list of `(torrent, path)` tuples from TAB-separated lines in `filepath`
+
+    Empty lines and lines starting with "#" are ignored. If `filepath` is "-"
+    and doesn't exist, stdin is read.
+    """
+    try:
+        if filepath == '-' and not os.path.exists('-'):
+            lines = sys.stdin.readlines()
+        else:
+            with open(filepath, 'r') as f:
+                lines = f.readlines()
+    except OSError as e:
+        raise _errors.ReadError(f'{filepath}: {os.strerror(e.errno)}')
+
+    pairs = []
+    for lineno, line in enumerate(lines, start=1):
+        line = line.rstrip('\n')
+        if not line or line[0] == '#':
+            continue
+        parts = line.split('\t')
+        if len(parts) != 2 or not all(parts):
+            raise _errors.ReadError(f'{filepath}:{lineno}: Expected TORRENT<TAB>PATH: {line}')
+        pairs.append(tuple(parts))
+    return pairs
+
+
+def _get_umask():
+    # The umask can only be read by changing it, which is not thread-safe, so
+    # this is done once when the module is imported
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+_UMASK = _get_umask()
+
+
+def write_file_atomic(filepath, data):
+    """
+    Write `data` to `filepath` without leaving a partially written file behind
+
+    `data` is written to a temporary file in the same directory, which is then
+    renamed to `filepath`. The file gets the mode of the existing `filepath` or
+    the default mode for new files.
+    """
+    dirpath = os.path.dirname(filepath) or '.'
+    try:
+        try:
+            mode = os.stat(filepath).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), mode)
+                f.write(data)
+            os.replace(tmppath, filepath)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+    except OSError as e:
+        raise _errors.WriteError(f'{filepath}: {os.strerror(e.errno)}')
 
 
 def is_magnet(string):
     return not os.path.exists(string) and string.startswith('magnet:')
 
 
+def is_glob(string):
+    return (
+        not os.path.exists(string)
+        and not is_magnet(string)
+        and any(char in string for char in '*?[')
+    )
+
+
 class Average():
     def __init__(self, samples):
         self.times = []
@@ -307,7 +650,7 @@ def metainfo(dct, all_fields=False, remove_pieces=True):
 
     return bool2int(new)
 
-def json_dumps(obj):
+def json_dumps(obj, indent=4):
     def default(obj):
         if isinstance(obj, datetime.datetime):
             return int(obj.timestamp())
@@ -315,4 +658,4 @@ def json_dumps(obj):
             return base64.standard_b64encode(obj).decode()
         else:
             return str(obj)
-    return json.dumps(obj, allow_nan=False, indent=4, default=default) + '\n'
+    return json.dumps(obj, allow_nan=False, indent=indent, default=default) + '\n'